@@ -13,7 +13,20 @@ __maintainer__ = 'George Flanagin'
 __email__ = 'me@georgeflanagin.com'
 __status__ = 'PyRVA demonstration'
 __license__ = 'MIT'
-__required_version__ = (3,5)
+__required_version__ = (3,9)
+
+import time
+startup_clock = time.perf_counter()
+startup_profile = []
+def startup_phase(name:str) -> None:
+    """
+    Record how long it has been since the previous phase of startup
+    ended. The list is printed by --startup-profile.
+    """
+    global startup_clock
+    now = time.perf_counter()
+    startup_profile.append((name, now - startup_clock))
+    startup_clock = now
 
 import getpass
 import os
@@ -31,10 +44,11 @@ if sys.version_info < __required_version__:
     print('This program requires Python {} or greater.'.format(__required_version__))
     sys.exit(os.EX_SOFTWARE)
 
+# Only what this program and its supporting files import. Anything
+# else is checked when (if) a command needs it.
 required_modules = sorted([
-    'setproctitle', 'simplejson', 'psutil', 'paramiko', 'croniter', 'twisted',
-    'dateutil', 'shlex', 'shutil', 'sortedcontainers', 'multimap', 'pandas',
-    'OpenSSL'])
+    'setproctitle', 'simplejson', 'paramiko', 'croniter', 'dateutil', 
+    'sortedcontainers'])
 
 import importlib.util
 missing_modules = set()
@@ -49,16 +63,24 @@ if len(missing_modules):
     print("Hey! You don't have everything you need. You seem to be missing\n" +
         ", ".join(missing_modules))
     sys.exit(os.EX_SOFTWARE)
+startup_phase('dependency check')
     
 
 # Builtins
 import argparse
 import cmd
+import codecs
+import collections
+import concurrent.futures
+import datetime
+import functools
 import glob
 import json
 import logging
 import os
+import posixpath
 import pprint as pp
+import select
 import setproctitle
 import socket
 import subprocess
@@ -66,34 +88,65 @@ import sys
 import time
 import typing
 from   typing import *
-
-# Paramiko
-import paramiko 
-from   paramiko import SSHClient, SSHConfig, SSHException
+startup_phase('standard library')
 
 import fname
 import jparse
+import keepalive
+import probestore
+import tomblog
 import gkflib as gkf
+import cfgjournal
+import cfgsnapshot
+import dnscache
+import hopstats
+import pluginpool
+import pluginreg
+import sshpool
+import sweep
+import transfer
+startup_phase('fname, jparse, gkflib, and friends')
+
+# Paramiko (and the cryptography it drags in) is the most expensive
+# import we have, and many sessions never connect to anything. It is 
+# loaded the first time one of its attributes is used.
+paramiko = gkf.lazy_import('paramiko')
+# A paramiko.HostKeys, so it waits for paramiko.
+knownhosts = gkf.lazy_import('knownhosts')
+
 from hpclib import urdecorators
+startup_phase('hpclib')
 
 
 import pdb
 run_debugger = False
 
+class SmallHOP: pass
+
 members = ['kex', 'ciphers', 'digests', 'compression', 'key_types']
 
+@functools.lru_cache(maxsize=None)
+def my_fqdn() -> str:
+    """
+    getfqdn() may go all the way to the resolver, so we only ask once
+    per process rather than once per SmallHOP.
+    """
+    return socket.getfqdn().replace('-','.')
+
+
 class SmallHOP:
 
     __slots__ = [
         'my_host', 'user', 'remote_host', 'remote_port', 'ssh_info',
         'auth_timeout', 'banner_timeout', 'tcp_timeout', 'sock_type', 'sock_domain',
         'password', 'sock', 'transport', 'security', 'channel',
-        'client', 'sftp', 'error', 'do_logging'
+        'client', 'sftp', 'error', 'do_logging', 'pool', 'pool_key', 'resolver',
+        'monitor'
         ]
 
     def __init__(self, do_log:bool=False):
         # Identification members
-        self.my_host = socket.getfqdn().replace('-','.')
+        self.my_host = my_fqdn()
         self.user = gkf.me()
         self.remote_host = ""
         self.remote_port = 0
@@ -104,9 +157,10 @@ class SmallHOP:
         self.banner_timeout = 1.0
         self.tcp_timeout = 1.0
 
-        # Socket types
+        # Socket types. AF_UNSPEC tries both IPv4 and IPv6.
         self.sock_type = socket.SOCK_STREAM
-        self.sock_domain = socket.AF_INET
+        self.sock_domain = socket.AF_UNSPEC
+        self.resolver = dnscache.cache
 
         # Connection parameters.
         self.password = None
@@ -118,6 +172,15 @@ class SmallHOP:
         self.sftp = None
         self.do_logging = do_log
 
+        # Reuse of authenticated connections. None means every session
+        # is built (and torn down) from scratch.
+        self.pool = sshpool.pool
+        self.pool_key = None
+
+        # Keepalives and round trip times for the sessions we open. None
+        # means the sessions are left alone.
+        self.monitor = keepalive.monitor
+
         # Most recent error.
         self.error = None
 
@@ -135,14 +198,44 @@ class SmallHOP:
             self.remote_host, self.remote_port, self.error_msg())
 
 
+    def clone(self) -> SmallHOP:
+        """
+        Return a fresh, unconnected SmallHOP that has the same timeouts,
+        socket settings, and credentials as this one. Used wherever we
+        need one hop per host rather than the shared one. The clone does
+        not use the connection pool; a probe of a pooled connection would
+        not tell us anything.
+        """
+        other = SmallHOP(self.do_logging)
+        other.pool = None
+        other.monitor = None
+        other.auth_timeout = self.auth_timeout
+        other.banner_timeout = self.banner_timeout
+        other.tcp_timeout = self.tcp_timeout
+        other.sock_type = self.sock_type
+        other.sock_domain = self.sock_domain
+        other.resolver = self.resolver
+        other.password = self.password
+        return other
+
+
     def close(self) -> None:
-        """ Close everything and reset values for a second use. """
+        """ 
+        Close everything and reset values for a second use. If we have
+        an authenticated session and a pool, the session goes back into
+        the pool rather than being closed.
+        """
 
         if self.sftp: self.sftp.close(); self.sftp = None
         if self.channel: self.channel.close(); self.channel = None
+        if self.pool is not None and self.pool_key and self.client and self.error is None:
+            self.pool.release(self.pool_key, self.client)
+            self.client = self.transport = self.sock = None
+        if self.transport and self.monitor is not None: self.monitor.forget(self.transport)
         if self.transport: self.transport.close(); self.transport = None
         if self.client: self.client.close(); self.client = None
         if self.sock: self.sock.close(); self.sock = None
+        self.pool_key = None
 
 
     def debug_level(self, level:int=None) -> int:
@@ -173,16 +266,68 @@ class SmallHOP:
             "x":"x11"
             }
 
-        if data not in channel_types.keys() and data not in channel_types.values():
-            self.error = 'unknown channel type: {}'.format(data)
+        if channel_type not in channel_types.keys() and channel_type not in channel_types.values():
+            self.error = 'unknown channel type: {}'.format(channel_type)
             return False
 
         try:
-            self.channel = self.transport.open_channel(data)
+            start_time = time.perf_counter()
+            self.channel = self.transport.open_channel(
+                channel_types.get(channel_type, channel_type))
+            hopstats.stats.record(self.remote_host, 'channel', time.perf_counter() - start_time)
         except Exception as e:
             self.error = gkf.type_and_text(e)
         finally:
-            return self.error is not None
+            return self.error is None
+
+
+    def run_command(self, command:str, 
+            stdout:Callable[[bytes], None], 
+            stderr:Callable[[bytes], None],
+            bufsize:int=32768,
+            cap:int=None) -> tuple:
+        """
+        Run a command on the open channel, handing its output to stdout()
+        and stderr() a piece at a time, as it arrives. We never hold more
+        than bufsize bytes of it, and because we only read when the last
+        piece has been dealt with, a slow reader makes the far end wait
+        (the channel's window fills up) rather than making us grow.
+
+        cap -- if given, stop after this many bytes of output and close
+            the channel.
+
+        returns -- (exit status, stdout bytes, stderr bytes, truncated).
+            The exit status is -1 if we closed the channel first.
+        """
+        channel = self.channel
+        channel.exec_command(command)
+
+        nbytes = {'out':0, 'err':0}
+        truncated = False
+        try:
+            while True:
+                select.select([channel], [], [], 1.0)
+                for name, ready, recv, sink in (
+                        ('err', channel.recv_stderr_ready, channel.recv_stderr, stderr),
+                        ('out', channel.recv_ready, channel.recv, stdout)):
+                    if not ready(): continue
+                    chunk = recv(bufsize if cap is None 
+                        else max(1, min(bufsize, cap - nbytes['out'] - nbytes['err'])))
+                    nbytes[name] += len(chunk)
+                    sink(chunk)
+
+                if cap is not None and nbytes['out'] + nbytes['err'] >= cap:
+                    truncated = True
+                    break
+                if channel.eof_received and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+
+        finally:
+            if truncated or not channel.eof_received:
+                channel.close()
+
+        status = channel.recv_exit_status() if not truncated else -1
+        return status, nbytes['out'], nbytes['err'], truncated
 
 
     def open_session(self) -> bool:
@@ -194,25 +339,54 @@ class SmallHOP:
         global members
 
         self.error = None
-        self.client = SSHClient()
-        self.client.load_system_host_keys()
+        if self.pool_key and self.client:
+            # open_socket() found this session in the pool.
+            self.read_security()
+            return True
+
+        self.client = paramiko.SSHClient()
+        # Rather than load_system_host_keys(), which would read all of
+        # known_hosts again for this one client.
+        self.client._system_host_keys = knownhosts.known_hosts
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
 
+        # connect() does the banner, the kex, and the auth in one go. The
+        # socket tells us when the banner arrived, and the transport tells
+        # us when the kex is done.
+        sock = None if self.sock is None else hopstats.TimedSocket(self.sock)
+        marks = {}
+        def transport_factory(*args, **kwargs) -> object:
+            t = paramiko.Transport(*args, **kwargs)
+            start_client = t.start_client
+            def timed_start_client(*args, **kwargs) -> None:
+                start_client(*args, **kwargs)
+                marks['kex'] = time.perf_counter()
+            t.start_client = timed_start_client
+            return t
+
         try:
             username=self.ssh_info.get('user', getpass.getuser())
+            start_time = time.perf_counter()
             if not self.password:
                 self.client.connect(self.ssh_info['hostname'],
-                    int(self.ssh_info['port']),
+                    int(self.ssh_info.get('port', 22)),
                     username=username,
-                    key_filename=self.ssh_info['identityfile'],
-                    sock=self.sock)        
+                    key_filename=self.ssh_info.get('identityfile'),
+                    sock=sock,
+                    banner_timeout=self.banner_timeout,
+                    auth_timeout=self.auth_timeout,
+                    transport_factory=transport_factory)        
 
             else:
                 self.client.connect(self.ssh_info['hostname'], 
-                    int(self.ssh_info['port']), 
+                    int(self.ssh_info.get('port', 22)), 
                     username=username, 
                     password=self.password,
-                    sock=self.sock)
+                    sock=sock,
+                    banner_timeout=self.banner_timeout,
+                    auth_timeout=self.auth_timeout,
+                    transport_factory=transport_factory)
+            stop_time = time.perf_counter()
 
         except paramiko.ssh_exception.BadAuthenticationType as e:
             self.error = str(e)
@@ -226,22 +400,82 @@ class SmallHOP:
 
         else:
             self.open_transport()
-            opts = self.transport.get_security_options()          
-            self.security = { k:list(getattr(opts, k, None)) for k in members }
-            self.security['host_key'] = self.transport.get_remote_server_key().get_base64()
-            self.security['version'] = self.transport.remote_version
+            self.read_security()
+            self.pool_key = sshpool.TransportPool.key(
+                self.remote_host, self.remote_port, username)
+            if self.monitor is not None:
+                self.monitor.watch(self.remote_host if self.remote_port == 22 else
+                    '{}:{}'.format(self.remote_host, self.remote_port), self.transport)
+            if sock is not None and sock.first_recv and 'kex' in marks:
+                hopstats.stats.record(self.remote_host, 'banner', sock.first_recv - start_time)
+                hopstats.stats.record(self.remote_host, 'kex', marks['kex'] - sock.first_recv)
+                hopstats.stats.record(self.remote_host, 'auth', stop_time - marks['kex'])
 
         finally:
             return self.error is None
 
 
+    def open_handshake(self) -> bool:
+        """
+        Negotiate the transport over the open socket, and nothing more:
+        the banner, the KEXINIT, and the key exchange that gets us the
+        host key. No authentication is attempted, so no credentials are
+        needed and the server logs no failures. self.security gets the
+        host key and the version, as read_security() would give them,
+        and, under 'offered', the server's algorithm lists in its order
+        of preference. Those are what the server would accept, not what
+        our client would use, so they are kept apart from the lists that
+        read_security() fills in.
+        """
+        self.error = None
+        if self.sock is None:
+            self.error = 'Socket not open.'
+            return False
+
+        sock = hopstats.TimedSocket(self.sock)
+        t = None
+        try:
+            t = paramiko.Transport(sock)
+            t.banner_timeout = self.banner_timeout
+
+            # The transport forgets the server's KEXINIT once the keys are
+            # in use, so keep a copy as it goes by.
+            kexinit = {}
+            parse_kex_init = t._parse_kex_init
+            def keep_kex_init(m:object) -> None:
+                parse_kex_init(m)
+                kexinit['server'] = t.remote_kex_init
+            t._parse_kex_init = keep_kex_init
+
+            start_time = time.perf_counter()
+            t.start_client(timeout=self.auth_timeout)
+            stop_time = time.perf_counter()
+
+            self.security = {'offered': parse_kexinit(kexinit['server'])}
+            self.security['host_key'] = t.get_remote_server_key().get_base64()
+            self.security['version'] = t.remote_version
+            if sock.first_recv:
+                hopstats.stats.record(self.remote_host, 'banner', sock.first_recv - start_time)
+                hopstats.stats.record(self.remote_host, 'kex', stop_time - sock.first_recv)
+
+        except Exception as e:
+            self.error = gkf.type_and_text(e)
+
+        finally:
+            if t is not None: t.close()
+            self.sock = None
+            return self.error is None
+
+
     def open_sftp(self, data:list=[]) -> bool:
         """
         Open an sftp connection to the remote host.
         """
         self.error = None
         try:
+            start_time = time.perf_counter()
             self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            hopstats.stats.record(self.remote_host, 'sftp', time.perf_counter() - start_time)
 
         except Exception as e:
             self.error = gkf.type_and_text(e)
@@ -266,10 +500,28 @@ class SmallHOP:
         except:
             port = int(self.ssh_info.get('port', 22))
 
-        self.sock = socket.socket(self.sock_domain, self.sock_type)
+        if self.pool is not None:
+            key = sshpool.TransportPool.key(hostname, port, 
+                self.ssh_info.get('user', getpass.getuser()))
+            client = self.pool.acquire(key)
+            if client is not None:
+                self.client = client
+                self.transport = client.get_transport()
+                self.sock = self.transport.sock
+                self.pool_key = key
+                self.remote_host = hostname
+                self.remote_port = port
+                return True
+
+        self.sock = None
         try:
-            self.sock.settimeout(self.tcp_timeout)
-            self.sock.connect((hostname,port))
+            addresses = self.resolver.resolve(hostname, port, self.sock_domain, self.sock_type)
+            start_time = time.perf_counter()
+            self.sock = dnscache.connect(addresses, self.tcp_timeout)
+            hopstats.stats.record(hostname, 'connect', time.perf_counter() - start_time)
+
+        except socket.gaierror as e:
+            self.error = 'cannot resolve {}: {}'.format(hostname, e)
 
         except socket.timeout as e:
             self.error = 'timeout of {} seconds exceeded.'.format(self.tcp_timeout)
@@ -303,47 +555,155 @@ class SmallHOP:
             return self.error is None
             
     
+    def read_security(self) -> None:
+        """
+        Fill in self.security from the open transport.
+        """
+        global members
+
+        opts = self.transport.get_security_options()          
+        self.security = { k:list(getattr(opts, k, None)) for k in members }
+        self.security['host_key'] = self.transport.get_remote_server_key().get_base64()
+        self.security['version'] = self.transport.remote_version
+
+
     def timeouts(self) -> tuple:
         return self.tcp_timeout, self.auth_timeout, self.banner_timeout
 
+
+def probe_one(template:SmallHOP, host:str) -> dict:
+    """
+    Probe a single host with its own SmallHOP, built from the template's
+    settings. Nothing here touches shared state, so any number of these
+    can run at once.
+
+    returns -- a dict with the host, how far we got, the error (if any),
+        and the elapsed time of each step in seconds.
+    """
+    result = {'host':host, 'socket':False, 'session':False, 'error':None,
+        'socket_time':0.0, 'session_time':0.0}
+
+    hop = template.clone()
+    try:
+        start_time = time.time()
+        result['socket'] = hop.open_socket(host)
+        result['socket_time'] = time.time() - start_time
+        if result['socket']:
+            start_time = time.time()
+            result['session'] = hop.open_session()
+            result['session_time'] = time.time() - start_time
+        if hop.error is not None: result['error'] = hop.error_msg()
+
+    except Exception as e:
+        result['error'] = gkf.type_and_text(e)
+
+    finally:
+        hop.close()
+
+    return result
+
+
+def scan_one(template:SmallHOP, host:str) -> dict:
+    """
+    Like probe_one(), but only as far as the key exchange. See 
+    SmallHOP.open_handshake().
+
+    returns -- a dict with the host, the name it resolved to, the 
+        security info, the error (if any), and the elapsed time.
+    """
+    result = {'host':host, 'hostname':None, 'security':None, 'error':None, 'seconds':0.0}
+
+    hop = template.clone()
+    start_time = time.time()
+    try:
+        if hop.open_socket(host) and hop.open_handshake():
+            result['hostname'] = hop.remote_host
+            result['security'] = hop.security
+        else:
+            result['error'] = hop.error_msg()
+
+    except Exception as e:
+        result['error'] = gkf.type_and_text(e)
+
+    finally:
+        result['seconds'] = time.time() - start_time
+        hop.close()
+
+    return result
+
+
+def parse_kexinit(kexinit:bytes) -> dict:
+    """
+    Pull the algorithm lists out of a KEXINIT message (RFC 4253, 7.1), 
+    in the sender's order of preference, with the names beachhead.json
+    uses for the client's lists. We report what the server will accept
+    from us; the server-to-client lists are almost always the same.
+    """
+    m = paramiko.Message(kexinit)
+    m.get_byte()        # message type
+    m.get_bytes(16)     # cookie
+    kex, key_types, ciphers, _, digests, _, compression, _ = [ m.get_list() for i in range(8) ]
+    return {'kex':kex, 'ciphers':ciphers, 'digests':digests, 
+        'compression':compression, 'key_types':key_types}
+
+
+def probe_many(template:SmallHOP, hostnames:list, workers:int=1, 
+        probe:Callable=probe_one) -> Iterator[dict]:
+    """
+    Probe the hosts with at most `workers` of them in flight at once.
+    The results are yielded in the same order as hostnames, regardless
+    of the order in which the probes finish. probe is probe_one() or
+    scan_one().
+    """
+    if not hostnames: return
+
+    # Finish the lazy import of paramiko here, rather than in several
+    # workers at once.
+    paramiko.Transport
+
+    def one(host:str) -> dict:
+        # Anything tombstoned along the way is about this host.
+        with tomblog.host_context(host): return probe(template, host)
+
+    workers = max(1, min(workers, len(hostnames)))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = [ pool.submit(one, _) for _ in hostnames ]
+    try:
+        for f in futures:
+            yield f.result()
+    finally:
+        # If the caller quits early (control-C), do not start the rest.
+        for f in futures: f.cancel()
+        pool.shutdown()
+
 ########################################################
 
 # plugins! 
 
-from hpclib import fileutils, urlogger, urdecorators
-import pathlib
+from hpclib import urlogger, urdecorators
 logger = urlogger.URLogger(level=logging.DEBUG,rotator=2,logfile="beachhead_startup.log")
+startup_phase('logger')
 
 
-plugins = {}
-def load_plugin(plugin_path: str) -> int:
-    plugin_name = plugin_path.stem
-    module_spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
-    module = importlib.util.module_from_spec(module_spec)
-    module_spec.loader.exec_module(module)
-    
-    if hasattr(module, 'main') and callable(module.main):
-        plugins[plugin_name] = module.main
-        return 0
-    else:
-        logger.error(f"Plugin {plugin_name} is mising main function, ignoring.")
-    
+# Plugins are found through a cached manifest, and each one is imported
+# the first time it is run, so sessions that never use one do not pay.
+plugins = pluginreg.PluginRegistry('plugins')
 
-# find and load plugins
-for plugin_path in tuple(fileutils.all_files_in('plugins/')):
-    plugin_path = pathlib.Path(plugin_path)
-    if plugin_path.glob("*.py"):
-        load_plugin(plugin_path)
+# The worker processes that the `plugin` and `runon` commands use. None
+# until the first of those.
+plugin_pool = None
+def get_plugin_pool() -> pluginpool.WorkerPool:
+    global plugin_pool
+    if plugin_pool is None: plugin_pool = pluginpool.WorkerPool(plugins)
+    return plugin_pool
 
-
-def run_plugin(p:str,*args) -> (int, str): # exit code, return
-    if not plugins.get(p):
-        logger.debug(f"Plugin '{p}' called but not found in plugins folder")
-        return -1, f"Plugin '{p}' not found in plugins folder"
+def run_plugin(p:str,*args) -> (int, object): # exit code, return
     try:
         logger.debug(f"Running plugin {p}")
-        exit_code, result = exec(plugins[p](args))
-        return exit_code, result
+        return plugins.run(p, *args)
+    except pluginreg.PluginError as e:
+        logger.debug(str(e))
+        return -1, str(e)
     except Exception as exception:
         logger.error(f"Plugin {p} failed: {str(exception)}")
         return -1, exception
@@ -397,21 +757,57 @@ banner = [
     ""
 ] 
 
-from io import StringIO
 terminal_mode = True
-old_stdout = sys.stdout
-old_stderr = sys.stderr
 if not os.isatty(0):
+    # Everything goes to stdout, in the order it happens, as it happens.
+    # Nothing is held back until the end, so nothing is lost if we die.
     terminal_mode = False
     banner = [gkf.REVERT,'\nBEACHHEAD']
-    #logfile = open('output.txt', 'w')
-    #sys.stdout = logfile
-    #sys.stderr = logfile
-    logger_stdout = StringIO()
-    sys.stdout = logger_stdout
-    sys.stderr = logger_stdout
+    sys.stderr = sys.stdout
+startup_phase('console')
 
 __default_config__ = 'beachhead.json'
+def find_config(explicit:str=None) -> Tuple[str, str]:
+    """
+    Look for the config in these places, in order, and stop at the
+    first one that exists:
+
+        the --config option
+        $BEACHHEAD_CONFIG
+        ./beachhead.json
+        $XDG_CONFIG_HOME/beachhead/beachhead.json (~/.config if unset)
+
+    returns -- the full name of the file, and which of the above found
+        it; or None, None.
+    """
+    xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    for f, found_by in (
+            (explicit, '--config'),
+            (os.environ.get('BEACHHEAD_CONFIG'), '$BEACHHEAD_CONFIG'),
+            (__default_config__, 'current directory'),
+            (os.path.join(xdg, 'beachhead', __default_config__), 'XDG config directory')):
+        if not f: continue
+        f = os.path.abspath(os.path.expanduser(f))
+        if os.path.isfile(f): return f, found_by
+        if found_by.startswith(('--', '$')):
+            gkf.tombstone(red('{} names {}, which does not exist.'.format(found_by, f)))
+
+    return None, None
+
+
+def probes_file() -> str:
+    """
+    returns -- where probe, history and probe-daemon keep the results:
+        $XDG_STATE_HOME/beachhead/beachhead.probes (~/.local/state if
+        unset), the same wherever we were started. The directory is
+        made if need be.
+    """
+    xdg = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    directory = os.path.join(xdg, 'beachhead')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, 'beachhead.probes')
+
+
 class Beachhead: pass
 class Beachhead(cmd.Cmd):
     """
@@ -422,18 +818,125 @@ class Beachhead(cmd.Cmd):
     doc_header = 'To get a little overall guidance, type `help general`'
     intro = "\n".join(banner)
 
-    def __init__(self, do_log:bool):
+    def __init__(self, do_log:bool, show_startup_profile:bool=False, cfg_file:str=None):
         
         cmd.Cmd.__init__(self)
         Beachhead.prompt = "\n[beachhead]: "
+        self.show_startup_profile = show_startup_profile
         self.hop = SmallHOP(do_log)
         self.cfg = {}
-        self.cfg_file = None
+        self.cfg_file = cfg_file
+        self.cfg_found_by = None
+        self.journal = None
+        self.probes = probestore.ProbeStore(probes_file())
+        self.cfg_how = None
+        self.cfg_load_time = 0.0
+
+        # The config file is checked for changes before a command, but
+        # not more often than every cfg_poll seconds.
+        self.cfg_mtime = None
+        self.cfg_poll = 1.0
+        self.cfg_next_check = 0.0
+        self.probe_workers = 16
+        self.transfer_workers = 4
+        self.sweep_workers = 256
+        self.batch_mode = False
+        self.last_status = 0
 
     def precmd(self, line):
-        if not terminal_mode: print(line)
+        if not terminal_mode or self.batch_mode: print(line)
+        self._check_config()
         return line
 
+
+    def postcmd(self, stop:bool, line:str) -> bool:
+        # What the command said goes out before the next prompt.
+        tomblog.flush()
+        return stop
+
+
+    def run_one(self, line:str) -> Tuple[int, float]:
+        """
+        Run one command, as the console would. The status is 1 if the
+        command raised, was not recognized, or left a new error on the
+        connection; otherwise 0.
+
+        returns -- (status, elapsed seconds).
+        """
+        self.last_status = 0
+        error_before = self.hop.error
+        start_time = time.perf_counter()
+        try:
+            line = self.precmd(line)
+            self.postcmd(self.onecmd(line), line)
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+            self.last_status = 1
+
+        except Exception as e:
+            gkf.tombstone(red(gkf.type_and_text(e)))
+            self.last_status = 1
+
+        if self.hop.error is not None and self.hop.error is not error_before:
+            self.last_status = 1
+        return self.last_status, time.perf_counter() - start_time
+
+
+    def run_batch(self, commands:Iterable[str], stop_on_error:bool=False) -> int:
+        """
+        Run the commands one line at a time, reporting the status and
+        time of each. Blank lines and lines starting with # are skipped.
+        Output is flushed after each command, so that what has been done
+        is on the page (or in the file) even if a later command hangs.
+        quit or exit ends the batch there, with the summary; quit also
+        closes everything, as it does at the console.
+
+        stop_on_error -- stop at the first failure, rather than noting it
+            and carrying on.
+
+        returns -- 0 if every command succeeded, otherwise 1.
+        """
+        self.batch_mode = True
+        self.preloop()
+
+        failures = []
+        count = 0
+        verb = None
+        start_time = time.perf_counter()
+        for lineno, line in enumerate(commands, 1):
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+
+            verb = self.parseline(line)[0]
+            if verb in ('quit', 'exit'):
+                print(line)
+                gkf.tombstone(blue('[batch] {} at line {}.'.format(verb, lineno)))
+                break
+
+            count += 1
+            status, seconds = self.run_one(line)
+            gkf.tombstone(blue('[batch] line {} status {} elapsed time: {}'.format(
+                lineno, status, elapsed_time(0, seconds))))
+            tomblog.flush()
+            sys.stdout.flush()
+
+            if status:
+                failures.append(lineno)
+                if stop_on_error:
+                    gkf.tombstone(red('[batch] stopping at line {}.'.format(lineno)))
+                    break
+
+        gkf.tombstone(blue('[batch] {} command[s], {} failed{}, elapsed time: {}'.format(
+            count, len(failures), 
+            ' (lines {})'.format(", ".join(str(_) for _ in failures)) if failures else '',
+            elapsed_time(start_time, time.perf_counter()))))
+        self.postloop()
+        if verb == 'quit': self._close_all()
+        tomblog.flush()
+        sys.stdout.flush()
+        return 1 if failures else 0
+
     
     def preloop(self) -> None:
         """
@@ -448,34 +951,19 @@ class Beachhead(cmd.Cmd):
             gkf.tombstone('You do not seem to have an ssh config file. This program')
             gkf.tombstone('may not be very useful.')
 
-        try:
-            for d in [ os.environ.get(_, "") for _ in [ 'PWD' ] ]:
-                for this_dir, sub_dirs, files in os.walk(d):
-                    for f in files:
-                        if f == __default_config__: 
-                            self.cfg_file = os.path.join(d, this_dir, f)
-                            raise StopIteration
-
-        except StopIteration as e:
-            try:
-                jp = jparse.JSONReader()
-                self.cfg = jp.attach_IO(self.cfg_file, True).convert()
-                gkf.tombstone('Using config info read from {}'.format(self.cfg_file))
-
-            except Exception as e:
-                gkf.tombstone(str(e))
-                gkf.tombstone('{} failed to compile.'.format(self.cfg_file))
-
-        except Exception as e:
-            gkf.tombstone(gkf.type_and_text(e))
-            gkf.tombstone('Something really bad happened.')
-            raise
-
-        else:
+        self.cfg_file, self.cfg_found_by = find_config(self.cfg_file)
+        if self.cfg_file is None:
             gkf.tombstone('No config file found.')
+        else:
+            self._load_config()
+
+        startup_phase('preloop')
+        if self.show_startup_profile: self._do_startup()
+        tomblog.flush()
 
     def default(self, data:str="") -> None:
         gkf.tombstone(red('unknown command {}'.format(data)))
+        self.last_status = 1
         self.do_help(data)
 
 
@@ -527,17 +1015,47 @@ class Beachhead(cmd.Cmd):
 
     def do_do(self, data:str="") -> None:
         """
-        do { something }
+        do [ --cap bytes | --tail lines ] { something }
 
             attempt to exit a command by stuffing the text through the channel
+
+            The output is shown as it arrives. With --cap, we stop (and 
+            close the channel) after that many bytes. With --tail, only 
+            the last so many lines are shown, once the command finishes.
         """
         if not self.hop.channel or not data: 
             self.do_help('do')
             return
 
+        cap = tail = None
+        words = data.strip().split(None, 2)
+        try:
+            if words[0] in ('--cap', '--tail'):
+                if words[0] == '--cap': cap = int(words[1])
+                else: tail = collections.deque(maxlen=int(words[1]))
+                data = words[2]
+        except (IndexError, ValueError) as e:
+            self.do_help('do')
+            return
+
+        decoders = { _:codecs.getincrementaldecoder('utf-8')(errors='replace') for _ in ('out', 'err') }
+        partial = ['']
+        def show(name:str, chunk:bytes, final:bool=False) -> None:
+            text = decoders[name].decode(chunk, final)
+            if tail is None or name == 'err':
+                (sys.stdout if name == 'out' else sys.stderr).write(text)
+                return
+            lines = (partial[0] + text).split('\n')
+            partial[0] = lines.pop()
+            tail.extend(lines)
+
+        start_time = time.time()
         try:
             gkf.tombstone(blue('attempting remote command {}'.format(data)))
-            in_, out_, err_ = self.hop.channel.exec_command(data)
+            # The output is written as it comes, so it must not pass this.
+            tomblog.flush()
+            status, out_bytes, err_bytes, truncated = self.hop.run_command(data,
+                lambda _: show('out', _), lambda _: show('err', _), cap=cap)
 
         except KeyboardInterrupt as e:
             gkf.tombstone(blue('aborting. Control-C pressed.'))
@@ -546,8 +1064,15 @@ class Beachhead(cmd.Cmd):
             gkf.tombstone(red(gkf.type_and_text(e)))
 
         else:
-            out_.channel.recv_exit_status();
-            gkf.tombstone(blue(out_.readlines()))
+            show('out', b'', True); show('err', b'', True)
+            if tail is not None:
+                if partial[0]: tail.append(partial[0])
+                print("\n".join(tail))
+            sys.stdout.flush()
+            if truncated: gkf.tombstone(blue('output capped at {} bytes; channel closed.'.format(cap)))
+            gkf.tombstone(blue('received {} bytes stdout, {} bytes stderr, exit status {}'.format(
+                out_bytes, err_bytes, status)))
+            gkf.tombstone(blue('elapsed time: {}'.format(elapsed_time(start_time, time.time()))))
 
         finally:
             self.hop.open_channel()
@@ -573,13 +1098,10 @@ class Beachhead(cmd.Cmd):
     def do_EOF(self, data:str="") -> None:
         """
         EOF:
-            end of file, print out commands
+            end of file, leave quietly.
         """
         print("exited via EOF")
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
-
-        print(logger_stdout.getvalue())
+        sys.stdout.flush()
         sys.exit(os.EX_OK)
 
 
@@ -614,9 +1136,13 @@ class Beachhead(cmd.Cmd):
 
     def do_get(self, data:str="") -> None:
         """
-        get a file from the remote host.
+        get files from the remote host.
 
-        Syntax: get filename
+        Syntax: get filename [ local-directory ]
+
+            NOTE: the last part of filename can be a wildcard spec. The
+            files are written to the local directory ($PWD by default),
+            and `setworkers transfer` of them are moved at once.
         """
         if not self.hop.sftp:
             gkf.tombstone(red('sftp channel is not open.'))
@@ -626,12 +1152,78 @@ class Beachhead(cmd.Cmd):
             self.do_help('get')
             return
 
-        start_time = time.time()
-        OK = self.hop.sftp.get(data, Fname(data).fname)
-        stop_time = time.time()
-        if OK: gkf.tombstone('success')
-        else: gkf.tombstone('failure {}'.format(self.hop.error_msg()))
-        gkf.tombstone('elapsed time: {}'.format(elapsed_time(stop_time, start_time)))
+        data = data.strip().split()
+        local_dir = data[1] if len(data) > 1 else os.getcwd()
+        try:
+            files = transfer.expand_remote(self.hop.sftp, data[0])
+        except Exception as e:
+            gkf.tombstone(red(gkf.type_and_text(e)))
+            return
+
+        if not files:
+            gkf.tombstone(red('no file[s] named {}'.format(data[0])))
+            return
+
+        self._transfer('get', [ (_, os.path.join(local_dir, os.path.basename(_))) for _ in files ])
+
+
+    def do_history(self, data:str="") -> None:
+        """
+        history [ n ]
+        history {transaction-id}
+        history {host} [ n ]
+        history since {when} [ n ]
+
+            Look up the results of `probe`. With no parameter, or a number,
+            list the last n (10) transactions. With a transaction ID, show
+            its results. With a host, show its last n (10) results, the
+            newest first. With since, show the results from that time on
+            (only the last n, if n is given); when is a date and time
+            (2024-03-01, 2024-03-01T14:30) or a time ago (90s, 30m, 2h, 7d).
+        """
+        words = data.strip().split()
+        try:
+            if not words or words[0].isdigit() and len(words[0]) < 9:
+                n = int(words[0]) if words else 10
+                transactions = self.probes.recent_transactions(n)
+                for tx, count, when in transactions:
+                    gkf.tombstone('{} {} {} host[s]'.format(tx, gkf.iso_time(when), count))
+                if not transactions: gkf.tombstone(blue('no transactions yet.'))
+                return
+
+            if words[0] == 'since' and len(words) in (2, 3):
+                results = self.probes.since(self._when(words[1]),
+                    n=int(words[2]) if len(words) == 3 else None)
+            elif len(words) == 1 and words[0].isdigit():
+                results = self.probes.transaction(words[0])
+            elif len(words) in (1, 2):
+                results = self.probes.host(words[0], int(words[1]) if len(words) == 2 else 10)
+            else:
+                raise ValueError(data)
+
+        except ValueError as e:
+            self.do_help('history')
+            return
+
+        for r in results:
+            gkf.tombstone('{} {} {} {} socket {} session {}{}'.format(
+                gkf.iso_time(r.get('time', 0)), r.get('transaction'), r.get('host'),
+                'OK' if r.get('session') else red('FAILED'),
+                elapsed_time(0, r.get('socket_time', 0)),
+                elapsed_time(0, r.get('session_time', 0)),
+                ' ' + red(r['error']) if r.get('error') else ''))
+        if not results: gkf.tombstone(blue('nothing found.'))
+
+
+    def _when(self, s:str) -> float:
+        """
+        returns -- a time as seconds since the epoch, from an ISO date
+            and time, or from a time ago such as 30m.
+        """
+        units = {'s':1, 'm':60, 'h':3600, 'd':86400}
+        if s[-1:] in units and s[:-1].isdigit():
+            return time.time() - int(s[:-1]) * units[s[-1]]
+        return datetime.datetime.fromisoformat(s).timestamp()
 
 
     def do_hosts(self, data:str="") -> None:
@@ -689,7 +1281,47 @@ class Beachhead(cmd.Cmd):
             logging.getLogger("paramiko").setLevel(logging.NOTSET)
 
         return
-        
+
+
+    def do_messages(self, data:str="") -> None:
+        """
+        messages [ text | json | direct | level { debug | info | warning | error } ]
+
+            Without a parameter, show how this program's own messages
+            are being written.
+
+            text -- queue the messages, and write them from a background
+                thread, a batch at a time, in the usual format. This is
+                the default.
+            json -- the same, but one JSON object per line, with the
+                time, level, process, thread, and host of each message.
+            direct -- write each message as it is made, with no queue.
+            level -- do not show messages below this level. The results
+                of probe, scan, sweep, and runon are info if they
+                succeeded and warnings if they did not.
+        """
+        words = data.strip().lower().split()
+        if not words:
+            backend = gkf.tombstone_backend
+            gkf.tombstone(blue('messages are {}, {} and up'.format(
+                'direct' if backend is None else backend.fmt,
+                tomblog.level_names.get(gkf.tombstone_level, gkf.tombstone_level))))
+            if backend is not None: gkf.tombstone(blue(backend.stats()))
+            return
+
+        if words[0] == 'level' and len(words) == 2 and words[1] in tomblog.levels:
+            gkf.tombstone_level = tomblog.levels[words[1]]
+        elif words[0] in tomblog.formats and len(words) == 1:
+            tomblog.install(words[0])
+        elif words == ['direct']:
+            tomblog.uninstall()
+        else:
+            self.do_help('messages')
+            return
+
+        self.do_messages()
+
+
 
     def do_open(self, data:str="") -> None:
         """
@@ -721,18 +1353,68 @@ class Beachhead(cmd.Cmd):
             gkf.tombstone(red('no operation named {}'.format(data)))
 
 
+    def do_plugin(self, data:str="") -> None:
+        """
+        plugin [ name [ args .. ] | rescan ]
+
+            Without a parameter, list the plugins, whether each has been
+            loaded yet, how long it took to load, and how long its runs 
+            have taken. With a name, run that plugin with the rest of 
+            the line as its arguments. 'rescan' looks for new plugins
+            now rather than waiting for the directory to change.
+
+            The plugin runs in a worker process (see `runon`), and is
+            killed if it takes longer than `settimeout plugin`.
+        """
+        data = data.strip().split()
+        if not data:
+            timings = plugins.timings()
+            if not timings: gkf.tombstone(blue('no plugins in {}'.format(plugins.plugin_dir)))
+            if plugin_pool is not None:
+                gkf.tombstone(blue('workers: {running} of {size}, {calls} calls, {timeouts} timeouts, '
+                    '{crashes} crashes, {restarts} restarts'.format(**plugin_pool.stats())))
+            for name, t in timings.items():
+                gkf.tombstone(blue('{:<16} {:<10} load {:>20}  runs {:>5}  p50 {:>20}  max {:>20}'.format(
+                    name, 'loaded' if t['loaded'] else 'not loaded',
+                    elapsed_time(0, t['load']) if t['load'] is not None else '-',
+                    t['runs']['count'],
+                    elapsed_time(0, t['runs']['p50']), elapsed_time(0, t['runs']['max']))))
+            return
+
+        if data[0] == 'rescan':
+            gkf.tombstone(blue('{} plugin[s] found'.format(plugins.rescan())))
+            return
+
+        start_time = time.time()
+        if data[0] not in plugins:
+            exit_code, result = -1, "Plugin '{}' not found in {}".format(data[0], plugins.plugin_dir)
+        else:
+            try:
+                exit_code, result = get_plugin_pool().call(data[0], *data[1:])
+            except KeyboardInterrupt as e:
+                exit_code, result = -1, 'Control-C pressed.'
+        if exit_code: self.last_status = 1
+        gkf.tombstone('{} exit code {} returned {}'.format(data[0], 
+            exit_code if not exit_code else red(exit_code), result))
+        gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
+
+
     def do_probe(self, data:str="") -> None:
         """
         Syntax:
             probe {host} [ host, [host] .. ]
 
         The 'probe' is nothing more than a convenience. It connects to
-        a host with logging on and set to the debug level. The transaction
-        is appended to the logfile for later inspection.
+        a host with logging on and set to the debug level. paramiko's
+        account of it goes to the logfile.
 
-        Each probe is given a 9-digit random ID. In the logfile, you will
-        find a BEGIN TRANSACTION and an END TRANSACTION containing the information
-        that is gleaned from the probe.
+        Each probe is given a 9-digit random ID, its transaction ID.
+        The result for each host, with the time for each step, is
+        appended to the probe store (see probes_file()) under that ID,
+        in the order the hosts were given. See `history` to get them back.
+
+        Each host gets its own connection, and as many as `setworkers`
+        hosts are probed at once.
         """
 
         self.do_logging('on')
@@ -747,36 +1429,39 @@ class Beachhead(cmd.Cmd):
             hostnames = sorted(list(gkf.get_ssh_host_info('all')))
             hostnames.remove('*')
         
-        transaction_log = open('beachhead.log', 'a')
-        transaction_id = "{:0>9}".format(random.randrange(1000000000))
+        transaction_id = self.probes.new_transaction()
+        successes = 0
+        start_time = time.time()
         try:
-            transaction_log.write('BEGIN TRANSACTION {}\n'.format(transaction_id))
-            transaction_log.flush()
-            for _ in hostnames:
-                gkf.tombstone('probing {}'.format(_))
-                transaction_log.write('probing {}\n'.format(_))
-                transaction_log.flush()
-                try:
-                    self.do_open('socket {}'.format(_))
-                    if not self.hop: continue
-                    self.do_open('session')
-                    self.do_close()
-                except Exception as e:
-                    gkf.tombstone(gkf.type_and_text(e))
+            gkf.tombstone('probing {} hosts with {} workers'.format(len(hostnames), self.probe_workers))
+            for r in probe_many(self.hop, hostnames, self.probe_workers):
+                status = 'OK' if r['session'] else 'FAILED'
+                successes += int(r['session'])
+                gkf.tombstone('probed {} {}'.format(r['host'], status if r['session'] else red(r['error'])),
+                    20 if r['session'] else 30, r['host'])
+                self.probes.append(transaction_id, r)
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+
         finally:
-            transaction_log.write('END TRANSACTION {}\n'.format(transaction_id))
-            transaction_log.flush()
-            transaction_log.close()
-            gkf.tombstone("Written to logfile as transaction ID {}".format(transaction_id))
+            stop_time = time.time()
+            self.probes.commit()
+            gkf.tombstone('{} of {} hosts OK'.format(successes, len(hostnames)))
+            gkf.tombstone("Written to {} as transaction ID {}".format(
+                os.path.basename(self.probes.filename), transaction_id))
+            gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, stop_time)))
 
 
     def do_put(self, data:str="") -> None:
         """
-        put a file onto the remote host.
+        put files onto the remote host.
 
-        Syntax: put filename
+        Syntax: put filename [ remote-directory ]
 
-            NOTE: filename can be a wildcard spec.
+            NOTE: filename can be a wildcard spec. The files are written
+            to the remote directory (the login directory by default), and
+            `setworkers transfer` of them are moved at once.
         """
         if not self.hop.sftp:
             gkf.tombstone(red('sftp channel is not open.'))
@@ -787,24 +1472,14 @@ class Beachhead(cmd.Cmd):
             self.do_help('put')
             return
 
-        files = glob.glob(data)
+        data = data.strip().split()
+        remote_dir = data[1] if len(data) > 1 else ''
+        files = transfer.expand_local(data[0])
         if not files:
-            gkf.tombstone(red('no file[s] named {}'.format(data)))
+            gkf.tombstone(red('no file[s] named {}'.format(data[0])))
             return
 
-        start_time = time.time()
-        OK = None
-        for f in files:
-            try:
-                OK = self.hop.sftp.put(f.fqn, f.fname)
-            except Exception as e:
-                gkf.tombstone(red(gkf.type_and_text(e)))
-
-            stop_time = time.time()
-            if OK: gkf.tombstone('success')
-            else: gkf.tombstone('failure {}'.format(self.hop.error_msg()))
-
-        gkf.tombstone('elapsed time: '.format(elapsed_time(stop_time, start_time)))
+        self._transfer('put', [ (_, posixpath.join(remote_dir, os.path.basename(_))) for _ in files ])
 
 
     def do_quit(self, data:str="") -> None:
@@ -812,12 +1487,76 @@ class Beachhead(cmd.Cmd):
         quit:
             close up everything gracefully, and then exit.
         """
-        if self.hop.sock:
-            self.hop.sock.close()
+        self._close_all()
+        sys.stdout.flush()
         os.closerange(3,1024)
         self.do_exit(data)
 
 
+    def _close_all(self) -> None:
+        if self.hop.sock:
+            self.hop.sock.close()
+        keepalive.monitor.clear()
+        sshpool.pool.clear()
+        if plugin_pool is not None: plugin_pool.stop()
+        tomblog.uninstall()
+
+
+    def do_scan(self, data:str="") -> None:
+        """
+        Syntax:
+            scan {host} [ host, [host] .. ]
+
+        Collect the security info for each host --- the kex-es, ciphers,
+        digests, compression, host key types, host key, and version ---
+        without logging in. Only the transport is negotiated, so no 
+        credentials are needed, and the hosts' logs show no failed 
+        authentications. 'scan all' does every host in ~/.ssh/config.
+
+        As many as `setworkers` hosts are scanned at once. What is found
+        is merged into the host's entry in the config: the host key and
+        version, as `save` records them, and the server's offer lists
+        under 'offered'. The lists that `save` records (what our client
+        negotiates with) are left as they are.
+        """
+        hostnames = data.strip().split()
+        if not hostnames: 
+            self.do_help('scan')
+            return
+
+        if 'all' in hostnames:
+            hostnames = sorted(list(gkf.get_ssh_host_info('all')))
+            hostnames.remove('*')
+
+        successes = 0
+        updates = 0
+        start_time = time.time()
+        try:
+            gkf.tombstone('scanning {} hosts with {} workers'.format(len(hostnames), self.probe_workers))
+            for r in probe_many(self.hop, hostnames, self.probe_workers, scan_one):
+                if r['error'] is not None:
+                    gkf.tombstone('scanned {} {}'.format(r['host'], red(r['error'])), 30, r['host'])
+                    continue
+
+                successes += 1
+                old_info = self.cfg.get(r['hostname'], {})
+                new_info = dict(old_info, **r['security'])
+                changed = old_info != new_info
+                if changed:
+                    self._remember(r['hostname'], new_info)
+                    updates += 1
+                gkf.tombstone('scanned {} OK {} {}'.format(r['host'], 
+                    r['security']['version'], 'updated' if changed else 'unchanged'), host=r['host'])
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+
+        finally:
+            gkf.tombstone('{} of {} hosts OK, {} updated'.format(successes, len(hostnames), updates))
+            gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
+            if self.journal is not None and self.journal.due(): self.do_compact()
+
+
     def do_send(self, data:str="") -> None:
         """
         send { file filename | string }
@@ -851,6 +1590,43 @@ class Beachhead(cmd.Cmd):
             self.hop.open_channel()
 
 
+    def do_setkeepalive(self, data:str="") -> None:
+        """
+        setkeepalive [ { seconds [ stall seconds ] | off | reset } ]
+
+            Without parameters, show the keepalive settings. Every open
+            session, including those idle in the pool, is sent a
+            keepalive every `seconds` (15 to begin with), which keeps
+            NATs and firewalls from forgetting it, and the time to the
+            reply is its round trip; see `watch`.
+
+            seconds -- how often; 0 or off stops the keepalives.
+            stall   -- how late a reply may be before the host is
+                       reported as stalled (5 seconds to begin with).
+            reset   -- forget the round trips so far.
+        """
+        monitor = keepalive.monitor
+        data = data.strip().lower().split()
+
+        if not data:
+            gkf.tombstone(blue('keepalive: {}'.format(monitor.stats())))
+            return
+
+        if data == ['off']: monitor.set_interval(0)
+        elif data == ['reset']: monitor.reset()
+        elif len(data) in (1, 3) and (len(data) == 1 or data[1] == 'stall'):
+            try:
+                monitor.set_interval(float(data[0]), float(data[2]) if len(data) == 3 else None)
+            except ValueError as e:
+                gkf.tombstone(red('bad value for keepalive: {}'.format(' '.join(data))))
+                return
+        else:
+            self.do_help('setkeepalive')
+            return
+
+        self.do_setkeepalive()
+
+
     def do_setpass(self, data:str="") -> None:
         """
         setpass [password]
@@ -864,11 +1640,51 @@ class Beachhead(cmd.Cmd):
         else: self.hop.password = data        
 
 
+    def do_setpool(self, data:str="") -> None:
+        """
+        setpool [ { on | off | flush | size {n} | idle {seconds} } ]
+
+            Without parameters, show the state of the connection pool.
+            Sessions that are closed go back into the pool, and the next
+            `open socket` to the same host and user picks them up again
+            without a new handshake.
+
+            on / off -- use the pool or not. `off` also empties it.
+            flush    -- close everything in the pool.
+            size     -- the most idle connections to keep.
+            idle     -- how long an idle connection is kept.
+        """
+        pool = sshpool.pool
+        data = data.strip().lower().split()
+
+        if not data:
+            gkf.tombstone(blue('pool: {}'.format(pool.stats())))
+            return
+
+        if data[0] == 'on': pool.enabled = True
+        elif data[0] == 'off': pool.enabled = False; pool.clear()
+        elif data[0] == 'flush': gkf.tombstone(blue('closed {} connections.'.format(pool.clear())))
+        elif data[0] in ('size', 'idle') and len(data) > 1:
+            try:
+                if data[0] == 'size': pool.max_size = max(0, int(data[1]))
+                else: pool.max_idle = max(0.0, float(data[1]))
+            except ValueError as e:
+                gkf.tombstone(red('bad value for pool {}: {}'.format(data[0], data[1])))
+                return
+        else: 
+            self.do_help('setpool')
+            return
+
+        self.do_setpool()
+
+
     def do_setsockdomain(self, data:str="") -> None:
         """
-        setsockdomain [{ af_inet | af_unix }]
+        setsockdomain [{ af_inet | af_inet6 | any | af_unix }]
 
             af_inet -- internet sockets
+            af_inet6 -- internet sockets, IPv6 only
+            any -- IPv4 or IPv6, whichever connects first (the default)
             af_unix -- a socket on local host that most people call a 'pipe'
         """
 
@@ -876,6 +1692,8 @@ class Beachhead(cmd.Cmd):
         data = data.strip().lower()
 
         if data == 'af_inet': self.hop.sock_domain = socket.AF_INET
+        elif data == 'af_inet6': self.hop.sock_domain = socket.AF_INET6
+        elif data == 'any': self.hop.sock_domain = socket.AF_UNSPEC
         elif data == 'af_unix': self.hop.sock_domain = socket.AF_UNIX
         else: gkf.tombstone(blue('unknown socket domain: {}'.format(data)))
 
@@ -898,16 +1716,48 @@ class Beachhead(cmd.Cmd):
             gkf.tombstone(blue('unknown socket type: {}'.format(data)))
 
 
+    def do_setworkers(self, data:str="") -> None:
+        """
+        setworkers [ { probe | transfer | sweep | plugin } ] [ n ]
+
+            Without a parameter, show how many hosts `probe` works on at
+            once, how many files `put` and `get` move at once, how
+            many connects `sweep` has in flight at once, and how many
+            worker processes run plugins. Otherwise, set one of them; a 
+            bare number sets the probe workers. 1 does things one at a 
+            time.
+        """
+        if not data:
+            gkf.tombstone(blue('probe workers: {}'.format(self.probe_workers)))
+            gkf.tombstone(blue('transfer workers: {}'.format(self.transfer_workers)))
+            gkf.tombstone(blue('sweep workers: {}'.format(self.sweep_workers)))
+            gkf.tombstone(blue('plugin workers: {}'.format(get_plugin_pool().size)))
+            return
+
+        data = data.strip().lower().split()
+        kind = data.pop(0) if data[0] in ('probe', 'transfer', 'sweep', 'plugin') else 'probe'
+        try:
+            n = int(data[0])
+            if n < 1: raise ValueError
+        except (ValueError, IndexError) as e:
+            gkf.tombstone(red('bad value for workers: {}'.format(" ".join(data))))
+        else:
+            if kind == 'plugin': get_plugin_pool().resize(n)
+            else: setattr(self, kind+'_workers', n)
+            self.do_setworkers()
+
+
     def do_settimeout(self, data:str="") -> None:
         """
-        settimeout [ { tcp | auth | banner } {seconds} ]
+        settimeout [ { tcp | auth | banner | plugin } {seconds} ]
 
         Without parameters, settimeout will show the current socket timeout values.
         Otherwise, set it and don't forget it.
         """
         if not data: 
-            gkf.tombstone('timeouts (tcp, auth, banner): ({}, {}, {})'.format(
-                self.hop.tcp_timeout, self.hop.auth_timeout, self.hop.banner_timeout))
+            gkf.tombstone('timeouts (tcp, auth, banner, plugin): ({}, {}, {}, {})'.format(
+                self.hop.tcp_timeout, self.hop.auth_timeout, self.hop.banner_timeout,
+                get_plugin_pool().timeout))
             return
 
         data = data.strip().split()
@@ -917,7 +1767,8 @@ class Beachhead(cmd.Cmd):
             return
 
         try:
-            setattr(self.hop, data[0]+'_timeout', float(data[1]))
+            if data[0] == 'plugin': get_plugin_pool().timeout = float(data[1])
+            else: setattr(self.hop, data[0]+'_timeout', float(data[1]))
         except AttributeError as e:
             gkf.tombstone(red('no timeout value for ' + data[0]))
         except ValueError as e:
@@ -930,7 +1781,7 @@ class Beachhead(cmd.Cmd):
         """
         Usage: 
 
-            show { config | version }
+            show { config | startup | version }
         """
         if not what: self.do_help('show'); return
 
@@ -941,6 +1792,61 @@ class Beachhead(cmd.Cmd):
             self.do_help('show')
 
 
+    def do_stats(self, data:str="") -> None:
+        """
+        stats [ host | slow [n] | reset | export { json | prom } filename ]
+
+            Latency of each phase of connecting (connect, banner, kex, 
+            auth, channel, sftp), gathered from every socket and session
+            opened so far, including those of probes.
+
+            stats             -- p50/p95/p99 of each phase, all hosts together.
+            stats host        -- the same, for one host.
+            stats slow [n]    -- the n host/phase pairs with the worst p95.
+            stats reset       -- forget everything.
+            stats export ...  -- write everything to a file as JSON, or in
+                                 the Prometheus text format.
+        """
+        data = data.strip().split()
+
+        if data and data[0] == 'reset':
+            hopstats.stats.reset()
+            gkf.tombstone(blue('statistics reset.'))
+            return
+
+        if data and data[0] == 'slow':
+            try:
+                n = int(data[1]) if len(data) > 1 else 10
+            except ValueError as e:
+                self.do_help('stats'); return
+            for host, phase, p95 in hopstats.stats.slowest(n):
+                gkf.tombstone(blue('{:<40} {:<8} p95 {}'.format(host, phase, elapsed_time(0, p95))))
+            return
+
+        if data and data[0] == 'export':
+            if len(data) < 3 or data[1] not in ('json', 'prom'):
+                self.do_help('stats'); return
+            text = hopstats.stats.to_json() if data[1] == 'json' else hopstats.stats.to_prometheus()
+            try:
+                with open(data[2], 'w') as f: f.write(text)
+            except Exception as e:
+                gkf.tombstone(red(gkf.type_and_text(e)))
+            else:
+                gkf.tombstone(blue('statistics written to {}'.format(data[2])))
+            return
+
+        host = data[0] if data else None
+        phases = hopstats.stats.phases(host)
+        if not phases:
+            gkf.tombstone(blue('no statistics{}.'.format(' for '+host if host else '')))
+            return
+
+        gkf.tombstone(blue('{:<8} {:>7} {:>20} {:>20} {:>20}'.format('phase', 'count', 'p50', 'p95', 'p99')))
+        for phase, h in phases.items():
+            gkf.tombstone(blue('{:<8} {:>7} {:>20} {:>20} {:>20}'.format(phase, h.count,
+                *[ elapsed_time(0, h.percentile(_)) for _ in (50, 95, 99) ])))
+
+
     def do_status(self, data:str="") -> None:
         """
         status
@@ -950,6 +1856,17 @@ class Beachhead(cmd.Cmd):
         global members
 
         gkf.tombstone(blue("debug level: {}".format(self.hop.debug_level())))
+        gkf.tombstone(blue("pool:          {hits} hits / {misses} misses / {evictions} evictions, "
+            "{size} idle of {max_size}".format(**sshpool.pool.stats())))
+        gkf.tombstone(blue("dns cache:     {hits} hits / {misses} misses, "
+            "{live} live of {size}".format(**dnscache.cache.stats())))
+        gkf.tombstone(blue("known hosts:   {entries} entries, {salts} salts, "
+            "{hits} hits / {misses} misses".format(**knownhosts.known_hosts.stats())))
+        gkf.tombstone(blue("keepalive:     every {interval} s, {transports} session[s] to {hosts} host[s], "
+            "{stalled} stalled".format(**keepalive.monitor.stats())))
+        if gkf.tombstone_backend is not None:
+            gkf.tombstone(blue("messages:      {format}, {level} and up, {records} written "
+                "in {batches} batches, {queued} queued".format(**gkf.tombstone_backend.stats())))
         if not self.hop.sock: gkf.tombstone('not connected.'); return
 
         gkf.tombstone(blue("local end:     {}".format(self.hop.sock.getsockname())))
@@ -959,6 +1876,7 @@ class Beachhead(cmd.Cmd):
         gkf.tombstone(blue("transport:     {}".format(self.hop.transport)))
         gkf.tombstone(blue("sftp layer:    {}".format(self.hop.sftp)))
         gkf.tombstone(blue("channel:       {}".format(self.hop.channel)))
+        gkf.tombstone(blue("pooled:        {}".format(self.hop.pool_key is not None)))
         try:
             banner= self.hop.transport.get_banner().decode('utf-8') if os.isatty(0) else ''
         except:
@@ -970,6 +1888,157 @@ class Beachhead(cmd.Cmd):
             gkf.tombstone(blue("{} : {}").format(_,self.hop.security.get(_, None)))
 
 
+    def do_sweep(self, data:str="") -> None:
+        """
+        Syntax:
+            sweep {host} [ host, [host] .. ]
+
+        Find out which hosts have their ssh port open, without logging
+        in or even starting ssh. Each host gets a TCP connect and we wait
+        for its identification line; the connect time and the line are
+        reported. 'sweep all' does every host in ~/.ssh/config.
+
+        All the hosts are done at once, with as many as `setworkers sweep`
+        connects in flight, so a sweep takes about one tcp timeout (see
+        `settimeout`) rather than one per host.
+        """
+        hostnames = data.strip().split()
+        if not hostnames: 
+            self.do_help('sweep')
+            return
+
+        if 'all' in hostnames:
+            hostnames = sorted(list(gkf.get_ssh_host_info('all')))
+            hostnames.remove('*')
+
+        targets, unknown = sweep.targets(hostnames)
+        for _ in unknown: gkf.tombstone('swept {} {}'.format(_, red('unknown host')), 30, _)
+
+        gkf.tombstone('sweeping {} hosts, {} at a time'.format(
+            len(targets), min(self.sweep_workers, len(targets))))
+        start_time = time.time()
+        try:
+            family = socket.AF_UNSPEC if self.hop.sock_domain == socket.AF_UNIX else self.hop.sock_domain
+            results = sweep.sweep(targets, self.hop.tcp_timeout, self.sweep_workers, family)
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+            return
+
+        for r in results:
+            if r['rtt'] is None:
+                gkf.tombstone('swept {} {}'.format(r['host'], red(r['error'])), 30, r['host'])
+            else:
+                gkf.tombstone('swept {} {}:{} {} {}'.format(r['host'], r['hostname'], 
+                    r['port'], elapsed_time(0, r['rtt']), 
+                    r['banner'] or (red(r['error']) if r['error'] else blue('no banner'))),
+                    host=r['host'])
+
+        gkf.tombstone('{} of {} hosts reachable, {} with a banner'.format(
+            sum(_['rtt'] is not None for _ in results), len(hostnames),
+            sum(_['banner'] is not None for _ in results)))
+        gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
+
+
+    def do_resolve(self, data:str="") -> None:
+        """
+        resolve [ host [host ..] | all | flush | on | off | ttl n ]
+
+            Host names are looked up once and remembered for `ttl` 
+            seconds (failures for less), so that a slow name server is 
+            not paid for on every connect.
+
+            Without a parameter, show the state of the cache. With host
+            names (or 'all' for every host in ~/.ssh/config), look them 
+            up now, as many at once as `setworkers probe`, so that a 
+            `probe` or `scan` that follows finds them ready. 'flush' 
+            forgets everything; 'off' looks up every name every time.
+        """
+        cache = dnscache.cache
+        data = data.strip().split()
+
+        if not data:
+            for k, v in cache.stats().items():
+                gkf.tombstone(blue('{:<14} {}'.format(k+':', v)))
+            return
+
+        if data[0].lower() in ('on', 'off'):
+            cache.enabled = data[0].lower() == 'on'
+            if not cache.enabled: cache.clear()
+
+        elif data[0].lower() == 'flush':
+            gkf.tombstone(blue('{} name[s] forgotten'.format(cache.clear())))
+
+        elif data[0].lower() == 'ttl':
+            try:
+                cache.ttl = float(data[1])
+            except (ValueError, IndexError) as e:
+                gkf.tombstone(red('bad value for ttl: {}'.format(" ".join(data[1:]))))
+
+        else:
+            if 'all' in data:
+                data = sorted(list(gkf.get_ssh_host_info('all')))
+                data.remove('*')
+
+            targets, unknown = sweep.targets(data)
+            for _ in unknown: gkf.tombstone('{} {}'.format(_, red('unknown host')))
+
+            start_time = time.time()
+            n = cache.prefetch([ _[1:] for _ in targets ], 
+                self.hop.sock_domain, self.hop.sock_type, self.probe_workers)
+            gkf.tombstone('{} of {} names resolved'.format(n, len(targets)))
+            gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
+
+
+    def do_runon(self, data:str="") -> None:
+        """
+        runon {plugin} {host [host ..] | all} [ -- args .. ]
+
+            Run a plugin once for each host, as many at once as there are 
+            plugin workers (see `setworkers plugin`). Each run is 
+            main(host, *args) in a worker process; one that takes longer 
+            than `settimeout plugin` is killed, and its worker replaced.
+            The results are shown as they come in.
+        """
+        data = data.strip().split()
+        args = []
+        if '--' in data:
+            args = data[data.index('--')+1:]
+            data = data[:data.index('--')]
+        if len(data) < 2:
+            self.do_help('runon')
+            return
+
+        name, hostnames = data[0], data[1:]
+        if name not in plugins:
+            gkf.tombstone(red("Plugin '{}' not found in {}".format(name, plugins.plugin_dir)))
+            self.last_status = 1
+            return
+
+        if 'all' in hostnames:
+            hostnames = sorted(list(gkf.get_ssh_host_info('all')))
+            hostnames.remove('*')
+
+        pool = get_plugin_pool()
+        failures = 0
+        start_time = time.time()
+        gkf.tombstone('running {} on {} hosts with {} workers'.format(name, len(hostnames), pool.size))
+        try:
+            for i, (exit_code, result) in pool.map(name, [ [_] + args for _ in hostnames ]):
+                failures += int(exit_code != 0)
+                gkf.tombstone('{} {} exit code {} returned {}'.format(name, hostnames[i],
+                    exit_code if not exit_code else red(exit_code), result),
+                    30 if exit_code else 20, hostnames[i])
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+
+        finally:
+            if failures: self.last_status = 1
+            gkf.tombstone('{} of {} hosts failed'.format(failures, len(hostnames)))
+            gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
+
+
     def do_save(self, data:str="") -> None:
         """
         save [ additional-file-name ]
@@ -981,29 +2050,61 @@ class Beachhead(cmd.Cmd):
         The configuration is written as a JSON file, indented 4 spaces per
             level, with the host names sorted alphabetically. The kex-es and
             ciphers are listed in the order the host perfers them. 
+
+        The change for the current host is appended to a journal next to
+            the config file, and the config file itself is rewritten every
+            so often (see `compact`).
         """
 
-        try:
-            with open(data, 'w') as f:
-                json.dump(self.cfg, f, sort_keys=True, indent=4)
+        if data:
+            try:
+                cfgjournal.write_atomically(data.strip(), self.cfg)
                 gkf.tombstone('Duplicate config file written to {}'.format(data))
-        except:
-            pass
+            except Exception as e:
+                gkf.tombstone(red(gkf.type_and_text(e)))
 
         old_sec_info = self.cfg.get(self.hop.remote_host, {})
         new_sec_info = self.hop.security
         if new_sec_info == {}:
             gkf.tombstone('No active connection / no data to update.')
             return
+        # What scan found the server offering is not ours to replace.
+        if 'offered' in old_sec_info:
+            new_sec_info = dict(new_sec_info, offered=old_sec_info['offered'])
 
         if old_sec_info == new_sec_info: 
             gkf.tombstone('Update not required for {}'.format(self.hop.remote_host))
             return
 
-        self.cfg[self.hop.remote_host] = new_sec_info
-        with open(self.cfg_file, 'w') as f:
-            json.dump(self.cfg, f, sort_keys=True, indent=4)
-            gkf.tombstone('Update successful. Written to {}'.format(self.cfg_file))
+        self._remember(self.hop.remote_host, new_sec_info)
+        gkf.tombstone('Update successful. Written to {}'.format(self.journal.journal_file))
+        if self.journal.due(): self.do_compact()
+
+
+    def do_compact(self, data:str="") -> None:
+        """
+        compact
+
+            Fold the journal of saved changes back into the config file. 
+            The new file replaces the old one in a single rename, so there
+            is never a half-written config on disk. This happens by itself
+            every 1000 saves.
+        """
+        if self.journal is None:
+            gkf.tombstone(blue('nothing to do'))
+            return
+
+        start_time = time.time()
+        try:
+            n = len(self.journal)
+            self.journal.compact(self.cfg)
+            # Our own change; no need to read it back.
+            self.cfg_mtime = os.stat(self.cfg_file).st_mtime_ns
+        except Exception as e:
+            gkf.tombstone(red(gkf.type_and_text(e)))
+        else:
+            gkf.tombstone('{} change[s] compacted into {}'.format(n, self.cfg_file))
+            gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, time.time())))
 
 
     def do_version(self, data:str="") -> None:
@@ -1015,6 +2116,60 @@ class Beachhead(cmd.Cmd):
         self._do_version()
 
 
+    def do_watch(self, data:str="") -> None:
+        """
+        watch [ host ] [ seconds ]
+
+            The round trips of the keepalives (see `setkeepalive`) for
+            each host we have a session with: the last, the p50 and the
+            p99 of the last 300, how many were sent and answered, and
+            whether the host is stalled -- not answering -- now, and
+            how often it has been.
+
+            At the console, the table is redrawn every second until
+            Ctrl-C, or for `seconds`. In batch mode it is written once,
+            or every second for `seconds`.
+        """
+        host, seconds = None, None
+        for word in data.strip().split():
+            try:
+                seconds = float(word)
+            except ValueError as e:
+                host = word
+
+        live = terminal_mode and not self.batch_mode
+        stop_time = None if seconds is None else time.time() + seconds
+        try:
+            while True:
+                if live: sys.stdout.write('\033[H\033[2J'); sys.stdout.flush()
+                self._watch_table(host)
+                tomblog.flush()
+                if not live and seconds is None: break
+                if stop_time is not None and time.time() >= stop_time: break
+                time.sleep(1.0)
+        except KeyboardInterrupt as e:
+            pass
+
+
+    def _watch_table(self, host:str=None) -> None:
+        rows = keepalive.monitor.report(host)
+        if not rows:
+            gkf.tombstone(blue('no sessions{} to watch.'.format(' with '+host if host else '')))
+            return
+
+        ms = lambda _: '{:>9}'.format('-' if _ is None else '{:.1f}'.format(_ * 1000))
+        gkf.tombstone(blue('{:<32} {:>4} {:>9} {:>9} {:>9} {:>6} {:>6} {:>6}  {}'.format(
+            'host', 'sess', 'last ms', 'p50 ms', 'p99 ms', 'sent', 'ans', 'stalls', 'state')))
+        for row in rows:
+            if row['stalled'] is not None: state = red('stalled {:.1f} s'.format(row['stalled']))
+            elif not row['sessions']: state = 'closed'
+            elif not row['samples']: state = 'waiting'
+            else: state = 'ok'
+            gkf.tombstone('{:<32} {:>4} {} {} {} {:>6} {:>6} {:>6}  {}'.format(
+                row['host'], row['sessions'], ms(row['last']), ms(row['p50']), ms(row['p99']),
+                row['sent'], row['replies'], row['stalls'], state))
+
+
     """ ***********************************************************************************
     The following functions cannot be called directly, but rather through "open"
     *********************************************************************************** """
@@ -1036,7 +2191,7 @@ class Beachhead(cmd.Cmd):
         gkf.tombstone(blue('attempting to create a channel of type {}'.format(data)))
 
         start_time = time.time()
-        OK = self.hop.transport.open_channel(data)
+        OK = self.hop.open_channel(data)
         stop_time = time.time()
 
         if OK: gkf.tombstone(blue('success'))
@@ -1045,17 +2200,123 @@ class Beachhead(cmd.Cmd):
         gkf.tombstone(blue('elapsed time: {}'.format(elapsed_time(start_time, stop_time))))
 
 
+    def _load_config(self) -> None:
+        """
+        (Re)load self.cfg_file, and apply the journal to it.
+        """
+        try:
+            self.cfg_mtime = os.stat(self.cfg_file).st_mtime_ns
+            # Hosts are decoded when they are first looked at; see
+            # jparse.LazyJSONObject and cfgsnapshot.
+            start_time = time.perf_counter()
+            self.cfg, self.cfg_how = cfgsnapshot.load(self.cfg_file)
+            self.cfg_load_time = time.perf_counter() - start_time
+            gkf.tombstone('Using config info read from {} ({}, found by {})'.format(
+                self.cfg_file, self.cfg_how, self.cfg_found_by))
+            if self.journal is None: self.journal = cfgjournal.ConfigJournal(self.cfg_file)
+            n = self.journal.replay(self.cfg)
+            if n: gkf.tombstone('Replayed {} change[s] from {}'.format(n, self.journal.journal_file))
+
+        except Exception as e:
+            gkf.tombstone(str(e))
+            gkf.tombstone('{} failed to compile.'.format(self.cfg_file))
+
+
+    def _check_config(self) -> None:
+        """
+        Reload the config if the file has changed since we read it. This
+        costs one stat() a second at most.
+        """
+        if self.cfg_file is None or self.cfg_mtime is None: return
+        now = time.monotonic()
+        if now < self.cfg_next_check: return
+        self.cfg_next_check = now + self.cfg_poll
+
+        try:
+            mtime = os.stat(self.cfg_file).st_mtime_ns
+        except OSError as e:
+            return
+        if mtime != self.cfg_mtime:
+            gkf.tombstone(blue('{} has changed; reloading.'.format(self.cfg_file)))
+            self._load_config()
+
+
+    def _remember(self, host:str, info:dict) -> None:
+        """
+        Put a host's security info in the config, and in the journal so 
+        that it is there next time.
+        """
+        if self.journal is None:
+            self.cfg_file = self.cfg_file or os.path.abspath(__default_config__)
+            self.journal = cfgjournal.ConfigJournal(self.cfg_file)
+
+        self.cfg[host] = info
+        self.journal.append(host, info)
+
+
+    def _transfer(self, direction:str, pairs:list) -> None:
+        """
+        Move the files for put and get, and say how it went. 
+        """
+        gkf.tombstone(blue('{} {} file[s] with {} workers'.format(
+            direction, len(pairs), min(self.transfer_workers, len(pairs)))))
+
+        total_bytes = 0
+        successes = 0
+        start_time = time.perf_counter()
+        try:
+            for r in transfer.transfer(self.hop.transport, pairs, direction,
+                    self.transfer_workers, self.hop.sftp):
+                if r['error']:
+                    gkf.tombstone(red('failure {} {}'.format(r['source'], r['error'])))
+                    continue
+                successes += 1
+                total_bytes += r['bytes']
+                gkf.tombstone('success {} {} bytes {:.3f} MB/s'.format(
+                    r['source'], r['bytes'], transfer.throughput(r['bytes'], r['seconds'])))
+
+        except KeyboardInterrupt as e:
+            gkf.tombstone(blue('aborting. Control-C pressed.'))
+
+        except Exception as e:
+            gkf.tombstone(red(gkf.type_and_text(e)))
+
+        stop_time = time.perf_counter()
+        seconds = stop_time - start_time
+        gkf.tombstone('{} of {} file[s], {} bytes, {:.3f} MB/s, {:.1f} files/s'.format(
+            successes, len(pairs), total_bytes, 
+            transfer.throughput(total_bytes, seconds),
+            successes / seconds if seconds > 0 else 0.0))
+        gkf.tombstone('elapsed time: {}'.format(elapsed_time(start_time, stop_time)))
+
+
     def _do_version(self) -> None:
         gkf.tombstone("This is the only version you will ever need.")
         gkf.tombstone("What difference does it make?")
         pass
 
 
+    def _do_startup(self) -> None:
+        """
+            Prints the time spent in each phase of startup.
+        """
+        for name, seconds in startup_profile:
+            gkf.tombstone('startup: {:<32} {}'.format(name, elapsed_time(0, seconds)))
+        gkf.tombstone('startup: {:<32} {}'.format('total', 
+            elapsed_time(0, sum(_[1] for _ in startup_profile))))
+
+
     def _do_config(self) -> None:
         """
-            Prints the currect config.
+            Prints the currect config, and says where it came from: the
+            compiled snapshot, the JSON (with the snapshot rebuilt), or
+            the JSON alone.
         """
-        pp.pprint(self.cfg)
+        pp.pprint(dict(self.cfg))
+        gkf.tombstone(blue('config file:   {}'.format(self.cfg_file)))
+        gkf.tombstone(blue('found by:      {}'.format(self.cfg_found_by)))
+        gkf.tombstone(blue('loaded from:   {}'.format(self.cfg_how)))
+        gkf.tombstone(blue('load time:     {}'.format(elapsed_time(0, self.cfg_load_time))))
 
 
     def _do_session(self, data:list=[]) -> None:
@@ -1066,10 +2327,6 @@ class Beachhead(cmd.Cmd):
             the socket, transport, and channel that we [may] have already
             openend.
         """
-        self.hop.client = SSHClient()
-        self.hop.client.load_system_host_keys()
-        self.hop.client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-    
         start_time = time.time()
         OK = self.hop.open_session()
         stop_time = time.time()
@@ -1142,15 +2399,74 @@ class Beachhead(cmd.Cmd):
 
 if __name__ == "__main__":
 
-    subprocess.call('clear',shell=True)
-    try:
-        do_log = sys.argv[1].lower() == 'log'
-    except:
-        do_log = False
+    # serve-stub has options of its own; see stubserver.py.
+    if sys.argv[1:2] == ['serve-stub']:
+        import stubserver
+        sys.exit(stubserver.main(sys.argv[2:]))
+
+    # So has probe-daemon; see probedaemon.py. The probes are probe's.
+    if sys.argv[1:2] == ['probe-daemon']:
+        import probedaemon
+        template = SmallHOP()
+        sys.exit(probedaemon.main(sys.argv[2:], lambda host: probe_one(template, host),
+            probestore.ProbeStore(probes_file())))
+
+    parser = argparse.ArgumentParser(prog='beachhead', 
+        description='Interactive operation of the paramiko stack.')
+    parser.add_argument('mode', nargs='?', default='', 
+        help="'log' to turn on logging, 'serve-stub' to run stand-in "
+            "SSH hosts on localhost, or 'probe-daemon' to probe hosts on "
+            "cron schedules (either with --help for more).")
+    parser.add_argument('--config', type=str, default=None, metavar='FILE',
+        help='the beachhead.json to use, rather than searching for one.')
+    parser.add_argument('--startup-profile', action='store_true',
+        help='report the time spent in each phase of startup.')
+    parser.add_argument('--batch', type=str, default=None, metavar='FILE',
+        help="run the commands in FILE ('-' for stdin), then exit. This is "
+            "the default when stdin is not a terminal.")
+    parser.add_argument('--output', type=str, default=None, metavar='FILE',
+        help='in batch mode, append the output to FILE rather than stdout.')
+    parser.add_argument('--stop-on-error', action='store_true',
+        help='in batch mode, stop at the first command that fails.')
+    parser.add_argument('--messages', choices=tomblog.formats + ('direct',), default='text',
+        help="how to write our own messages: queued as 'text' or 'json' lines "
+            "and written in batches (the default is text), or 'direct'.")
+    parser.add_argument('--message-level', choices=sorted(tomblog.levels, key=tomblog.levels.get),
+        default='info', help='do not show messages below this level.')
+    args = parser.parse_args()
+    do_log = args.mode.lower() == 'log'
+
+    if args.batch is None and not terminal_mode: args.batch = '-'
+    if args.messages != 'direct': tomblog.install(args.messages)
+    gkf.tombstone_level = tomblog.levels[args.message_level]
+    if terminal_mode and args.batch is None: sys.stdout.write('\033[H\033[2J')
+    startup_phase('arguments')
+
+    if args.batch is not None and args.output:
+        # 64K of buffer, flushed after each command.
+        sys.stdout = sys.stderr = open(args.output, 'a', buffering=65536)
+
+    # The plugin forker, and through it the workers, are forked now,
+    # while we have only one thread; see pluginpool.py.
+    get_plugin_pool().start()
+    startup_phase('plugin workers')
+
+    if args.batch is not None:
+        try:
+            commands = sys.stdin if args.batch == '-' else open(args.batch)
+        except Exception as e:
+            gkf.tombstone(gkf.type_and_text(e))
+            sys.exit(os.EX_NOINPUT)
+        status = Beachhead(True, args.startup_profile, args.config).run_batch(
+            commands, args.stop_on_error)
+        if args.output:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        sys.exit(status)
 
     while True:
         try:
-            Beachhead(True).cmdloop()
+            Beachhead(True, args.startup_profile, args.config).cmdloop()
 
         except KeyboardInterrupt:
             gkf.tombstone("Exiting via control-C.")
@@ -1159,4 +2475,4 @@ if __name__ == "__main__":
         except Exception as e:
             gkf.tombstone(gkf.type_and_text(e))
             gkf.tombstone(gkf.formatted_stack_trace())
-            sys.exit(1) 
+            sys.exit(1)
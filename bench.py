@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the paths that beachhead spends its time on, run against
+a one-host stubserver.StubFleet in this same process, on localhost, so
+that two runs on the same machine can be compared.
+
+    python bench.py [ run ] [--quick] [--only name,..] [--output FILE]
+    python bench.py compare OLD.json NEW.json [--threshold 0.10]
+
+run writes the results as JSON (to bench-YYYYmmdd-HHMMSS.json unless
+told otherwise). Each metric is a value, its unit, and whether higher
+or lower is better. compare lines up the metrics of two runs, and exits
+with 1 if any is worse in NEW by more than the threshold.
+
+The benchmarks:
+
+    connect     TCP connects per second through SmallHOP.open_socket()
+    session     full sessions (connect, banner, kex, auth) per second, and
+                the latency of open_socket(), open_session(), and
+                open_sftp()
+    sftp_files  small files per second, put and get, with 1 and 4
+                workers, as `put` and `get` move them
+    sftp_bulk   MB/s for one large file, put and get
+    ssh_config  parsing and indexing an ssh config of N hosts, and
+                looking up every host in it
+    config      loading a beachhead.json of N hosts: json, the lazy
+                index, and the snapshot, cold and warm
+
+Everything runs in a scratch directory that is also $HOME for the run,
+so that neither ~/.ssh nor the current directory is touched.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+import stubserver
+paramiko = gkf.lazy_import('paramiko')
+
+# What each run of the suite is made of: (connections, small files,
+# bulk MB, fleet sizes).
+sizes = {
+    'full':  {'connects': 500, 'sessions': 100, 'files': 200, 'bulk_mb': 64,
+              'fleet': (1000, 10000, 30000)},
+    'quick': {'connects': 100, 'sessions': 20, 'files': 50, 'bulk_mb': 8,
+              'fleet': (1000,)}
+    }
+
+########################################################
+# Measuring.
+########################################################
+
+def metric(value:float, unit:str, better:str='lower') -> dict:
+    return {'value': round(value, 6), 'unit': unit, 'better': better}
+
+
+def latency(name:str, samples:List[float]) -> dict:
+    """ returns -- p50 and p99, in ms, of samples in seconds. """
+    if len(samples) < 2: samples = samples * 2
+    q = statistics.quantiles(samples, n=100, method='inclusive')
+    return {
+        name + '_p50': metric(q[49] * 1000, 'ms'),
+        name + '_p99': metric(q[98] * 1000, 'ms')
+        }
+
+
+def best_of(fn:Callable, repeat:int=3) -> float:
+    """ returns -- the shortest of repeat timings of fn(). """
+    times = []
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def git_version() -> str:
+    """ The commit of the tree we are running from, wherever we are. """
+    try:
+        return subprocess.run(['git', '-C', os.path.dirname(os.path.abspath(__file__)),
+            'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or 'unknown'
+    except OSError as e:
+        return 'unknown'
+
+
+def new_hop() -> object:
+    hop = beachhead.SmallHOP()
+    hop.pool = None
+    hop.password = 'bench'
+    hop.tcp_timeout = hop.auth_timeout = hop.banner_timeout = 10.0
+    return hop
+
+
+########################################################
+# The benchmarks. Each takes the sizes and the scratch directory, and
+# returns { metric: metric(..) }.
+########################################################
+
+def bench_connect(n:dict, scratch:str) -> dict:
+    hop = new_hop()
+    samples = []
+    for i in range(n['connects']):
+        start_time = time.perf_counter()
+        if not hop.open_socket('bench'): raise RuntimeError(hop.error_msg())
+        samples.append(time.perf_counter() - start_time)
+        hop.close()
+    return dict(connects_per_s=metric(len(samples) / sum(samples), '1/s', 'higher'),
+        **latency('connect', samples))
+
+
+def bench_session(n:dict, scratch:str) -> dict:
+    sockets, sessions, sftps, totals = [], [], [], []
+    for i in range(n['sessions']):
+        hop = new_hop()
+        t0 = time.perf_counter()
+        ok = hop.open_socket('bench')
+        t1 = time.perf_counter()
+        ok = ok and hop.open_session()
+        t2 = time.perf_counter()
+        ok = ok and hop.open_sftp()
+        t3 = time.perf_counter()
+        hop.close()
+        if not ok: raise RuntimeError(hop.error_msg())
+        sockets.append(t1 - t0)
+        sessions.append(t2 - t1)
+        sftps.append(t3 - t2)
+        totals.append(t3 - t0)
+
+    return dict(sessions_per_s=metric(len(totals) / sum(totals), '1/s', 'higher'),
+        **latency('open_socket', sockets),
+        **latency('open_session', sessions),
+        **latency('open_sftp', sftps))
+
+
+def _transfer(hop:object, pairs:list, direction:str, workers:int) -> float:
+    start_time = time.perf_counter()
+    for r in transfer.transfer(hop.transport, pairs, direction, workers, hop.sftp):
+        if r['error']: raise RuntimeError(r['error'])
+    return time.perf_counter() - start_time
+
+
+def bench_sftp_files(n:dict, scratch:str) -> dict:
+    local = os.path.join(scratch, 'files')
+    remote = os.path.join(scratch, 'remote')
+    back = os.path.join(scratch, 'back')
+    for _ in (local, remote, back): os.makedirs(_, exist_ok=True)
+    names = [ 'f{:05}'.format(i) for i in range(n['files']) ]
+    for name in names:
+        with open(os.path.join(local, name), 'wb') as f: f.write(os.urandom(1024))
+
+    hop = new_hop()
+    if not (hop.open_socket('bench') and hop.open_session() and hop.open_sftp()):
+        raise RuntimeError(hop.error_msg())
+
+    results = {}
+    try:
+        for workers in (1, 4):
+            seconds = _transfer(hop, [ (os.path.join(local, _), '/remote/' + _) for _ in names ],
+                'put', workers)
+            results['put_files_per_s_w{}'.format(workers)] = metric(len(names) / seconds, '1/s', 'higher')
+            seconds = _transfer(hop, [ ('/remote/' + _, os.path.join(back, _)) for _ in names ],
+                'get', workers)
+            results['get_files_per_s_w{}'.format(workers)] = metric(len(names) / seconds, '1/s', 'higher')
+    finally:
+        hop.close()
+    return results
+
+
+def bench_sftp_bulk(n:dict, scratch:str) -> dict:
+    source = os.path.join(scratch, 'bulk')
+    os.makedirs(os.path.join(scratch, 'remote'), exist_ok=True)
+    chunk = os.urandom(1 << 20)
+    with open(source, 'wb') as f:
+        for i in range(n['bulk_mb']): f.write(chunk)
+    nbytes = n['bulk_mb'] << 20
+
+    hop = new_hop()
+    if not (hop.open_socket('bench') and hop.open_session() and hop.open_sftp()):
+        raise RuntimeError(hop.error_msg())
+    try:
+        put = _transfer(hop, [(source, '/remote/bulk')], 'put', 1)
+        get = _transfer(hop, [('/remote/bulk', source + '.back')], 'get', 1)
+    finally:
+        hop.close()
+
+    return {
+        'put_mb_per_s': metric(transfer.throughput(nbytes, put), 'MB/s', 'higher'),
+        'get_mb_per_s': metric(transfer.throughput(nbytes, get), 'MB/s', 'higher')
+        }
+
+
+def bench_ssh_config(n:dict, scratch:str) -> dict:
+    results = {}
+    for size in n['fleet']:
+        f = os.path.join(scratch, 'ssh_config.{}'.format(size))
+        with open(f, 'w') as out:
+            for i in range(size):
+                out.write('Host h{0}\n    HostName 10.{1}.{2}.{3}\n    User u{0}\n    Port 22\n\n'.format(
+                    i, i >> 16 & 255, i >> 8 & 255, i & 255))
+            out.write('Host *\n    ServerAliveInterval 30\n')
+        hosts = [ 'h{}'.format(i) for i in range(size) ]
+
+        def parse() -> None:
+            gkf._ssh_config_cache.pop(f, None)
+            gkf._ssh_config_index(f)
+        results['parse_ms_{}'.format(size)] = metric(best_of(parse) * 1000, 'ms')
+
+        gkf._ssh_config_cache.pop(f, None)
+        seconds = best_of(lambda: gkf.get_ssh_hosts_info(hosts, f), 1)
+        results['lookup_us_{}'.format(size)] = metric(seconds / size * 1e6, 'us')
+    return results
+
+
+def bench_config(n:dict, scratch:str) -> dict:
+    results = {}
+    info = {'kex': ['curve25519-sha256', 'ecdh-sha2-nistp256', 'diffie-hellman-group14-sha256'],
+        'ciphers': ['aes128-ctr', 'aes256-ctr', 'aes128-gcm@openssh.com'],
+        'digests': ['hmac-sha2-256', 'hmac-sha2-512'],
+        'compression': ['none'], 'key_types': ['ssh-ed25519', 'rsa-sha2-512'],
+        'host_key': 'A' * 68, 'version': 'SSH-2.0-OpenSSH_9.6'}
+
+    for size in n['fleet']:
+        f = os.path.join(scratch, 'beachhead.{}.json'.format(size))
+        with open(f, 'w') as out:
+            json.dump({ 'h{}.example.edu'.format(i): info for i in range(size) }, out,
+                sort_keys=True, indent=4)
+
+        def first(cfg:Mapping) -> None:
+            cfg['h{}.example.edu'.format(size // 2)]['kex']
+
+        def json_load() -> None:
+            with open(f) as x: first(json.load(x))
+        results['json_ms_{}'.format(size)] = metric(best_of(json_load) * 1000, 'ms')
+
+        results['lazy_ms_{}'.format(size)] = metric(
+            best_of(lambda: first(jparse.JSONReader().index(f))) * 1000, 'ms')
+
+        def cold() -> None:
+            try:
+                os.unlink(cfgsnapshot.snapshot_name(f))
+            except FileNotFoundError as e:
+                pass
+            first(cfgsnapshot.load(f)[0])
+        results['snapshot_cold_ms_{}'.format(size)] = metric(best_of(cold) * 1000, 'ms')
+        results['snapshot_warm_ms_{}'.format(size)] = metric(
+            best_of(lambda: first(cfgsnapshot.load(f)[0])) * 1000, 'ms')
+    return results
+
+
+benchmarks = {
+    'connect': bench_connect,
+    'session': bench_session,
+    'sftp_files': bench_sftp_files,
+    'sftp_bulk': bench_sftp_bulk,
+    'ssh_config': bench_ssh_config,
+    'config': bench_config
+    }
+
+########################################################
+# run and compare
+########################################################
+
+def run(names:List[str], quick:bool=False) -> dict:
+    """
+    returns -- { 'meta': {..}, 'results': { benchmark: { metric: .. } } }
+    """
+    n = sizes['quick' if quick else 'full']
+    scratch = os.environ['HOME']
+    ssh_dir = os.path.join(scratch, '.ssh')
+    os.makedirs(ssh_dir, mode=0o700, exist_ok=True)
+
+    fleet = stubserver.StubFleet([stubserver.Endpoint('bench',
+        host_keys=[paramiko.ECDSAKey.generate()], sftp_root=scratch)])
+    fleet.start()
+    with open(os.path.join(ssh_dir, 'config'), 'w') as f:
+        f.write(fleet.ssh_config('bench'))
+
+    report = {'meta': {
+        'time': gkf.now_as_string(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'paramiko': paramiko.__version__,
+        'version': git_version(),
+        'quick': quick,
+        'sizes': n
+        }, 'results': {} }
+
+    try:
+        for name in names:
+            start_time = time.perf_counter()
+            try:
+                report['results'][name] = benchmarks[name](n, scratch)
+                gkf.tombstone('{:<12} {:.2f} s'.format(name, time.perf_counter() - start_time))
+            except Exception as e:
+                gkf.tombstone('{:<12} failed: {}'.format(name, gkf.type_and_text(e)))
+    finally:
+        fleet.stop()
+    return report
+
+
+def compare(old:dict, new:dict, threshold:float=0.10) -> int:
+    """
+    Show each metric the two runs have in common, and flag those that
+    got worse by more than threshold (a fraction).
+
+    returns -- the number of regressions.
+    """
+    regressions = 0
+    for name in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][name], new['results'][name]
+        for key in sorted(set(a) & set(b)):
+            before, after = a[key]['value'], b[key]['value']
+            if before == 0: continue
+            change = (after - before) / before
+            worse = -change if a[key]['better'] == 'higher' else change
+            flag = ''
+            if worse > threshold:
+                flag = gkf.RED + 'REGRESSION' + gkf.REVERT
+                regressions += 1
+            elif worse < -threshold:
+                flag = gkf.BLUE + 'better' + gkf.REVERT
+            print('{:<12} {:<26} {:>12.3f} {:>12.3f} {:<5} {:>+7.1%} {}'.format(
+                name, key, before, after, a[key]['unit'], change, flag))
+
+    for name in sorted(set(old['results']) ^ set(new['results'])):
+        print('{:<12} only in {}'.format(name, 'old' if name in old['results'] else 'new'))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench',
+        description='Benchmarks for beachhead, against a paramiko server on localhost.')
+    parser.add_argument('command', nargs='?', default='run', choices=('run', 'compare'))
+    parser.add_argument('files', nargs='*', help='for compare, the old and new results.')
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller rounds.')
+    parser.add_argument('--only', type=str, default=None,
+        help='comma separated benchmarks to run, from: ' + ', '.join(benchmarks))
+    parser.add_argument('--output', type=str, default=None, help='where to write the results.')
+    parser.add_argument('--threshold', type=float, default=0.10,
+        help='for compare, the worsening (as a fraction) that counts as a regression.')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        if len(args.files) != 2: parser.error('compare needs two files.')
+        with open(args.files[0]) as a, open(args.files[1]) as b:
+            sys.exit(1 if compare(json.load(a), json.load(b), args.threshold) else 0)
+
+    names = list(benchmarks) if args.only is None else args.only.split(',')
+    unknown = [ _ for _ in names if _ not in benchmarks ]
+    if unknown: parser.error('no such benchmark: ' + ', '.join(unknown))
+    output = os.path.abspath(args.output or time.strftime('bench-%Y%m%d-%H%M%S.json'))
+
+    # Our own $HOME, before beachhead (and knownhosts) look at it, and
+    # no agent, so that auth costs the same every time.
+    scratch = tempfile.mkdtemp(prefix='beachhead-bench-')
+    os.environ['HOME'] = scratch
+    os.environ.pop('SSH_AUTH_SOCK', None)
+    try:
+        import beachhead
+        import cfgsnapshot
+        import jparse
+        import transfer
+        report = run(names, args.quick)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    gkf.tombstone('results written to {}'.format(output))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+An append-only journal of changes to beachhead.json.
+
+Saving one host's security info used to mean rewriting the whole file,
+which costs time in proportion to the fleet and leaves a truncated file
+behind if we die halfway. Instead, each change is appended to a journal
+next to the config file (beachhead.json.journal), one JSON object per
+line, and fsync-ed. On load, the journal is replayed over the config.
+
+Now and then (every compact_every changes, or when asked) the journal
+is folded back into the config file. The new config is written to a
+temporary file in the same directory and renamed over the old one, so
+at every moment there is a complete config file on disk. The journal
+is removed only after the rename; if we die in between, replaying it
+again does no harm.
+"""
+
+import json
+import os
+import tempfile
+import typing
+from   typing import *
+
+import gkflib as gkf
+
+class ConfigJournal:
+    """ Hack to support forward reference. """
+    pass
+
+
+class ConfigJournal:
+
+    def __init__(self, cfg_file:str, compact_every:int=1000):
+        self.cfg_file = cfg_file
+        self.journal_file = cfg_file + '.journal'
+        self.compact_every = compact_every
+        self.entries = 0
+
+
+    def __len__(self) -> int:
+        """ returns -- the number of changes not yet compacted. """
+        return self.entries
+
+
+    def append(self, host:str, info:dict) -> None:
+        """
+        Record that host's security info is now info.
+        """
+        line = json.dumps({'host':host, 'security':info}, sort_keys=True) + "\n"
+        with open(self.journal_file, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries += 1
+
+
+    def replay(self, cfg:dict) -> int:
+        """
+        Apply the journal to cfg, in place. A last line that was only
+        partly written is ignored.
+
+        returns -- the number of changes applied.
+        """
+        self.entries = 0
+        try:
+            f = open(self.journal_file)
+        except FileNotFoundError as e:
+            return 0
+
+        with f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    change = json.loads(line)
+                    cfg[change['host']] = change['security']
+                except (ValueError, KeyError, TypeError) as e:
+                    gkf.tombstone('{} line {} ignored: {}'.format(
+                        self.journal_file, lineno, gkf.type_and_text(e)))
+                    continue
+                self.entries += 1
+
+        return self.entries
+
+
+    def due(self) -> bool:
+        return self.compact_every > 0 and self.entries >= self.compact_every
+
+
+    def compact(self, cfg:dict) -> None:
+        """
+        Write cfg to the config file (atomically) and start a new journal.
+        """
+        write_atomically(self.cfg_file, cfg)
+        try:
+            os.unlink(self.journal_file)
+        except FileNotFoundError as e:
+            pass
+        self.entries = 0
+
+
+def write_atomically(filename:str, cfg:dict) -> None:
+    """
+    Write cfg as JSON, the way beachhead.json has always looked (sorted,
+    indented 4), so that the file is either the old one or the new one,
+    never something in between.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.beachhead.', suffix='.tmp')
+    try:
+        # mkstemp() makes the file 0600; keep whatever the old one had.
+        try:
+            os.chmod(temp_name, os.stat(filename).st_mode & 0o7777)
+        except FileNotFoundError as e:
+            pass
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(cfg), f, sort_keys=True, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+
+    except:
+        try:
+            os.unlink(temp_name)
+        except OSError as e:
+            pass
+        raise
+
+    # Make the rename itself durable.
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError as e:
+        pass
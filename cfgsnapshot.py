@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+A compiled copy of beachhead.json, kept next to it as beachhead.json.snap.
+
+Even read lazily (see jparse.JSONReader.index), the JSON has to be
+scanned from end to end before the first host can be looked up. The
+snapshot holds the same data in a form that needs no scanning: a
+header, the index of hosts, and each host's record in marshal format.
+Loading it is a memory map and one marshal.loads() of the index; each
+host is unmarshaled when it is first looked at.
+
+The header records the size, mtime, and hash of the JSON the snapshot
+was made from, and the version of marshal that made it. If the JSON has
+a new size, or a new mtime and new contents, the snapshot is remade the
+next time it is loaded. If only the mtime has changed (the file was
+touched, or copied), the header is brought up to date and the snapshot
+is used.
+
+Layout, all integers big-endian:
+
+    magic       8 bytes     b'BHSNAP1\\0'
+    marshal     4 bytes     marshal.version
+    size        8 bytes     of the JSON
+    mtime       8 bytes     of the JSON, in ns
+    digest      16 bytes    blake2b of the JSON
+    index       8 + 8 bytes where the index is, and how long
+    records     marshal     one after another
+    index       marshal     { host: (start, end, False), .. }, with
+                            the offsets from the start of the file.
+"""
+
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import typing
+from   typing import *
+
+import gkflib as gkf
+import jparse
+
+magic = b'BHSNAP1\0'
+header = struct.Struct('!8sIQq16sQQ')
+
+def snapshot_name(cfg_file:str) -> str:
+    return cfg_file + '.snap'
+
+
+def digest(f:str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    with open(f, 'rb') as x:
+        for chunk in iter(lambda: x.read(1<<20), b''): h.update(chunk)
+    return h.digest()
+
+
+def load(cfg_file:str) -> Tuple[Mapping, str]:
+    """
+    returns -- the config, and how we came by it: 'snapshot' if the
+        snapshot was good, 'rebuilt' if it had to be made again from
+        the JSON, or 'json' if it could not be made (and we used the
+        JSON as it is).
+    """
+    info = os.stat(cfg_file)
+    snap = snapshot_name(cfg_file)
+
+    try:
+        cfg = read(snap, info, cfg_file)
+        if cfg is not None: return cfg, 'snapshot'
+    except (OSError, ValueError, EOFError, TypeError, struct.error) as e:
+        pass
+
+    cfg = jparse.JSONReader().index(cfg_file)
+    if not isinstance(cfg, jparse.LazyJSONObject): return cfg, 'json'
+
+    try:
+        write(snap, cfg, info, digest(cfg_file))
+    except (OSError, ValueError) as e:
+        # Not writable, or not marshalable. The JSON will do.
+        gkf.tombstone('Cannot write {}: {}'.format(snap, gkf.type_and_text(e)))
+        return cfg, 'json'
+
+    return read(snap, os.stat(cfg_file), cfg_file) or cfg, 'rebuilt'
+
+
+def read(snap:str, info:os.stat_result, cfg_file:str) -> Mapping:
+    """
+    returns -- the snapshot as a LazyJSONObject, or None if there is
+        not one that matches the JSON.
+    """
+    with open(snap, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        fields = list(header.unpack_from(m))
+        this_magic, version, size, mtime, this_digest, start, length = fields
+        if this_magic != magic or version != marshal.version or size != info.st_size:
+            m.close()
+            return None
+
+        if mtime != info.st_mtime_ns:
+            # Same size, different time. Was it changed, or only touched?
+            if digest(cfg_file) != this_digest: 
+                m.close()
+                return None
+            fields[3] = info.st_mtime_ns
+            with open(snap, 'r+b') as f:
+                f.write(header.pack(*fields))
+
+        index = marshal.loads(m[start:start+length])
+
+    except:
+        m.close()
+        raise
+
+    return jparse.LazyJSONObject(m, index, snap, decode=marshal.loads)
+
+
+def write(snap:str, cfg:Mapping, info:os.stat_result, this_digest:bytes) -> None:
+    """
+    Write the snapshot to a temporary file, and rename it into place.
+    """
+    temp_name = '{}.{}.tmp'.format(snap, os.getpid())
+    try:
+        with open(temp_name, 'wb') as f:
+            f.write(bytes(header.size))
+            index = {}
+            offset = header.size
+            for host in cfg:
+                record = marshal.dumps(cfg[host])
+                f.write(record)
+                index[host] = (offset, offset + len(record), False)
+                offset += len(record)
+
+            index = marshal.dumps(index)
+            f.write(index)
+            f.seek(0)
+            f.write(header.pack(magic, marshal.version, info.st_size, 
+                info.st_mtime_ns, this_digest, offset, len(index)))
+        os.replace(temp_name, snap)
+
+    except:
+        try:
+            os.unlink(temp_name)
+        except OSError as e:
+            pass
+        raise
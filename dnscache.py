@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+From a host name to a connected socket, quickly.
+
+Two things made SmallHOP.open_socket() slow or blind:
+
+1. The name was resolved inside connect() on every attempt, so a slow
+   resolver cost its full delay on every probe of every host. DNSCache
+   keeps the answers (and the failures, for less time) for a TTL, and
+   can resolve a whole list of hosts in parallel ahead of time.
+
+2. Only IPv4 was tried. connect() here is "happy eyeballs" (RFC 8305):
+   the addresses are interleaved by family, the first connect starts at
+   once, and if it has not finished after a short delay the next one
+   starts alongside it. The first to connect wins and the others are
+   closed. A host that is only on IPv6 works, and a host whose IPv6
+   route is broken costs the delay rather than the timeout.
+"""
+
+import concurrent.futures
+import errno
+import os
+import selectors
+import socket
+import threading
+import time
+import typing
+from   typing import *
+
+import hopstats
+
+class DNSCache:
+    """ Hack to support forward reference. """
+    pass
+
+
+class DNSCache:
+    """
+    getaddrinfo() results by (host, port, family, type). Safe to use
+    from several threads. The TTL is ours, not the one in the DNS
+    record, because getaddrinfo() does not tell us that.
+    """
+
+    def __init__(self, ttl:float=300.0, negative_ttl:float=30.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.enabled = True
+
+        # key -> (expires, [ addrinfo, .. ] or the exception)
+        self.answers = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.answers)
+
+
+    def resolve(self, host:str, port:int,
+            family:int=socket.AF_UNSPEC,
+            sock_type:int=socket.SOCK_STREAM) -> List[tuple]:
+        """
+        returns -- what getaddrinfo() returns for the host. A failure
+            to resolve raises socket.gaierror, cached or not.
+
+        The time it took is recorded as the 'resolve' phase of the host.
+        """
+        key = host, int(port), family, sock_type
+        start_time = time.perf_counter()
+        now = time.monotonic()
+
+        with self.lock:
+            expires, answer = self.answers.get(key, (0, None))
+            if self.enabled and expires > now:
+                self.hits += 1
+            else:
+                answer = None
+                self.misses += 1
+
+        if answer is None:
+            try:
+                answer = socket.getaddrinfo(host, port, family, sock_type)
+                ttl = self.ttl
+            except socket.gaierror as e:
+                answer = e
+                ttl = self.negative_ttl
+            if self.enabled:
+                with self.lock: self.answers[key] = (now + ttl, answer)
+
+        hopstats.stats.record(host, 'resolve', time.perf_counter() - start_time)
+        if isinstance(answer, Exception): raise answer
+        return answer
+
+
+    def prefetch(self, hosts:Iterable[Tuple[str, int]],
+            family:int=socket.AF_UNSPEC,
+            sock_type:int=socket.SOCK_STREAM,
+            workers:int=16) -> int:
+        """
+        Resolve (host, port) pairs in parallel so that later connects
+        find them in the cache.
+
+        returns -- the number that resolved.
+        """
+        def one(pair:tuple) -> bool:
+            try:
+                self.resolve(pair[0], pair[1], family, sock_type)
+                return True
+            except (socket.gaierror, UnicodeError) as e:
+                return False
+
+        hosts = list(hosts)
+        if not hosts: return 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(workers, len(hosts)))) as pool:
+            return sum(pool.map(one, hosts))
+
+
+    def clear(self) -> int:
+        with self.lock:
+            n = len(self.answers)
+            self.answers = {}
+        return n
+
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self.answers),
+                'live': sum(_[0] > now for _ in self.answers.values()),
+                'failures': sum(isinstance(_[1], Exception) for _ in self.answers.values()),
+                'ttl': self.ttl,
+                'negative_ttl': self.negative_ttl,
+                'hits': self.hits,
+                'misses': self.misses
+                }
+
+
+def interleave(addrinfos:List[tuple]) -> List[tuple]:
+    """
+    Alternate the address families, keeping the resolver's order within
+    each family and starting with the family of its first answer.
+    """
+    by_family = {}
+    for _ in addrinfos: by_family.setdefault(_[0], []).append(_)
+    queues = list(by_family.values())
+
+    ordered = []
+    while queues:
+        for q in queues: ordered.append(q.pop(0))
+        queues = [ q for q in queues if q ]
+    return ordered
+
+
+def connect(addrinfos:List[tuple], timeout:float, delay:float=0.25) -> socket.socket:
+    """
+    Race connects to the addresses, happy eyeballs style. A connect
+    that fails outright starts the next one without waiting for the
+    delay.
+
+    returns -- the connected socket, in blocking mode with the timeout
+        set. Raises socket.timeout if nothing connects in time, or the
+        last error if everything failed.
+    """
+    addrinfos = interleave(addrinfos)
+    deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    pending = []
+    winner = None
+    error = None
+    i = 0
+    next_start = 0.0
+
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if now >= deadline: raise socket.timeout('timed out')
+
+            if i < len(addrinfos) and (not pending or now >= next_start):
+                family, sock_type, proto, _, address = addrinfos[i]
+                i += 1
+                try:
+                    s = socket.socket(family, sock_type, proto)
+                except OSError as e:
+                    # No IPv6 here, say; try the next address.
+                    error = e
+                    continue
+                s.setblocking(False)
+                result = s.connect_ex(address)
+                if result == 0:
+                    winner = s
+                elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    pending.append(s)
+                    selector.register(s, selectors.EVENT_WRITE)
+                    next_start = now + delay
+                else:
+                    error = OSError(result, os.strerror(result), address)
+                    s.close()
+                continue
+
+            if not pending:
+                raise error or OSError('no addresses to connect to')
+
+            wait = deadline - now
+            if i < len(addrinfos): wait = min(wait, next_start - now)
+            for key, _ in selector.select(max(0.0, wait)):
+                s = key.fileobj
+                result = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    winner = s
+                    break
+                error = OSError(result, os.strerror(result))
+                selector.unregister(s)
+                pending.remove(s)
+                s.close()
+                next_start = 0.0
+
+    finally:
+        for s in pending:
+            if s is not winner: s.close()
+        selector.close()
+
+    winner.setblocking(True)
+    winner.settimeout(timeout)
+    return winner
+
+
+# One cache for the whole process.
+cache = DNSCache()
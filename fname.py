@@ -19,10 +19,14 @@ This class supports all the comparison operators ( ==, !=, <, <=,
 """
 
 
+import atexit
+import dbm
 import  fcntl
 from   functools import total_ordering
 import hashlib
+import mmap
 import os
+import threading
 import typing
 from   typing import *
 from   urllib.parse import urlparse
@@ -36,6 +40,57 @@ __maintainer__ = 'George Flanagin'
 __email__ = 'gflanagin@richmond.edu'
 __status__ = 'Prototype'
 
+class HashCache:
+    """
+    Content hashes that outlive the process. A file is identified by 
+    what stat() tells us about it -- device, inode, size, and mtime in
+    nanoseconds -- so a file that has not been touched is never read
+    twice, and a file that has been touched is never mistaken for its
+    old self. The cache is a dbm file, opened the first time it is
+    needed.
+    """
+
+    def __init__(self, path:str=None):
+        if path is None:
+            path = os.path.join(os.environ.get('XDG_CACHE_HOME', 
+                os.path.expanduser('~/.cache')), 'beachhead', 'hashes')
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+
+    def _open(self) -> bool:
+        """ Must be called with the lock held. """
+        if self.db is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+                self.db = dbm.open(self.path, 'c')
+                atexit.register(self.close)
+            except Exception as e:
+                # No place to keep it. Carry on without it.
+                self.db = False
+        # Not bool(self.db); an empty database is False.
+        return self.db is not False
+
+
+    def get(self, key:str) -> str:
+        with self.lock:
+            if not self._open(): return None
+            value = self.db.get(key)
+        return None if value is None else value.decode('ascii')
+
+
+    def put(self, key:str, value:str) -> None:
+        with self.lock:
+            if self._open(): self.db[key] = value
+
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is not None and self.db is not False: self.db.close()
+            self.db = None
+
+
 """
 This is Guido's hack to allow forward references for types not yet
 defined.
@@ -57,9 +112,15 @@ class Fname:
     """
 
     BUFSIZE = 65536 
+    # Any name that hashlib.new() understands. md5 is what we have always 
+    # used; sha1 is about twice as fast on most hardware.
+    DIGEST = 'md5'
+    # Set to None to turn off the persistent cache.
+    hash_cache = HashCache()
+
     __slots__ = [ '_me', '_is_URI', '_fqn', '_dir', '_fname',
         '_fname_only', '_ext', '_all_but_ext', '_content_hash',
-        '_is_URI', '_lock_handle']
+        '_is_URI', '_lock_handle', '_hash_key']
 
     def __init__(self, s:str):
         """ 
@@ -77,6 +138,8 @@ class Fname:
             _all_but_ext -- the complement of _ext
             _content_hash -- hexdigit string representing the contents
                 the last time the file was read.
+            _hash_key -- identifies the version of the file (and the 
+                digest) that _content_hash belongs to.
             _lock_handle -- an entry in the logical unit table.
         Raises a ValueError if the argument is empty.
         """
@@ -93,6 +156,7 @@ class Fname:
         self._ext = ""
         self._all_but_ext = ""
         self._content_hash = ""
+        self._hash_key = None
 
         self._is_URI = True if "://" in s else False
         if self._is_URI and 'file://' in s:
@@ -186,19 +250,25 @@ class Fname:
         returns True if the files' contents are the same. We will
         check to ensure that each is really a file that exists, and
         then check the size before we check the contents.
+
+        The checks get more expensive as we go, and we stop as soon as
+        one of them settles it: the size, then a hash of the first and
+        last blocks, and only then a hash of everything (which may well
+        be in the hash cache already).
         """
         if not isinstance(other, Fname):
             return NotImplemented
 
         if not self or not other: return False
-        if len(self) != len(other): return False
+        mine, theirs = os.stat(str(self)), os.stat(str(other))
+        if (mine.st_dev, mine.st_ino) == (theirs.st_dev, theirs.st_ino): return True
+        if mine.st_size != theirs.st_size: return False
 
-        # Gotta look at the contents. See if our hash is known.
-        if not len(self._content_hash): self()
-            
-        # Make sure the other object's hash is known.
-        if not len(other._content_hash): other()
-        return self._content_hash == other._content_hash
+        if self.edge_hash != other.edge_hash: return False
+        # For small files, the edges are the whole thing.
+        if mine.st_size <= 2 * Fname.BUFSIZE: return True
+
+        return self.hash == other.hash
 
 
     @property
@@ -320,27 +390,69 @@ class Fname:
         return self._fqn
 
 
+    @property
+    def edge_hash(self) -> str:
+        """
+        A hash of the first and last BUFSIZE bytes (which is all of it,
+        for a small file). Cheap, and different files of the same size
+        nearly always differ here.
+        """
+        hasher = hashlib.new(Fname.DIGEST)
+        with open(str(self), 'rb') as f:
+            hasher.update(f.read(Fname.BUFSIZE))
+            size = os.fstat(f.fileno()).st_size
+            if size > Fname.BUFSIZE:
+                f.seek(max(Fname.BUFSIZE, size - Fname.BUFSIZE))
+                hasher.update(f.read(Fname.BUFSIZE))
+        return hasher.hexdigest()
+
+
     @property
     def hash(self) -> str:
         """
         Return the hash if it has already been calculated, otherwise
         calculate it and then return it. 
+
+        "Already" means for this version of the file, either by this
+        object or, through the hash cache, by anyone at any time.
         """
-        if len(self._content_hash) > 0: 
+        st = os.stat(str(self))
+        key = "{}:{}:{}:{}:{}".format(Fname.DIGEST, 
+            st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if self._hash_key == key: 
             return self._content_hash
 
-        hasher = hashlib.md5()
+        cache = Fname.hash_cache
+        content_hash = cache.get(key) if cache is not None else None
+        if content_hash is None:
+            content_hash = self._digest(st.st_size)
+            if cache is not None: cache.put(key, content_hash)
 
-        with open(str(self), 'rb') as f:
-            while True:
-                segment = f.read(Fname.BUFSIZE)
-                if not segment: break
-                hasher.update(segment)
-        
-        self._content_hash = hasher.hexdigest()
+        self._content_hash = content_hash
+        self._hash_key = key
         return self._content_hash
 
 
+    def _digest(self, size:int) -> str:
+        """
+        Hash the file through a memory map, so that nothing is copied
+        into our own buffers; hashlib reads the pages straight from the
+        page cache.
+        """
+        hasher = hashlib.new(Fname.DIGEST)
+        if not size: return hasher.hexdigest()
+
+        chunk = Fname.BUFSIZE * 16
+        with open(str(self), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'): m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    for i in range(0, len(view), chunk):
+                        hasher.update(view[i:i+chunk])
+
+        return hasher.hexdigest()
+
+
     @property
     def is_URI(self) -> bool:
         """ 
@@ -4,15 +4,49 @@ import os
 import sys
 
 """ Generic, bare functions, not a part of any object or service. """
+import importlib.util
+
+def lazy_import(name:str) -> object:
+    """
+    Return the named module, but do not execute it until one of its
+    attributes is first used. Heavy modules that only a few functions
+    need cost nothing at import time this way. A module that is not
+    installed still raises ImportError right away.
+    """
+    if name in sys.modules: return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None: raise ImportError('No module named ' + name)
+
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class _MissingModule:
+    """
+    Stands in for an optional module that is not installed, so that
+    importing this file still works; using the module raises
+    ImportError, saying what to install.
+    """
+    def __init__(self, name:str):
+        self.__name__ = name
+
+    def __getattr__(self, attr:str) -> object:
+        raise ImportError('{} is needed here, and is not installed.'.format(self.__name__))
+
+
 import argparse
 import atexit
 import base64
 import calendar
-import croniter
+croniter = lazy_import('croniter')
 import datetime
+import fnmatch
 try:
-    import dateutil
-    from   dateutil import parser
+    dateutil = lazy_import('dateutil')
 except ImportError as e:
     print('urutils requires dateutil.')
     sys.exit(os.EX_SOFTWARE)
@@ -22,15 +56,21 @@ from   functools import reduce
 import getpass
 import inspect
 import json
-import multimap
+try:
+    multimap = lazy_import('multimap')
+except ImportError as e:
+    multimap = _MissingModule('multimap')
 import operator
 try:
-    import paramiko
+    paramiko = lazy_import('paramiko')
 except ImportError as e:
     print('urutils requires paramiko.')
     sys.exit(os.EX_SOFTWARE)
 
-import pandas
+try:
+    pandas = lazy_import('pandas')
+except ImportError as e:
+    pandas = _MissingModule('pandas')
 import pprint as pp
 import pwd
 import re
@@ -40,12 +80,13 @@ import signal
 import socket
 import string
 try:
-    import sortedcontainers
+    sortedcontainers = lazy_import('sortedcontainers')
 except ImportError as e:
     print('urutils requires sortedcontainers.')
     sys.exit(os.EX_SOFTWARE)
 
 import subprocess
+import threading
 import time
 import traceback
 
@@ -192,7 +233,7 @@ def empty(o:object) -> bool:
     return r
         
 
-def flip_dict(kv_mapping:dict) -> Union[dict, multimap.MutableMultiMap]:
+def flip_dict(kv_mapping:dict) -> Union[dict, 'multimap.MutableMultiMap']:
     """
     Take the input dictionary, reverse the kv pairs, and return
     the result in a multimap.
@@ -242,6 +283,85 @@ def fcn_signature(*args) -> str:
 # G
 ####
 
+class _SSHConfigIndex:
+    """
+    A parsed ssh config file, plus what we need to look hosts up in it
+    without trying every Host block in turn. Literal host names go in
+    a dict; wildcard patterns are compiled once. Blocks that we cannot
+    index (negations, Match) are always tried.
+    """
+
+    def __init__(self, config_file:str, signature:tuple):
+        self.signature = signature
+        self.config = paramiko.SSHConfig()
+        with open(config_file) as f:
+            self.config.parse(f)
+
+        self.hostnames = self.config.get_hostnames()
+        self.exact = {}
+        self.wild = []
+        self.always = []
+        self.memo = {}
+
+        # Canonicalization and Match depend on more than the host name;
+        # leave those files to paramiko's own lookup.
+        self.fallback = any(
+            'matches' in _ or 'canonicalizehostname' in _['config']
+            for _ in self.config._config)
+
+        for i, block in enumerate(self.config._config):
+            patterns = block.get('host', [])
+            if any(_.startswith('!') for _ in patterns):
+                self.always.append(i)
+                continue
+
+            wild = []
+            for _ in patterns:
+                if any(c in _ for c in '*?['): wild.append(fnmatch.translate(_))
+                else: self.exact.setdefault(_, []).append(i)
+            if wild: self.wild.append((i, re.compile('|'.join(wild))))
+
+
+    def lookup(self, host_name:str) -> 'paramiko.SSHConfigDict':
+        if self.fallback: return self.config.lookup(host_name)
+
+        if host_name not in self.memo:
+            blocks = set(self.exact.get(host_name, []))
+            blocks.update(self.always)
+            blocks.update(i for i, pattern in self.wild if pattern.match(host_name))
+
+            subset = paramiko.SSHConfig()
+            subset._config = [ self.config._config[i] for i in sorted(blocks) ]
+            self.memo[host_name] = subset.lookup(host_name)
+
+        # Hand out a copy; callers are free to scribble on it.
+        return paramiko.SSHConfigDict({ k:(v[:] if isinstance(v, list) else v)
+            for k, v in self.memo[host_name].items() })
+
+
+_ssh_config_cache = {}
+_ssh_config_lock = threading.Lock()
+
+def _ssh_config_index(config_file:str=None) -> _SSHConfigIndex:
+    """
+    Return the parsed and indexed config file, reading it again only if
+    its mtime or size has changed since we last read it.
+    """
+    if config_file is None: config_file = os.path.expanduser("~") + "/.ssh/config"
+
+    try:
+        st = os.stat(config_file)
+        signature = (st.st_mtime_ns, st.st_size)
+        with _ssh_config_lock:
+            index = _ssh_config_cache.get(config_file)
+            if index is None or index.signature != signature:
+                index = _ssh_config_cache[config_file] = _SSHConfigIndex(config_file, signature)
+    except:
+        raise Exception("could not understand ssh config file " + config_file) from None
+
+    return index
+
+
 def get_ssh_host_info(host_name:str=None, config_file:str=None) -> list:
     """
     Utility function to get all the ssh config info, or just that
@@ -250,20 +370,28 @@ def get_ssh_host_info(host_name:str=None, config_file:str=None) -> list:
         in the ssh config file that gets parsed.
     config_file -- if given (at it usually is not) the usual default
         config file is used.
+
+    The parsed file is cached for the life of the process, and reread
+    when it changes.
     """
 
-    if config_file is None: config_file = os.path.expanduser("~") + "/.ssh/config"
+    index = _ssh_config_index(config_file)
 
-    try:
-        ssh_conf = paramiko.SSHConfig()
-        ssh_conf.parse(open(config_file))
-    except:
-        raise Exception("could not understand ssh config file " + config_file) from None
+    if not host_name: return index.config
+    if host_name == 'all': return set(index.hostnames)
 
-    if not host_name: return ssh_conf
-    if host_name == 'all': return ssh_conf.get_hostnames()
+    return None if host_name not in index.hostnames else index.lookup(host_name)
 
-    return None if host_name not in ssh_conf.get_hostnames() else ssh_conf.lookup(host_name)
+
+def get_ssh_hosts_info(host_names:Iterable[str], config_file:str=None) -> dict:
+    """
+    Look up many hosts at once, with one check of the config file.
+    returns -- a dict of host name to its info, or to None if the host
+        is not in the config file.
+    """
+
+    index = _ssh_config_index(config_file)
+    return { _:(index.lookup(_) if _ in index.hostnames else None) for _ in host_names }
 
 
 def iso_time(seconds: int) -> str:
@@ -467,7 +595,7 @@ def polish(args:dict, doc:str) -> str:
     return wrapper.fill(''.join(new_doc))
 
 
-def positions(x_list:list) -> pandas.DataFrame:
+def positions(x_list:list) -> 'pandas.DataFrame':
     """
     Given a list of hashables, return a pandas DataFrame where the 
     column names are the distinct members of the list, and the
@@ -624,7 +752,13 @@ def stalk_and_kill(process_name:str) -> bool:
     return got_em
 
 
-def tombstone(args=None) -> int:
+# If a backend is installed (see tomblog.py), tombstone() hands its
+# records to it rather than writing them itself. Anything below
+# tombstone_level is dropped before any work is done.
+tombstone_backend = None
+tombstone_level = 0
+
+def tombstone(args=None, level:int=20, host:str=None) -> int:
     """
     This is an augmented print() statement that has the advantage
     of always writing to "unit 2." In console programs, unit 2 is
@@ -633,11 +767,19 @@ def tombstone(args=None) -> int:
     you can all tombstone("Hello world") without having to worry
     about the mode of function of your program at the time the
     function is called.
+
+    level -- as in the logging module; 20 is INFO.
+    host -- the host the message is about, for a backend that keeps it.
     """
-    ELAPSED_TIME = time.time() - START_TIME
-    a = [now_as_string(" @ ") + " :: (", str(round(ELAPSED_TIME,3)), ")(" + str(os.getpid()) + ")"]
+    if level < tombstone_level: return
     if args is None:
         args=formatted_stack_trace(True)
+    if tombstone_backend is not None:
+        tombstone_backend.put(args, level, host)
+        return
+
+    ELAPSED_TIME = time.time() - START_TIME
+    a = [now_as_string(" @ ") + " :: (", str(round(ELAPSED_TIME,3)), ")(" + str(os.getpid()) + ")"]
     if isinstance(args, list):
         for _ in args:
             a.append(str(_))
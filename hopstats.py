@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms for the phases of an SSH connection.
+
+SmallHOP records how long each phase took (TCP connect, banner, key
+exchange, authentication, channel open, ...) for each host. We keep a
+histogram per (host, phase) and one per phase for all hosts together,
+so that we can see both which hosts are slow and where the time goes.
+
+The histograms have fixed, logarithmically spaced buckets, so memory
+does not grow with the number of samples, and percentiles are estimated
+by interpolating within a bucket. The same buckets are what we export
+in the Prometheus text format.
+"""
+
+import json
+import threading
+import time
+import typing
+from   typing import *
+
+# 0.25ms to about 68s, doubling each time.
+BUCKETS = tuple(0.00025 * 2**i for i in range(19))
+PHASES = ('resolve', 'connect', 'banner', 'kex', 'auth', 'channel', 'sftp')
+
+class Histogram:
+    """ Hack to support forward reference. """
+    pass
+
+
+class Histogram:
+    """
+    Counts of samples in each bucket, plus a running count, sum, min
+    and max. counts[i] is the number of samples <= BUCKETS[i] and
+    > BUCKETS[i-1]; the last slot is everything beyond the last bucket.
+    """
+
+    __slots__ = [ 'counts', 'count', 'total', 'low', 'high' ]
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+
+    def add(self, seconds:float) -> None:
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]: i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.low = seconds if self.low is None else min(self.low, seconds)
+        self.high = seconds if self.high is None else max(self.high, seconds)
+
+
+    def merge(self, other:Histogram) -> Histogram:
+        for i, n in enumerate(other.counts): self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        for _ in (other.low, other.high):
+            if _ is None: continue
+            self.low = _ if self.low is None else min(self.low, _)
+            self.high = _ if self.high is None else max(self.high, _)
+        return self
+
+
+    def percentile(self, p:float) -> float:
+        """
+        Estimate the p-th percentile (0 <= p <= 100) by assuming the
+        samples are spread evenly through the bucket they fall in. The
+        estimate is always clamped to the observed min and max.
+        """
+        if not self.count: return 0.0
+
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n or seen + n < rank:
+                seen += n
+                continue
+            lower = BUCKETS[i-1] if i > 0 else 0.0
+            upper = BUCKETS[i] if i < len(BUCKETS) else self.high
+            estimate = lower + (upper - lower) * (rank - seen) / n
+            return min(max(estimate, self.low), self.high)
+
+        return self.high
+
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.low or 0.0,
+            'max': self.high or 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+            }
+
+
+class LatencyStats:
+    """
+    All the histograms, by host and phase. Safe to use from the probe
+    workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_host = {}
+        self.started = time.time()
+
+
+    def record(self, host:str, phase:str, seconds:float) -> None:
+        with self.lock:
+            h = self.by_host.get((host, phase))
+            if h is None: h = self.by_host[(host, phase)] = Histogram()
+            h.add(seconds)
+
+
+    def reset(self) -> None:
+        with self.lock:
+            self.by_host = {}
+            self.started = time.time()
+
+
+    def hosts(self) -> List[str]:
+        with self.lock:
+            return sorted(set(_[0] for _ in self.by_host))
+
+
+    def phase(self, phase:str, host:str=None) -> Histogram:
+        """
+        returns -- the histogram for one host, or for all of them if
+            host is None. Either way it is a copy.
+        """
+        h = Histogram()
+        with self.lock:
+            for (this_host, this_phase), this in self.by_host.items():
+                if this_phase == phase and host in (None, this_host): h.merge(this)
+        return h
+
+
+    def phases(self, host:str=None) -> Dict[str, Histogram]:
+        """
+        returns -- the phases we have seen, in the order they happen.
+        """
+        with self.lock:
+            seen = set(_[1] for _ in self.by_host if host in (None, _[0]))
+        ordered = [ _ for _ in PHASES if _ in seen ] + sorted(seen - set(PHASES))
+        return { _:self.phase(_, host) for _ in ordered }
+
+
+    def slowest(self, n:int=10, p:float=95) -> List[tuple]:
+        """
+        returns -- the n (host, phase, percentile) triples with the
+            largest p-th percentile.
+        """
+        with self.lock:
+            rows = [ (host, phase, h.percentile(p)) for (host, phase), h in self.by_host.items() ]
+        return sorted(rows, key=lambda _: _[2], reverse=True)[:n]
+
+
+    def to_json(self) -> str:
+        with self.lock:
+            by_host = {}
+            for (host, phase), h in sorted(self.by_host.items()):
+                by_host.setdefault(host, {})[phase] = h.summary()
+        return json.dumps({
+            'started': self.started,
+            'written': time.time(),
+            'buckets': BUCKETS,
+            'global': { k:v.summary() for k, v in self.phases().items() },
+            'hosts': by_host
+            }, indent=4, sort_keys=True)
+
+
+    def to_prometheus(self) -> str:
+        """
+        The text exposition format, one histogram family with the host
+        and phase as labels. Buckets are cumulative, as Prometheus
+        expects.
+        """
+        name = 'beachhead_phase_seconds'
+        lines = [
+            '# HELP {} Time spent in each phase of an SSH connection.'.format(name),
+            '# TYPE {} histogram'.format(name)
+            ]
+        with self.lock:
+            items = sorted(self.by_host.items())
+
+        for (host, phase), h in items:
+            labels = 'host="{}",phase="{}"'.format(
+                host.replace('\\', '\\\\').replace('"', '\\"'), phase)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(name, labels, bound, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, h.count))
+            lines.append('{}_sum{{{}}} {:.6f}'.format(name, labels, h.total))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, h.count))
+
+        return "\n".join(lines) + "\n"
+
+
+class TimedSocket:
+    """
+    A socket that notes when the first bytes arrive from the other end.
+    For SSH, those bytes are the server's identification string, so
+    this is how we separate the banner from the key exchange without
+    reaching inside paramiko. Everything else goes to the real socket.
+    """
+
+    def __init__(self, sock:object):
+        self.sock = sock
+        self.first_recv = None
+
+
+    def recv(self, n:int) -> bytes:
+        data = self.sock.recv(n)
+        if self.first_recv is None and data: self.first_recv = time.perf_counter()
+        return data
+
+
+    def __getattr__(self, name:str) -> object:
+        return getattr(self.sock, name)
+
+
+# One set of statistics for the whole process.
+stats = LatencyStats()
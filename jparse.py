@@ -4,6 +4,7 @@
 #pylint: disable=anomalous-backslash-in-string
 """ One JSON munger to rule them all. """
 
+import collections.abc
 import os
 import pprint as pp
 import re
@@ -29,6 +30,87 @@ class JSONReader:
     pass
 
 
+class LazyJSONObject:
+    """ Hack to support forward reference. """
+    pass
+
+
+# The pieces of JSON (plus our bash type comments) that the indexer 
+# needs to recognize. A string is always matched whole, so that nothing
+# inside one is mistaken for structure.
+json_string = rb'"(?:[^"\\]|\\.)*"'
+json_str = re.compile(json_string)
+json_tokens = re.compile(json_string + rb'|#[^\n]*|[{}\[\]]')
+json_comments = rb'\s*(?:#[^\n]*\s*)*'
+json_open = re.compile(json_comments + rb'([{\[])')
+json_key = re.compile(json_comments + rb'(' + json_string + rb')\s*:\s*')
+json_next = re.compile(json_comments + rb'([,}])')
+json_scalar = re.compile(rb'true|false|null|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?')
+
+
+class LazyJSONObject(collections.abc.MutableMapping):
+    """
+    A JSON object whose members are decoded the first time they are
+    used. All that is known up front is where each member's value lies
+    in the source, so that opening a file with tens of thousands of 
+    hosts does not mean building tens of thousands of dicts. Members 
+    that are assigned are kept as they are given.
+
+    The source is JSON unless some other decode is given (see
+    cfgsnapshot).
+    """
+
+    def __init__(self, source:bytes, index:dict, origin:str=None, decode:Callable=None):
+        self.source = source
+        self.decode = simplejson.loads if decode is None else decode
+        # key -> (start, end, has_comment), or None for new members.
+        self.index = index
+        self.decoded = {}
+        self.origin = origin
+
+
+    def __getitem__(self, key:str) -> object:
+        try:
+            return self.decoded[key]
+        except KeyError as e:
+            pass
+
+        start, end, has_comment = self.index[key]
+        text = self.source[start:end]
+        if has_comment:
+            text = json_tokens.sub(lambda m: b'' if m.group().startswith(b'#') else m.group(), text)
+        value = self.decoded[key] = self.decode(text)
+        return value
+
+
+    def __setitem__(self, key:str, value:object) -> None:
+        self.index.setdefault(key, None)
+        self.decoded[key] = value
+
+
+    def __delitem__(self, key:str) -> None:
+        del self.index[key]
+        self.decoded.pop(key, None)
+
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+    def __repr__(self) -> str:
+        return '<LazyJSONObject {} members, {} decoded, from {}>'.format(
+            len(self.index), len(self.decoded), self.origin)
+
+
+    def materialize(self) -> dict:
+        """ returns -- the whole thing, as convert() would have. """
+        return { k:self[k] for k in self.index }
+
+
 class JSONReader:
     """ 
     A single purpose JSON converter and syntax checker for 
@@ -97,6 +179,100 @@ class JSONReader:
         return self
 
 
+    def index(self, f:str) -> object:
+        """
+        The streaming alternative to attach_IO(f, True).convert(). The
+        file is read once, as bytes, and scanned for the members of the
+        top level object; comments are stepped over where they are, not 
+        stripped from a copy. Each member is decoded only when it is 
+        first asked for.
+
+        Returns a LazyJSONObject, or, if the file does not hold a JSON
+        object, whatever convert() makes of it.
+        """
+        self.origin = str(f)
+        with open(f, 'rb') as x:
+            source = x.read()
+
+        m = json_open.match(source)
+        if m is None or m.group(1) == b'[':
+            self.s = json_tokens.sub(
+                lambda m: b'' if m.group().startswith(b'#') else m.group(), source).decode('utf-8')
+            return self.convert()
+
+        index = {}
+        pos = m.end()
+        m = json_next.match(source, pos)
+        if m is not None and m.group(1) == b'}': 
+            return LazyJSONObject(source, index, self.origin)
+
+        while True:
+            m = json_key.match(source, pos)
+            if m is None: self._index_error(source, pos, 'Expecting a property name')
+            key = m.group(1)
+            key = key[1:-1].decode('utf-8') if b'\\' not in key else simplejson.loads(key)
+
+            start = m.end()
+            end, has_comment = self._value_end(source, start)
+            index[key] = (start, end, has_comment)
+
+            m = json_next.match(source, end)
+            if m is None: self._index_error(source, end, "Expecting ',' delimiter")
+            pos = m.end()
+            if m.group(1) == b'}': break
+
+        return LazyJSONObject(source, index, self.origin)
+
+
+    def _value_end(self, source:bytes, start:int) -> Tuple[int, bool]:
+        """
+        Find the end of the value that begins at start.
+
+        returns -- the offset just past it, and whether it has comments
+            inside.
+        """
+        opener = source[start:start+1]
+        if opener not in (b'{', b'['):
+            if opener == b'"': 
+                m = json_str.match(source, start)
+            else:
+                m = json_scalar.match(source, start)
+            if m is None: self._index_error(source, start, 'Expecting value')
+            return m.end(), False
+
+        # The usual case: an object or array with nothing tricky inside,
+        # found with a few searches rather than a look at every token.
+        end = source.find(b'}' if opener == b'{' else b']', start) + 1
+        if (end and source.find(opener, start+1, end) == -1 
+                and source.find(b'\\', start, end) == -1
+                and source.find(b'#', start, end) == -1
+                and not source.count(b'"', start, end) & 1):
+            return end, False
+
+        depth = 0
+        has_comment = False
+        for m in json_tokens.finditer(source, start):
+            c = source[m.start():m.start()+1]
+            if c == b'#': has_comment = True
+            elif c in (b'{', b'['): depth += 1
+            elif c in (b'}', b']'):
+                depth -= 1
+                if not depth: return m.end(), has_comment
+
+        self._index_error(source, start, 'Unterminated value')
+
+
+    def _index_error(self, source:bytes, pos:int, msg:str) -> None:
+        lineno = source.count(b'\n', 0, pos) + 1
+        colno = pos - source.rfind(b'\n', 0, pos)
+        t = (   "Syntax error: " + msg + "\nin " + str(self.origin) +
+                " at offset " + str(pos) + ",\nnear the end of the phrase << " +
+                source[max(0, pos-20):pos+1].decode('utf-8', 'replace') + ">> of the original input, " +
+                "Line: " + str(lineno) + ", column:" + str(colno) + ". " )
+        gkf.tombstone(t)
+        raise Exception(str(self.origin) + ' failed syntax check.')
+
+
     def convert(self, source=None) -> object:
         """
         Parse the self.s string as JSON.
@@ -149,5 +325,5 @@ if __name__ == "__main__":
 
 else:
     # print(str(os.path.abspath(__file__)) + " compiled.")
-    print("*", end="")
+    pass
 
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Keepalives, and round trip times, for the SSH sessions we hold open.
+
+Between commands nothing crosses an open session, and a NAT or a
+firewall that sees nothing for long enough forgets the connection; we
+find out at the next command. Nor do we see a host getting slower until
+we time something against it.
+
+The monitor is one thread. Every `interval` seconds it sends each
+transport it watches a global request, keepalive@openssh.com, with
+want-reply set, as ssh's ServerAliveInterval does. Servers answer
+requests they do not know with a failure, and that answer is all we
+need: the time from the send to the answer is the round trip. A reply
+is matched to its request because the answers to global requests come
+back in the order the requests were sent; we take the replies ahead of
+paramiko's own handler, so that a reply to us never completes somebody
+else's request. For that the order we keep must be the order on the
+wire: every global request that wants a reply, ours or paramiko's, is
+put in the queue and sent under the same lock, and paramiko's are
+queued as None, so that their replies go back to paramiko.
+
+Each host has a window of its last `window` round trips. A host whose
+oldest unanswered keepalive is more than `stall_after` seconds old is
+stalled; the stall ends with the next reply. Transports that are no
+longer active, or that fail a send, are forgotten at the next round,
+and paramiko's handlers put back.
+"""
+
+import collections
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+paramiko = gkf.lazy_import('paramiko')
+
+class RTTWindow:
+    """ Hack to support forward reference. """
+    pass
+
+
+class KeepaliveMonitor:
+    """ Hack to support forward reference. """
+    pass
+
+
+request_name = 'keepalive@openssh.com'
+
+class RTTWindow:
+    """
+    The last round trips to one host, and its counters.
+    """
+
+    __slots__ = [ 'samples', 'sent', 'replies', 'stalls', 'stalled_since', 'last_reply' ]
+
+    def __init__(self, size:int=300):
+        self.samples = collections.deque(maxlen=size)
+        self.sent = 0
+        self.replies = 0
+        self.stalls = 0
+        self.stalled_since = None
+        self.last_reply = None
+
+
+    def add(self, seconds:float) -> None:
+        self.samples.append(seconds)
+        self.replies += 1
+        self.last_reply = time.time()
+        self.stalled_since = None
+
+
+    def percentile(self, p:float) -> float:
+        """ The p-th percentile (0 <= p <= 100) of the window, or None. """
+        if not self.samples: return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+class KeepaliveMonitor:
+    """
+    All methods are safe to call from several threads; the replies are
+    taken on each transport's own thread.
+    """
+
+    def __init__(self, interval:float=15.0, stall_after:float=5.0, window:int=300):
+        """
+        interval -- seconds between keepalives; 0 turns them off.
+        stall_after -- how late a reply may be before the host is stalled.
+        window -- how many round trips to keep for each host.
+        """
+        self.interval = interval
+        self.stall_after = stall_after
+        self.window = window
+
+        # id(transport) -> [ host, transport, sent times waiting for a
+        # reply (None for paramiko's), next send, { message type:
+        # paramiko's handler }, lock held to queue and send, paramiko's
+        # _send_user_message, forgotten ]
+        self.watched = {}
+        # host -> RTTWindow
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.watched)
+
+
+    def watch(self, host:str, transport:object) -> None:
+        """
+        Keep transport alive, and time it, until it is closed. Watching
+        a transport that is already watched does nothing.
+        """
+        if transport is None or not transport.is_active(): return
+        with self.lock:
+            if id(transport) in self.watched: return
+            entry = [host, transport, collections.deque(), time.monotonic() + self.interval, {},
+                threading.Lock(), transport._send_user_message, False]
+            for ptype in (paramiko.common.MSG_REQUEST_SUCCESS, paramiko.common.MSG_REQUEST_FAILURE):
+                entry[4][ptype] = handler = transport._handler_table[ptype]
+                transport._handler_table[ptype] = self._reply_handler(entry, handler)
+            transport._send_user_message = self._sender(entry)
+            self.watched[id(transport)] = entry
+            if host not in self.hosts: self.hosts[host] = RTTWindow(self.window)
+        if self.interval > 0: self.start()
+
+
+    def forget(self, transport:object) -> None:
+        """ Stop watching transport, and give its replies back to paramiko. """
+        with self.lock:
+            entry = self.watched.pop(id(transport), None)
+        if entry is not None: self._restore(entry)
+
+
+    def set_interval(self, interval:float, stall_after:float=None) -> None:
+        """ 0 stops the keepalives; the transports are still watched. """
+        self.interval = max(0.0, interval)
+        if stall_after is not None: self.stall_after = max(0.0, stall_after)
+        now = time.monotonic()
+        with self.lock:
+            for entry in self.watched.values(): entry[3] = now + self.interval
+        if self.interval > 0 and self.watched: self.start()
+        self.wakeup.set()
+
+
+    def reset(self) -> None:
+        """ Forget the round trips, but not the transports. """
+        with self.lock:
+            self.hosts = { entry[0]:RTTWindow(self.window) for entry in self.watched.values() }
+
+
+    def clear(self) -> None:
+        """ Stop watching everything, and forget everything. """
+        with self.lock:
+            entries, self.watched, self.hosts = list(self.watched.values()), {}, {}
+        for entry in entries: self._restore(entry)
+        self.stop()
+
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self._run, name='keepalive', daemon=True)
+            self.thread.start()
+
+
+    def stop(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        self.wakeup.set()
+        if thread is not None and thread is not threading.current_thread(): thread.join()
+
+
+    def report(self, host:str=None) -> List[dict]:
+        """
+        returns -- for each host (or just the one), its round trips (in
+            seconds) and counters, the hosts in name order.
+        """
+        now = time.time()
+        with self.lock:
+            sessions = collections.Counter(entry[0] for entry in self.watched.values())
+            windows = sorted(_ for _ in self.hosts.items() if host in (None, _[0]))
+            rows = []
+            for name, w in windows:
+                rows.append({
+                    'host': name,
+                    'sessions': sessions.get(name, 0),
+                    'samples': len(w.samples),
+                    'last': w.samples[-1] if w.samples else None,
+                    'p50': w.percentile(50),
+                    'p99': w.percentile(99),
+                    'sent': w.sent,
+                    'replies': w.replies,
+                    'stalls': w.stalls,
+                    'stalled': None if w.stalled_since is None else now - w.stalled_since,
+                    'last_reply': w.last_reply
+                    })
+        return rows
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'interval': self.interval,
+                'stall_after': self.stall_after,
+                'transports': len(self.watched),
+                'hosts': len(self.hosts),
+                'stalled': sum(_.stalled_since is not None for _ in self.hosts.values()),
+                'running': self.thread is not None
+                }
+
+
+    def _reply_handler(self, entry:list, handler:Callable) -> Callable:
+        def reply(m:object) -> None:
+            when = time.perf_counter()
+            with self.lock:
+                sent = entry[2].popleft() if entry[2] else None
+                w = self.hosts.get(entry[0]) if sent is not None else None
+                if w is not None: w.add(when - sent)
+                if entry[7] and not entry[2]: self._give_back(entry)
+            # Not ours; paramiko is waiting for it.
+            if sent is None: handler(m)
+        return reply
+
+
+    def _sender(self, entry:list) -> Callable:
+        """
+        paramiko sends its global requests, and everything else, through
+        the transport's _send_user_message; this takes its place.
+        """
+        def send(m:object) -> None:
+            if not _wants_reply(m): return entry[6](m)
+            with entry[5]:
+                entry[2].append(None)
+                entry[6](m)
+        return send
+
+
+    def _restore(self, entry:list) -> None:
+        """
+        Stop queueing and sending. Replies still to come are taken, and
+        sorted, as before; paramiko gets its handlers back after the last.
+        """
+        with entry[5]:
+            entry[1].__dict__.pop('_send_user_message', None)
+            with self.lock:
+                entry[7] = True
+                # A closed transport has no replies to come.
+                if not entry[2] or not entry[1].is_active(): self._give_back(entry)
+
+
+    def _give_back(self, entry:list) -> None:
+        for ptype, handler in entry[4].items(): entry[1]._handler_table[ptype] = handler
+
+
+    def _run(self) -> None:
+        while self.thread is threading.current_thread():
+            self.wakeup.wait(min(1.0, self.interval or 1.0))
+            self.wakeup.clear()
+            if self.interval <= 0: continue
+            self._round()
+
+
+    def _round(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            entries = list(self.watched.values())
+
+        for entry in entries:
+            host, t, waiting = entry[0], entry[1], entry[2]
+            if not t.is_active():
+                self.forget(t)
+                continue
+
+            with self.lock:
+                w = self.hosts.get(host)
+                oldest = next((_ for _ in list(waiting) if _ is not None), None)
+                late = 0.0 if oldest is None else time.perf_counter() - oldest
+                if w is not None and late > self.stall_after and w.stalled_since is None:
+                    w.stalled_since = time.time() - late
+                    w.stalls += 1
+                    gkf.tombstone('{} has not answered a keepalive for {:.1f} seconds'.format(
+                        host, late), 30, host)
+
+            if now < entry[3]: continue
+            entry[3] = now + self.interval
+
+            m = paramiko.Message()
+            m.add_byte(paramiko.common.cMSG_GLOBAL_REQUEST)
+            m.add_string(request_name)
+            m.add_boolean(True)
+            try:
+                with entry[5]:
+                    if entry[7]: continue
+                    with self.lock:
+                        waiting.append(time.perf_counter())
+                        if w is not None: w.sent += 1
+                    entry[6](m)
+            except Exception as e:
+                self.forget(t)
+
+
+def _wants_reply(m:object) -> bool:
+    """
+    Is m a global request with want-reply set? Every packet sent on a
+    watched transport is asked, so only the first byte is looked at
+    until it is one.
+    """
+    with m.packet.getbuffer() as view:
+        if not view or view[0] != paramiko.common.MSG_GLOBAL_REQUEST: return False
+    m = paramiko.Message(m.asbytes()[1:])
+    m.get_string()
+    return m.get_boolean()
+
+
+# One monitor for the whole process.
+monitor = KeepaliveMonitor()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+~/.ssh/known_hosts, read once and indexed, for every SSHClient we make.
+
+SSHClient.load_system_host_keys() reads the whole file, builds a key
+object for every line, and checks each new line against all the lines
+before it. With a known_hosts of 100k lines, that is paid on every
+session. Here the file is read once per process (and again only when
+its mtime changes), and nothing is built until a host is looked up:
+
+    plain entries are in a dict by host name.
+
+    hashed entries (|1|salt|hmac) are grouped by salt, and within a
+    salt by HMAC, so looking up a host costs one HMAC per distinct salt
+    rather than one per line, plus a dict lookup. The answer for each
+    host is remembered, so the second lookup of a host costs nothing.
+
+KnownHosts is a paramiko.HostKeys whose lookup() goes to the index, so
+it can be an SSHClient's system host keys and answer everything paramiko
+asks of them. Keys given to add() or load() are kept the way HostKeys
+keeps them, and are looked up after the index. Keys that AutoAddPolicy
+learns go into the client's own _host_keys, as before; known_hosts is
+never written.
+"""
+
+import base64
+import binascii
+import hmac
+import os
+import threading
+import typing
+from   typing import *
+
+import gkflib as gkf
+paramiko = gkf.lazy_import('paramiko')
+
+class KnownHosts:
+    """ Hack to support forward reference. """
+    pass
+
+
+class HostKeyDict(dict):
+    """
+    keytype -> PKey for one host. paramiko indexes the result of keys(),
+    so it has to be a list.
+    """
+    def keys(self) -> list:
+        return list(super().keys())
+
+
+class KnownHosts(paramiko.HostKeys):
+
+    def __init__(self, filename:str='~/.ssh/known_hosts'):
+        # Nothing of HostKeys' own until add() or load().
+        super().__init__()
+        self.filename = os.path.expanduser(filename)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self._clear()
+
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def _clear(self) -> None:
+        # [ (keytype, base64 key), .. ], in the order of the file.
+        self.entries = []
+        # name -> [ index into entries, .. ]
+        self.plain = {}
+        # salt -> { hmac -> [ index into entries, .. ] }
+        self.hashed = {}
+        # name -> HostKeyDict or None
+        self.memo = {}
+        # index into entries -> PKey, or None if paramiko cannot read it.
+        self.pkeys = {}
+
+
+    def __getitem__(self, hostname:str) -> HostKeyDict:
+        keys = self.lookup(hostname)
+        if keys is None: raise KeyError(hostname)
+        return keys
+
+
+    def __iter__(self) -> Iterator[str]:
+        """ Only the plain names; the hashed ones cannot be listed. """
+        return iter(self.keys())
+
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+
+    def keys(self) -> List[str]:
+        self._fresh()
+        names = list(self.plain)
+        if self._entries:
+            names.extend(_ for _ in super().keys() if _ not in self.plain)
+        return names
+
+
+    def values(self) -> List[HostKeyDict]:
+        return [ self[_] for _ in self.keys() ]
+
+
+    def lookup(self, hostname:str) -> HostKeyDict:
+        """
+        returns -- the keys for hostname (which is "[host]:port" for a
+            port other than 22), or None if there are none.
+        """
+        self._fresh()
+        with self.lock:
+            if hostname in self.memo:
+                self.hits += 1
+                return self._added(hostname, self.memo[hostname])
+            self.misses += 1
+            plain = self.plain.get(hostname, [])
+            hashed = list(self.hashed.items())
+            entries = self.entries
+
+        found = list(plain)
+        name = hostname.encode('utf-8')
+        for salt, table in hashed:
+            found.extend(table.get(hmac.digest(salt, name, 'sha1'), ()))
+
+        keys = None
+        if found:
+            keys = HostKeyDict()
+            for i in sorted(found):
+                pkey = self._pkey(i, entries)
+                if pkey is not None: keys.setdefault(pkey.get_name(), pkey)
+            keys = keys or None
+
+        with self.lock:
+            if entries is self.entries: self.memo[hostname] = keys
+        return self._added(hostname, keys)
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'file': self.filename,
+                'entries': len(self.entries),
+                'plain': len(self.plain),
+                'salts': len(self.hashed),
+                'remembered': len(self.memo),
+                'loads': self.loads,
+                'hits': self.hits,
+                'misses': self.misses
+                }
+
+
+    def _added(self, hostname:str, keys:HostKeyDict) -> HostKeyDict:
+        """ keys, with any that were add()-ed or load()-ed for hostname. """
+        if not self._entries: return keys
+        added = super().lookup(hostname)
+        if not added: return keys
+        keys = HostKeyDict(keys or {})
+        for keytype in added.keys(): keys.setdefault(keytype, added[keytype])
+        return keys
+
+
+    def _pkey(self, i:int, entries:list) -> object:
+        with self.lock:
+            if i in self.pkeys and entries is self.entries: return self.pkeys[i]
+
+        keytype, key = entries[i]
+        try:
+            pkey = paramiko.PKey.from_type_string(keytype, base64.b64decode(key))
+        except Exception as e:
+            # Bad base64, or a key type paramiko does not know.
+            pkey = None
+
+        with self.lock:
+            if entries is self.entries: self.pkeys[i] = pkey
+        return pkey
+
+
+    def _fresh(self) -> None:
+        """
+        Read the file if we have not, or if it has changed since.
+        """
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError as e:
+            mtime = None
+
+        with self.lock:
+            if mtime == self.mtime and self.loads: return
+            self._clear()
+            self.mtime = mtime
+            self.loads += 1
+            if mtime is None: return
+            self._load()
+
+
+    def _load(self) -> None:
+        """ Must be called with the lock held. """
+        try:
+            f = open(self.filename, 'r', errors='replace')
+        except OSError as e:
+            return
+
+        with f:
+            for line in f:
+                fields = line.split()
+                # Comments, blanks, and the @cert-authority and @revoked
+                # markers, which paramiko does not support either.
+                if len(fields) < 3 or fields[0][0] in '#@': continue
+
+                i = len(self.entries)
+                self.entries.append((fields[1], fields[2]))
+                for name in fields[0].split(','):
+                    if name.startswith('|1|'):
+                        try:
+                            _, _, salt, digest = name.split('|')
+                            salt = base64.b64decode(salt)
+                            digest = base64.b64decode(digest)
+                        except (ValueError, binascii.Error) as e:
+                            continue
+                        self.hashed.setdefault(salt, {}).setdefault(digest, []).append(i)
+                    else:
+                        self.plain.setdefault(name, []).append(i)
+
+
+# One index for the whole process.
+known_hosts = KnownHosts()
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Run plugins in worker processes, so that a slow or hung plugin does not
+take the console with it, and so that one plugin can run for many hosts
+at once.
+
+The workers are forked up front, the way forkdemo.py does it, and each
+one keeps running plugins until it is told to stop. Requests and results
+go over a socketpair as length-prefixed pickles. The parent is a single
+thread: it hands out requests to idle workers and select()s on the busy
+ones. A worker that does not answer in time is killed; one that dies is
+reaped. Either way a new worker is forked in its place.
+
+By the time a worker needs replacing, the console has threads (the
+tombstone writer, the keepalive monitor, paramiko's), and a child forked
+then may find a lock held by a thread it does not have. So the parent
+forks only once, at startup, before there are any threads: a forker,
+which has one thread, forks the workers when asked, and hands back each
+one's pid and the parent's end of its socketpair (SCM_RIGHTS). The
+workers are the forker's children, so it is the forker that reaps them.
+"""
+
+import atexit
+import collections
+import os
+import pickle
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+
+class Worker:
+    """ Hack to support forward reference. """
+    pass
+
+
+class WorkerPool:
+    """ Hack to support forward reference. """
+    pass
+
+
+def send(sock:socket.socket, message:object) -> None:
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv(sock:socket.socket) -> object:
+    """
+    returns -- the next message, or None if the other end has closed.
+    """
+    header = recv_exactly(sock, 4)
+    if header is None: return None
+    data = recv_exactly(sock, struct.unpack('!I', header)[0])
+    return None if data is None else pickle.loads(data)
+
+
+def recv_exactly(sock:socket.socket, n:int) -> bytes:
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1<<20))
+        if not chunk: return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+class Worker:
+    """
+    The parent's handle on one child: its pid, and its end of the
+    socketpair.
+    """
+
+    __slots__ = [ 'pid', 'sock' ]
+
+    def __init__(self, pid:int, sock:socket.socket):
+        self.pid = pid
+        self.sock = sock
+
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+
+class WorkerPool:
+
+    def __init__(self, registry:object, size:int=4, timeout:float=30.0):
+        self.registry = registry
+        self.size = size
+        self.timeout = timeout
+        self.workers = []
+        # Our handle on the forker; see fork_server().
+        self.forker = None
+
+        self.started = 0
+        self.restarts = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.calls = 0
+        atexit.register(self.stop)
+
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+
+    def start(self) -> None:
+        """
+        Fork workers until there are self.size of them. The first call
+        forks the forker, and should come before the program starts any
+        threads.
+        """
+        if self.forker is None: self.forker = self._fork_forker()
+        while len(self.workers) < self.size:
+            self.workers.append(self._fork())
+
+
+    def stop(self) -> None:
+        """ Ask each worker, and then the forker, to stop, and reap them all. """
+        for w in self.workers:
+            try:
+                send(w.sock, None)
+            except OSError as e:
+                pass
+        for w in self.workers: self._reap(w, timeout=1.0)
+        self.workers = []
+
+        forker, self.forker = self.forker, None
+        if forker is not None:
+            try:
+                send(forker.sock, None)
+            except OSError as e:
+                pass
+            forker.sock.close()
+            reap(forker.pid, timeout=1.0)
+
+
+    def resize(self, size:int) -> None:
+        self.size = max(1, size)
+        while len(self.workers) > self.size:
+            w = self.workers.pop()
+            try:
+                send(w.sock, None)
+            except OSError as e:
+                pass
+            self._reap(w, timeout=1.0)
+        if self.workers: self.start()
+
+
+    def call(self, name:str, *args, timeout:float=None) -> Tuple[int, Any]:
+        """
+        Run one plugin in a worker.
+
+        returns -- (exit code, result), as PluginRegistry.run() does.
+        """
+        for _, reply in self.map(name, [args], timeout): return reply
+
+
+    def map(self, name:str, arglists:Iterable[tuple],
+            timeout:float=None) -> Iterator[Tuple[int, Tuple[int, Any]]]:
+        """
+        Run the plugin once for each tuple of arguments, as many at once
+        as there are workers.
+
+        Yields (index into arglists, (exit code, result)) as each one
+        finishes. A call that times out or kills its worker gives an exit
+        code of -1 and the reason as its result.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        todo = collections.deque(enumerate(arglists))
+        busy = {}
+        self.start()
+
+        try:
+            while todo or busy:
+                idle = [ w for w in self.workers if w not in busy ]
+                while todo and idle:
+                    w = idle.pop()
+                    i, args = todo.popleft()
+                    try:
+                        send(w.sock, (name, tuple(args)))
+                    except OSError as e:
+                        self._replace(w)
+                        yield i, (-1, 'worker {} gone: {}'.format(w.pid, e))
+                        continue
+                    self.calls += 1
+                    busy[w] = (i, time.monotonic() + timeout, time.perf_counter())
+
+                if not busy: continue
+
+                wait = max(0.0, min(_[1] for _ in busy.values()) - time.monotonic())
+                ready, _, _ = select.select(list(busy), [], [], wait)
+
+                for w in ready:
+                    i, _, start_time = busy.pop(w)
+                    try:
+                        reply = recv(w.sock)
+                    except (OSError, pickle.UnpicklingError, EOFError) as e:
+                        reply = None
+
+                    if reply is None:
+                        self.crashes += 1
+                        status = self._replace(w)
+                        yield i, (-1, 'worker {} died, signal {}, exit status {}'.format(
+                            w.pid, status % 256, status // 256))
+                        continue
+
+                    self.registry.record(name, time.perf_counter() - start_time, reply[2])
+                    yield i, (reply[1] if reply[0] == 'ok' else (-1, reply[1]))
+
+                now = time.monotonic()
+                for w in [ w for w, v in busy.items() if v[1] <= now ]:
+                    i, _, _ = busy.pop(w)
+                    self.timeouts += 1
+                    os.kill(w.pid, signal.SIGKILL)
+                    self._replace(w)
+                    yield i, (-1, 'timeout of {} seconds exceeded.'.format(timeout))
+
+        finally:
+            # If our caller gives up early, the answers still on their
+            # way would be read by the next caller. Start over instead.
+            for w in busy:
+                os.kill(w.pid, signal.SIGKILL)
+                self._replace(w)
+
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'running': len(self.workers),
+            'timeout': self.timeout,
+            'started': self.started,
+            'restarts': self.restarts,
+            'timeouts': self.timeouts,
+            'crashes': self.crashes,
+            'calls': self.calls
+            }
+
+
+    def _fork_forker(self) -> Worker:
+        parent_end, child_end = socket.socketpair()
+        # Anything still buffered would be written again by every child.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+
+        if pid > 0:
+            child_end.close()
+            return Worker(pid, parent_end)
+
+        # This is the forker. It keeps nothing of the parent's but the
+        # registry, and never returns.
+        status = 0
+        try:
+            parent_end.close()
+            for w in self.workers: w.sock.close()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.registry.after_fork()
+            try:
+                import setproctitle
+                setproctitle.setproctitle('beachhead plugin forker')
+            except ImportError as e:
+                pass
+            fork_server(child_end, self.registry)
+
+        except BaseException as e:
+            status = 1
+
+        finally:
+            os._exit(status)
+
+
+    def _fork(self) -> Worker:
+        """ Have the forker fork a worker; start a new forker if it has gone. """
+        for attempt in range(2):
+            try:
+                send(self.forker.sock, ('fork',))
+                data, fds, _, _ = socket.recv_fds(self.forker.sock, 4, 1)
+                if len(data) == 4 and fds:
+                    self.started += 1
+                    return Worker(struct.unpack('!i', data)[0], socket.socket(fileno=fds[0]))
+                for fd in fds: os.close(fd)
+            except OSError as e:
+                pass
+            # Better a fork from here, threads or not, than no workers.
+            self.forker.sock.close()
+            reap(self.forker.pid, timeout=1.0)
+            self.forker = self._fork_forker()
+        raise OSError('cannot start a plugin worker')
+
+
+    def _replace(self, w:Worker) -> int:
+        """
+        Reap a worker that is finished (or about to be), and fork another
+        in its place.
+
+        returns -- the dead worker's wait status.
+        """
+        status = self._reap(w)
+        if w in self.workers:
+            self.workers[self.workers.index(w)] = self._fork()
+            self.restarts += 1
+        return status
+
+
+    def _reap(self, w:Worker, timeout:float=None) -> int:
+        """
+        Have the forker wait for the worker to exit, killing it if it
+        has not done so after timeout seconds.
+
+        returns -- its status, as os.wait() gives it.
+        """
+        w.sock.close()
+        try:
+            send(self.forker.sock, ('reap', w.pid, timeout))
+            status = recv(self.forker.sock)
+        except (OSError, AttributeError) as e:
+            status = None
+        return 0 if status is None else status
+
+
+def reap(pid:int, timeout:float=None) -> int:
+    """
+    Wait for a child to exit, killing it if it has not done so after
+    timeout seconds.
+
+    returns -- its status, as os.wait() gives it.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            done, status = os.waitpid(pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError as e:
+            return 0
+        if done: return status
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            deadline = None
+        else:
+            time.sleep(0.01)
+
+
+def fork_server(sock:socket.socket, registry:object) -> None:
+    """
+    What the forker does, until the parent goes away: fork a worker
+    when asked, and send back its pid with the parent's end of its
+    socketpair; reap a worker when asked, and send back its status.
+    """
+    while True:
+        request = recv(sock)
+        if request is None: return
+
+        if request[0] == 'reap':
+            send(sock, reap(request[1], request[2]))
+            continue
+
+        parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                sock.close()
+                parent_end.close()
+                try:
+                    import setproctitle
+                    setproctitle.setproctitle('beachhead plugin worker')
+                except ImportError as e:
+                    pass
+                serve(child_end, registry)
+            except BaseException as e:
+                status = 1
+            finally:
+                os._exit(status)
+
+        child_end.close()
+        socket.send_fds(sock, [struct.pack('!i', pid)], [parent_end.fileno()])
+        parent_end.close()
+
+
+def serve(sock:socket.socket, registry:object) -> None:
+    """
+    What a worker does: run plugins until told to stop, or until the
+    parent goes away.
+    """
+    while True:
+        request = recv(sock)
+        if request is None: return
+        name, args = request
+
+        try:
+            reply = ('ok', registry.run(name, *args), registry.load_times.get(name))
+        except Exception as e:
+            reply = ('error', gkf.type_and_text(e), registry.load_times.get(name))
+
+        try:
+            send(sock, reply)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # The result cannot be pickled; send what it looks like.
+            send(sock, ('ok', (reply[1][0], repr(reply[1][1])), reply[2]))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Find plugins without importing them, and import each one only when it
+is first run.
+
+A plugin is a .py file somewhere under the plugin directory with a
+callable main(). `plugin name args` calls main(*args), and `runon`
+calls main(host, *args) once for each host, so a plugin meant for
+runon takes the host first. Which plugins exist, and where, is kept in a manifest
+(name, path, mtime) in the user's cache directory. The manifest is good
+for as long as none of the directories under the plugin directory has
+changed, which costs one stat() per directory to find out, rather than
+a walk of the tree and an exec of every module. The compiled modules
+themselves are cached the usual way, in __pycache__.
+
+A plugin whose file changes after it was imported is imported again the
+next time it is run.
+"""
+
+import importlib.util
+import inspect
+import json
+import os
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+import hopstats
+
+class PluginError(Exception):
+    pass
+
+
+class PluginRegistry:
+    """ Hack to support forward reference. """
+    pass
+
+
+class PluginRegistry:
+
+    def __init__(self, plugin_dir:str='plugins', manifest:str=None):
+        self.plugin_dir = os.path.abspath(plugin_dir)
+        if manifest is None:
+            manifest = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                os.path.expanduser('~/.cache')), 'beachhead', 'plugins.json')
+        self.manifest_file = manifest
+
+        # name -> {'path':.., 'mtime':..}, and directory -> mtime_ns for
+        # every directory that was walked to find them.
+        self.manifest = None
+        self.directories = {}
+
+        # name -> (mtime when imported, main)
+        self.loaded = {}
+        self.load_times = {}
+        self.run_times = {}
+        self.lock = threading.RLock()
+
+
+    def __contains__(self, name:str) -> bool:
+        return name in self.names()
+
+
+    def names(self) -> List[str]:
+        with self.lock:
+            self._discover()
+            return sorted(self.manifest)
+
+
+    def rescan(self) -> int:
+        """
+        Walk the plugin directory again, whatever the manifest says.
+
+        returns -- the number of plugins found.
+        """
+        with self.lock:
+            self.manifest = None
+            self._walk()
+            return len(self.manifest)
+
+
+    def load(self, name:str) -> Callable:
+        """
+        returns -- the plugin's main(), importing the plugin if this
+            is the first time, or if its file has changed since.
+        """
+        with self.lock:
+            self._discover()
+            entry = self.manifest.get(name)
+            if entry is None:
+                raise PluginError("Plugin '{}' not found in {}".format(name, self.plugin_dir))
+
+            try:
+                mtime = os.stat(entry['path']).st_mtime_ns
+            except FileNotFoundError as e:
+                self.rescan()
+                raise PluginError("Plugin '{}' has gone away".format(name))
+
+            if name in self.loaded and self.loaded[name][0] == mtime:
+                return self.loaded[name][1]
+
+            start_time = time.perf_counter()
+            spec = importlib.util.spec_from_file_location(name, entry['path'])
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.load_times[name] = time.perf_counter() - start_time
+
+            main = getattr(module, 'main', None)
+            if not callable(main):
+                raise PluginError('Plugin {} is missing a main function.'.format(name))
+
+            self.loaded[name] = (mtime, main)
+            return main
+
+
+    def run(self, name:str, *args) -> Tuple[int, Any]:
+        """
+        Run a plugin's main(*args). A plugin returns either an exit code,
+        or a tuple of an exit code and a result.
+
+        returns -- (exit code, result). Exceptions from the plugin are
+            the caller's to catch.
+        """
+        main = self.load(name)
+        try:
+            inspect.signature(main).bind(*args)
+        except TypeError as e:
+            raise PluginError('Plugin {} cannot take {} argument[s]: {}'.format(name, len(args), e))
+        except ValueError as e:
+            # No signature to be had; let the call decide.
+            pass
+
+        start_time = time.perf_counter()
+        try:
+            value = main(*args)
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+        if isinstance(value, tuple) and len(value) == 2: return value
+        return (value if isinstance(value, int) else 0), value
+
+
+    def record(self, name:str, seconds:float, load:float=None) -> None:
+        """
+        Note a run of the plugin, and how long it took to load if that
+        is news. For runs that happen somewhere else (see pluginpool).
+        """
+        with self.lock:
+            self.run_times.setdefault(name, hopstats.Histogram()).add(seconds)
+            if load is not None: self.load_times.setdefault(name, load)
+
+
+    def after_fork(self) -> None:
+        """
+        In a child process, the lock may have been held by some other
+        thread of the parent at the moment of the fork. Start fresh.
+        """
+        self.lock = threading.RLock()
+
+
+    def timings(self) -> Dict[str, dict]:
+        """
+        returns -- for each plugin, whether it is loaded, how long the
+            import took, and a summary of its run times.
+        """
+        with self.lock:
+            return { name: {
+                'loaded': name in self.loaded or name in self.load_times,
+                'load': self.load_times.get(name),
+                'runs': self.run_times.get(name, hopstats.Histogram()).summary()
+                } for name in self.names() }
+
+
+    def _discover(self) -> None:
+        """
+        Must be called with the lock held. Use the manifest we have, or
+        the one on disk, if no directory has changed since it was made.
+        """
+        if self.manifest is not None and self._current(self.directories): return
+
+        try:
+            with open(self.manifest_file) as f:
+                saved = json.load(f).get(self.plugin_dir)
+            if saved and self._current(saved['directories']):
+                self.manifest = saved['plugins']
+                self.directories = saved['directories']
+                return
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            pass
+
+        self._walk()
+
+
+    def _current(self, directories:dict) -> bool:
+        try:
+            return all(os.stat(d).st_mtime_ns == mtime for d, mtime in directories.items())
+        except OSError as e:
+            return False
+
+
+    def _walk(self) -> None:
+        """
+        Must be called with the lock held. Find the plugins, and save
+        what we found for next time.
+        """
+        self.manifest = {}
+        self.directories = {}
+        if os.path.isdir(self.plugin_dir):
+            self.directories[self.plugin_dir] = os.stat(self.plugin_dir).st_mtime_ns
+
+        for here, dirs, files in os.walk(self.plugin_dir):
+            dirs[:] = sorted(_ for _ in dirs if _ != '__pycache__' and not _.startswith('.'))
+            for d in dirs:
+                path = os.path.join(here, d)
+                self.directories[path] = os.stat(path).st_mtime_ns
+            for f in sorted(files):
+                name, ext = os.path.splitext(f)
+                if ext != '.py' or name.startswith(('.', '_')): continue
+                path = os.path.join(here, f)
+                if name in self.manifest:
+                    gkf.tombstone('Plugin {} in {} is hidden by {}'.format(
+                        name, path, self.manifest[name]['path']))
+                    continue
+                self.manifest[name] = {'path':path, 'mtime':os.stat(path).st_mtime_ns}
+
+        try:
+            try:
+                with open(self.manifest_file) as f:
+                    everything = json.load(f)
+            except (OSError, ValueError) as e:
+                everything = {}
+            everything[self.plugin_dir] = {
+                'plugins': self.manifest, 'directories': self.directories }
+            os.makedirs(os.path.dirname(self.manifest_file), mode=0o700, exist_ok=True)
+            temp_name = self.manifest_file + '.' + str(os.getpid())
+            with open(temp_name, 'w') as f:
+                json.dump(everything, f, indent=4, sort_keys=True)
+            os.replace(temp_name, self.manifest_file)
+
+        except OSError as e:
+            # No place to keep it. We will walk again next time.
+            pass
@@ -10,7 +10,12 @@ def create_ssh_folder(path: str):
     except OSError as error:
         return OSError(f"Error creating directory {path}: {error}")
     
-def main() -> int:
+def main(host: str = None, *args) -> int:
+    # The home directories are on the network, so ~/.ssh is the same
+    # wherever it is made; `runon` gives the host, and it is not needed.
     ssh_folder_path = os.path.join(os.path.expanduser("~"), ".ssh")
-    create_ssh_folder(ssh_folder_path)
+    error = create_ssh_folder(ssh_folder_path)
+    if isinstance(error, FileExistsError): return 0, str(error)
+    if error is not None: return 1, str(error)
+    return 0
     
\ No newline at end of file
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Probes on a schedule, for as long as we are left running.
+
+    python beachhead.py probe-daemon SCHEDULE [ --workers 16 ] [ --list ]
+
+SCHEDULE is a JSON file of host groups, each with a cron schedule:
+
+    {
+        "web": {"cron": "*/5 * * * *", "hosts": ["web*", "lb01"]},
+        "db":  {"cron": "0 * * * *",   "hosts": ["db01", "db02"]}
+    }
+
+The hosts are names, or fnmatch patterns matched against the hosts in
+~/.ssh/config; 'all' is every one of them, as it is for `probe`. The
+schedules are croniter's, in local time, so a sixth field, seconds, is
+allowed. The results go to the probe store, as those of `probe` do,
+one transaction for each run of a schedule; see `history`.
+
+Groups with the same schedule are run as one, so the queue of next-run
+times (a heap) has one entry per distinct schedule, however many hosts
+there are, and croniter is asked for one time per run rather than one
+per host. The probes themselves are done by a fixed number of worker
+threads.
+
+Runs do not pile up:
+
+    late        If we wake up after a run's time has passed (a busy
+                machine, a suspended process), that run is made now,
+                and any others that were missed are not made at all.
+    overlapping A host that is still waiting for, or in the middle of,
+                its last probe is not queued again; nor is a host that
+                is in two groups whose runs come at once.
+
+The schedule file is read again when it changes.
+"""
+
+import argparse
+import bisect
+import concurrent.futures
+import datetime
+import fnmatch
+import heapq
+import json
+import os
+import signal
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+import tomblog
+croniter = gkf.croniter
+
+class Schedule:
+    """ Hack to support forward reference. """
+    pass
+
+
+class ProbeDaemon:
+    """ Hack to support forward reference. """
+    pass
+
+
+class Schedule:
+    """
+    One cron expression, the groups that use it, and their hosts.
+    """
+
+    __slots__ = [ 'cron', 'groups', 'hosts', 'times', 'next_time', 'runs', 'late' ]
+
+    def __init__(self, cron:str, groups:List[str], hosts:List[str]):
+        self.cron = cron
+        self.groups = groups
+        self.hosts = hosts
+        self.times = None
+        self.next_time = None
+        self.runs = 0
+        self.late = 0
+
+
+    def __str__(self) -> str:
+        return '{} [{}]'.format(','.join(self.groups), self.cron)
+
+
+    def advance(self, now:float) -> float:
+        """
+        Move to the first run time after now, and return it.
+        """
+        if self.times is None: self.times = self._times(now)
+        self.next_time = self.times.get_next(float)
+        if self.next_time <= now:
+            # We are late. The runs we missed are not made at all.
+            self.late += 1
+            self.times = self._times(now)
+            self.next_time = self.times.get_next(float)
+        return self.next_time
+
+
+    def _times(self, start:float) -> object:
+        return croniter.croniter(self.cron, datetime.datetime.fromtimestamp(start).astimezone())
+
+
+def load(filename:str, known_hosts:Iterable[str]=None) -> List[Schedule]:
+    """
+    Read a schedule file.
+
+    known_hosts -- the names that patterns are matched against; by
+        default, the hosts in ~/.ssh/config, read only if some group
+        uses 'all' or a pattern.
+
+    returns -- the schedules, one for each distinct cron expression.
+    raises -- ValueError if the file is not what it should be.
+    """
+    with open(filename) as f:
+        try:
+            groups = json.load(f)
+        except ValueError as e:
+            raise ValueError('{} is not JSON: {}'.format(filename, e))
+    if not isinstance(groups, dict): raise ValueError('{} is not a dict of groups'.format(filename))
+
+    # The ssh config is read only if some group needs it.
+    known = None if known_hosts is None else sorted(known_hosts)
+    def known_hosts() -> List[str]:
+        nonlocal known
+        if known is None:
+            try:
+                known = sorted(_ for _ in gkf.get_ssh_host_info('all') if _ != '*')
+            except Exception as e:
+                raise ValueError(str(e)) from None
+        return known
+
+    by_cron = {}
+    for group, entry in groups.items():
+        if not isinstance(entry, dict) or not isinstance(entry.get('cron'), str) \
+                or not isinstance(entry.get('hosts'), list):
+            raise ValueError('group {} needs a "cron" string and a "hosts" list'.format(group))
+        cron = ' '.join(entry['cron'].split())
+        if not croniter.croniter.is_valid(cron):
+            raise ValueError('group {}: not a cron schedule: {}'.format(group, cron))
+
+        hosts = []
+        for name in entry['hosts']:
+            if name == 'all': hosts.extend(known_hosts())
+            elif any(_ in name for _ in '*?['): hosts.extend(_matching(known_hosts(), name))
+            else: hosts.append(name)
+
+        if cron not in by_cron: by_cron[cron] = Schedule(cron, [], {})
+        by_cron[cron].groups.append(group)
+        by_cron[cron].hosts.update(dict.fromkeys(hosts))
+
+    for schedule in by_cron.values(): schedule.hosts = list(schedule.hosts)
+    return list(by_cron.values())
+
+
+def _matching(names:List[str], pattern:str) -> List[str]:
+    """
+    fnmatch.filter(), for sorted names. Only the names that start with
+    the pattern's literal prefix are tried, which with tens of thousands
+    of hosts and patterns like web*, is most of the work saved.
+    """
+    prefix = pattern[:min(pattern.find(_) % (len(pattern) + 1) for _ in '*?[')]
+    if prefix:
+        names = names[bisect.bisect_left(names, prefix):
+            bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1))]
+    return fnmatch.filter(names, pattern)
+
+
+class ProbeDaemon:
+
+    def __init__(self, schedules:List[Schedule], probe:Callable, store:object,
+            workers:int=16, commit_interval:float=5.0):
+        """
+        probe -- called with a host name, from a worker thread; returns
+            the result, as probe_one() does.
+        store -- a probestore.ProbeStore for the results.
+        """
+        self.probe = probe
+        self.store = store
+        self.workers = workers
+        self.commit_interval = commit_interval
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.pool = None
+
+        # Hosts queued or being probed.
+        self.pending = set()
+        # transaction -> [ schedule, hosts queued, done, OK, coalesced, start time ]
+        self.runs = {}
+        self.uncommitted = 0
+
+        self.probes = 0
+        self.successes = 0
+        self.coalesced = 0
+        self.set_schedules(schedules)
+
+
+    def set_schedules(self, schedules:List[Schedule]) -> None:
+        """ Replace the schedules; each starts again from now. """
+        now = time.time()
+        heap = []
+        for i, schedule in enumerate(schedules):
+            heap.append((schedule.advance(now), i, schedule))
+        heapq.heapify(heap)
+        with self.lock:
+            self.schedules = schedules
+            self.heap = heap
+            self.sequence = len(heap)
+        self.wakeup.set()
+
+
+    def run(self, stop_time:float=None, reload:Callable=None) -> None:
+        """
+        Make the runs as they come due, until stop() or stop_time (by
+        time.time()). reload, if given, is called every few seconds, and
+        returns new schedules, or None if nothing has changed.
+        """
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+            thread_name_prefix='probe')
+        next_commit = next_reload = time.monotonic()
+        try:
+            while not self.stopping:
+                now = time.time()
+                if stop_time is not None and now >= stop_time: break
+
+                while True:
+                    with self.lock:
+                        if not self.heap or self.heap[0][0] > now: break
+                        _, _, schedule = heapq.heappop(self.heap)
+                        heapq.heappush(self.heap, (schedule.advance(now), self.sequence, schedule))
+                        self.sequence += 1
+                    self._start_run(schedule)
+
+                if time.monotonic() >= next_commit:
+                    self._commit()
+                    next_commit = time.monotonic() + self.commit_interval
+                if reload is not None and time.monotonic() >= next_reload:
+                    schedules = reload()
+                    if schedules is not None: self.set_schedules(schedules)
+                    next_reload = time.monotonic() + 5.0
+
+                with self.lock:
+                    wait = self.heap[0][0] - time.time() if self.heap else 1.0
+                if stop_time is not None: wait = min(wait, stop_time - time.time())
+                self.wakeup.wait(max(0.0, min(wait, 1.0)))
+                self.wakeup.clear()
+
+        finally:
+            # What is queued is dropped; what is running is finished.
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self._commit()
+
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.wakeup.set()
+
+
+    def upcoming(self, n:int=10) -> List[Tuple[float, Schedule]]:
+        """ returns -- the next n runs, soonest first. """
+        with self.lock:
+            return [ (t, schedule) for t, _, schedule in heapq.nsmallest(n, self.heap) ]
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'schedules': len(self.schedules),
+                'entries': sum(len(_.hosts) for _ in self.schedules),
+                'runs': sum(_.runs for _ in self.schedules),
+                'late': sum(_.late for _ in self.schedules),
+                'probes': self.probes,
+                'successes': self.successes,
+                'coalesced': self.coalesced,
+                'pending': len(self.pending)
+                }
+
+
+    def _start_run(self, schedule:Schedule) -> None:
+        transaction = self.store.new_transaction()
+        queued = []
+        with self.lock:
+            schedule.runs += 1
+            for host in schedule.hosts:
+                if host in self.pending: continue
+                self.pending.add(host)
+                queued.append(host)
+            coalesced = len(schedule.hosts) - len(queued)
+            self.coalesced += coalesced
+            if not queued:
+                gkf.tombstone('{}: every host is still busy from before; nothing queued'.format(schedule), 30)
+                return
+            self.runs[transaction] = [schedule, len(queued), 0, 0, coalesced, time.time()]
+
+        for host in queued:
+            try:
+                self.pool.submit(self._probe, host, transaction)
+            except RuntimeError as e:
+                # Shutting down.
+                with self.lock: self.pending.discard(host)
+
+
+    def _probe(self, host:str, transaction:str) -> None:
+        with tomblog.host_context(host):
+            try:
+                result = self.probe(host)
+            except Exception as e:
+                result = {'host': host, 'session': False, 'error': gkf.type_and_text(e)}
+            if result.get('session'):
+                gkf.tombstone('probed {} OK'.format(host), 10, host)
+            else:
+                gkf.tombstone('probed {} FAILED {}'.format(host, result.get('error')), 30, host)
+            self.store.append(transaction, result)
+
+        with self.lock:
+            self.pending.discard(host)
+            self.uncommitted += 1
+            self.probes += 1
+            self.successes += int(bool(result.get('session')))
+            run = self.runs[transaction]
+            run[2] += 1
+            run[3] += int(bool(result.get('session')))
+            if run[2] < run[1]: return
+            del self.runs[transaction]
+
+        schedule, queued, _, successes, coalesced, start_time = run
+        gkf.tombstone('{} transaction {}: {} of {} hosts OK{} in {:.2f} s'.format(
+            schedule, transaction, successes, queued,
+            ', {} still busy from before'.format(coalesced) if coalesced else '',
+            time.time() - start_time), 20 if successes == queued else 30)
+
+
+    def _commit(self) -> None:
+        with self.lock:
+            if not self.uncommitted: return
+            self.uncommitted = 0
+        self.store.commit()
+
+
+def _interrupt(signum:int, frame:object) -> None:
+    raise KeyboardInterrupt()
+
+
+def main(argv:List[str], probe:Callable, store:object) -> int:
+    """
+    What `beachhead.py probe-daemon` runs. probe and store are as for
+    ProbeDaemon; beachhead supplies them.
+    """
+    parser = argparse.ArgumentParser(prog='beachhead probe-daemon',
+        description='Probe groups of hosts on cron schedules.')
+    parser.add_argument('schedule', help='the JSON file of groups and their schedules.')
+    parser.add_argument('--workers', type=int, default=16, help='probes at once.')
+    parser.add_argument('--list', action='store_true',
+        help='show the schedules and their next runs, and exit.')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds.')
+    parser.add_argument('--messages', choices=tomblog.formats + ('direct',), default='text',
+        help='how to write our messages; see beachhead --help.')
+    parser.add_argument('--message-level', choices=sorted(tomblog.levels, key=tomblog.levels.get),
+        default='info', help='do not show messages below this level.')
+    args = parser.parse_args(argv)
+
+    if args.messages != 'direct': tomblog.install(args.messages)
+    gkf.tombstone_level = tomblog.levels[args.message_level]
+
+    try:
+        schedules = load(args.schedule)
+        mtime = os.stat(args.schedule).st_mtime
+    except (OSError, ValueError) as e:
+        gkf.tombstone(gkf.type_and_text(e), 40)
+        return os.EX_DATAERR
+
+    daemon = ProbeDaemon(schedules, probe, store, max(1, args.workers))
+    gkf.tombstone('{schedules} schedule[s], {entries} host entries, {0} workers'.format(
+        daemon.workers, **daemon.stats()))
+    for t, schedule in daemon.upcoming(5 if args.list else 1):
+        gkf.tombstone('next: {} {} for {} host[s]'.format(
+            datetime.datetime.fromtimestamp(t).isoformat(sep=' ', timespec='seconds'),
+            schedule, len(schedule.hosts)))
+    if args.list: return os.EX_OK
+
+    def reload() -> List[Schedule]:
+        nonlocal mtime
+        try:
+            if os.stat(args.schedule).st_mtime == mtime: return None
+            mtime = os.stat(args.schedule).st_mtime
+            schedules = load(args.schedule)
+        except (OSError, ValueError) as e:
+            gkf.tombstone('keeping the old schedules: {}'.format(gkf.type_and_text(e)), 30)
+            return None
+        gkf.tombstone('{} changed; {} schedule[s] now'.format(args.schedule, len(schedules)))
+        return schedules
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        daemon.run(None if args.duration is None else time.time() + args.duration, reload)
+    except KeyboardInterrupt as e:
+        daemon.stop()
+    gkf.tombstone('stopped: {runs} runs ({late} late), {probes} probes, {successes} OK, '
+        '{coalesced} coalesced'.format(**daemon.stats()))
+    tomblog.uninstall()
+    return os.EX_OK
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Probe results, kept where they can be found again.
+
+`probe` used to append its results to beachhead.log as free text, among
+paramiko's debug output, so that finding one transaction, or one host's
+history, meant reading the whole log. Now each result is appended to
+beachhead.probes as one JSON object per line, and a fixed-width record
+for it is appended to beachhead.probes.idx:
+
+    time        8 bytes     double, seconds since the epoch
+    offset      8 bytes     where the line starts in beachhead.probes
+    length      4 bytes     of the line, with its newline
+    prev_host   8 bytes     index of the previous record for the same
+                            host, or -1
+    prev_tx     8 bytes     index of the previous record in the same
+                            transaction, or -1
+
+so each host's results, and each transaction's, are a chain running
+backwards through the index. Where each chain ends is kept in
+beachhead.probes.heads, which is rewritten at the end of every
+transaction. A host's last n results are n reads, a transaction is as
+many reads as it has hosts, and a range of times is a binary search:
+each record's time is taken under the flock, and is never earlier than
+the one before it.
+
+beachhead.probes is the truth. If the heads are missing or stale, they
+are brought up to date from the index; if the index is short, it is
+brought up to date from the data. Several processes may append at once;
+each append holds an flock() on the index.
+"""
+
+import fcntl
+import itertools
+import json
+import marshal
+import os
+import random
+import struct
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+
+class ProbeStore:
+    """ Hack to support forward reference. """
+    pass
+
+
+index_record = struct.Struct('!dQIqq')
+
+class ProbeStore:
+
+    def __init__(self, filename:str='beachhead.probes'):
+        self.filename = os.path.abspath(filename)
+        self.index_file = self.filename + '.idx'
+        self.heads_file = self.filename + '.heads'
+        self.lock = threading.RLock()
+        self._reset()
+
+
+    def _reset(self) -> None:
+        # How many index records, and how much of the data, we have
+        # accounted for in the heads.
+        self.count = 0
+        self.data_end = 0
+        # The time of the last index record.
+        self.last_time = 0.0
+        # host -> index of its latest record
+        self.hosts = {}
+        # transaction -> [ first index, latest index, records, start time ]
+        self.transactions = {}
+        self.loaded = False
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            self._refresh()
+            return self.count
+
+
+    def new_transaction(self) -> str:
+        """ returns -- a 9-digit transaction ID not used before. """
+        with self.lock:
+            self._refresh()
+            while True:
+                tx = "{:0>9}".format(random.randrange(1000000000))
+                if tx not in self.transactions: return tx
+
+
+    def append(self, transaction:str, result:dict) -> int:
+        """
+        Add one result (a dict with at least 'host') to a transaction.
+
+        returns -- the index of its record.
+        """
+        record = dict(result, transaction=transaction)
+
+        with self.lock, open(self.index_file, 'ab') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                self._refresh(index)
+                # The times in the index must never go backwards, or
+                # since() cannot search them.
+                record['time'] = max(record.get('time', time.time()), self.last_time)
+                line = (json.dumps(record, sort_keys=True) + "\n").encode('utf-8')
+                with open(self.filename, 'ab') as f:
+                    offset = f.tell()
+                    f.write(line)
+                i = self._add(index, record, offset, len(line))
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+        return i
+
+
+    def commit(self) -> None:
+        """
+        Make what has been appended durable, and save the heads so that
+        the next process need not find them again.
+        """
+        with self.lock:
+            for name in (self.filename, self.index_file):
+                try:
+                    fd = os.open(name, os.O_RDONLY)
+                except FileNotFoundError as e:
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            temp_name = '{}.{}.tmp'.format(self.heads_file, os.getpid())
+            try:
+                with open(temp_name, 'wb') as f:
+                    marshal.dump({'count': self.count, 'data_end': self.data_end,
+                        'hosts': self.hosts, 'transactions': self.transactions}, f)
+                os.replace(temp_name, self.heads_file)
+            except OSError as e:
+                # They can be found again from the index.
+                gkf.tombstone('Cannot write {}: {}'.format(self.heads_file, gkf.type_and_text(e)))
+
+
+    def transaction(self, transaction:str) -> List[dict]:
+        """ returns -- the results of the transaction, in the order written. """
+        with self.lock:
+            self._refresh()
+            entry = self.transactions.get(transaction)
+            if entry is None: return []
+            return list(reversed(self._chain(entry[1], 4)))
+
+
+    def host(self, host:str, n:int=10) -> List[dict]:
+        """ returns -- the host's last n results, the newest first. """
+        with self.lock:
+            self._refresh()
+            return self._chain(self.hosts.get(host, -1), 3, n)
+
+
+    def since(self, start:float, stop:float=None, n:int=None) -> List[dict]:
+        """
+        returns -- the results written from start up to (not including)
+            stop, in the order written; only the last n if n is given.
+        """
+        with self.lock:
+            self._refresh()
+            if not self.count: return []
+            try:
+                with open(self.index_file, 'rb') as index, open(self.filename, 'rb') as data:
+                    lo = self._bisect(index, start)
+                    hi = self.count if stop is None else self._bisect(index, stop)
+                    if n is not None: lo = max(lo, hi - n)
+                    return [ self._read(index, data, i)[1] for i in range(lo, hi) ]
+            except FileNotFoundError as e:
+                return []
+
+
+    def recent_transactions(self, n:int=10) -> List[Tuple[str, int, float]]:
+        """
+        returns -- (transaction, records, start time) of the last n
+            transactions, the newest first.
+        """
+        with self.lock:
+            self._refresh()
+            # The transactions are in the dict in the order they began.
+            latest = itertools.islice(reversed(self.transactions.items()), n)
+            return [ (tx, entry[2], entry[3]) for tx, entry in latest ]
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._refresh()
+            return {
+                'file': self.filename,
+                'records': self.count,
+                'bytes': self.data_end,
+                'hosts': len(self.hosts),
+                'transactions': len(self.transactions)
+                }
+
+
+    def _chain(self, i:int, link:int, n:int=None) -> List[dict]:
+        """
+        Follow a chain back from index i. link is which field of the
+        index record to follow: 3 for the host's, 4 for the transaction's.
+        """
+        results = []
+        if i < 0 or not self.count: return results
+        try:
+            with open(self.index_file, 'rb') as index, open(self.filename, 'rb') as data:
+                while i >= 0 and (n is None or len(results) < n):
+                    fields, record = self._read(index, data, i)
+                    results.append(record)
+                    i = fields[link]
+        except FileNotFoundError as e:
+            pass
+        return results
+
+
+    def _read(self, index:object, data:object, i:int) -> Tuple[tuple, dict]:
+        fields = index_record.unpack(os.pread(index.fileno(), index_record.size, i * index_record.size))
+        return fields, json.loads(os.pread(data.fileno(), fields[2], fields[1]))
+
+
+    def _bisect(self, index:object, t:float) -> int:
+        """ returns -- the first index whose time is not before t. """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            when = struct.unpack_from('!d', os.pread(index.fileno(), 8, mid * index_record.size))[0]
+            if when < t: lo = mid + 1
+            else: hi = mid
+        return lo
+
+
+    def _add(self, index:object, record:dict, offset:int, length:int) -> int:
+        """
+        Must be called with the lock and the flock held. Append the
+        index record for a line of the data, and update the heads.
+        """
+        i = self.count
+        host, tx = record.get('host'), record.get('transaction')
+        entry = self.transactions.get(tx)
+        index.write(index_record.pack(record.get('time', 0.0), offset, length,
+            self.hosts.get(host, -1), -1 if entry is None else entry[1]))
+        index.flush()
+
+        self.hosts[host] = i
+        if entry is None: self.transactions[tx] = [i, i, 1, record.get('time', 0.0)]
+        else: entry[1:3] = [i, entry[2] + 1]
+        self.count = i + 1
+        self.data_end = offset + length
+        self.last_time = max(self.last_time, record.get('time', 0.0))
+        return i
+
+
+    def _refresh(self, index:object=None) -> None:
+        """
+        Must be called with the lock held, and with index, if given,
+        open for append and flock()-ed. Bring the heads up to date with
+        the index, and the index up to date with the data, as either may
+        have been added to by another process (or by us, before we died).
+        """
+        if not self.loaded:
+            self.loaded = True
+            try:
+                with open(self.heads_file, 'rb') as f:
+                    heads = marshal.load(f)
+                self.count, self.data_end = heads['count'], heads['data_end']
+                self.hosts, self.transactions = heads['hosts'], heads['transactions']
+                if self.count:
+                    with open(self.index_file, 'rb') as f:
+                        self.last_time = struct.unpack_from('!d', os.pread(f.fileno(), 8,
+                            (self.count - 1) * index_record.size))[0]
+            except (OSError, EOFError, ValueError, TypeError, KeyError, struct.error) as e:
+                pass
+
+        size = _size(self.index_file)
+        data_size = _size(self.filename)
+        n = size // index_record.size
+
+        if n < self.count or data_size < self.data_end:
+            # Not the index, or not the data, that the heads were made
+            # from. Start again from the data.
+            self._reset()
+            self.loaded = True
+            n = 0
+
+        if n > self.count:
+            with open(self.index_file, 'rb') as f, open(self.filename, 'rb') as data:
+                for i in range(self.count, n):
+                    self._follow(i, *self._read(f, data, i))
+
+        if data_size == self.data_end and size == n * index_record.size: return
+
+        # Lines with no index record, or an index record cut short.
+        if index is None:
+            with open(self.index_file, 'ab') as index:
+                fcntl.flock(index, fcntl.LOCK_EX)
+                try:
+                    # Someone may have done it while we waited.
+                    return self._refresh(index)
+                finally:
+                    fcntl.flock(index, fcntl.LOCK_UN)
+
+        index.truncate(n * index_record.size)
+        offset = self.data_end
+        with open(self.filename, 'rb') as data:
+            data.seek(offset)
+            for line in data:
+                # A last line cut short is dropped.
+                if not line.endswith(b"\n"): break
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    record = {'error': 'unreadable record'}
+                self._add(index, record, offset, len(line))
+                offset += len(line)
+        if offset < data_size: os.truncate(self.filename, offset)
+
+
+    def _follow(self, i:int, fields:tuple, record:dict) -> None:
+        """ Account for index record i, written by someone else. """
+        host, tx = record.get('host'), record.get('transaction')
+        self.hosts[host] = i
+        entry = self.transactions.get(tx)
+        if entry is None: self.transactions[tx] = [i, i, 1, fields[0]]
+        else: entry[1:3] = [i, entry[2] + 1]
+        self.count = i + 1
+        self.data_end = fields[1] + fields[2]
+        self.last_time = max(self.last_time, fields[0])
+
+
+def _size(filename:str) -> int:
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError as e:
+        return 0
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+A small pool of authenticated SSH connections, keyed by (host, port, user).
+
+Building a socket, an SSHClient, and a Transport costs a TCP handshake,
+a key exchange, and an authentication. When we go back to the same host
+again and again, we can skip all three by keeping the client around after
+SmallHOP.close() and handing it to the next SmallHOP that asks for the
+same host.
+
+Connections are evicted when they have been idle longer than max_idle
+seconds, when the pool holds more than max_size of them (oldest first),
+or when they are found to be dead on the way out.
+"""
+
+import collections
+import threading
+import time
+import typing
+from   typing import *
+
+class TransportPool:
+    """ Hack to support forward reference. """
+    pass
+
+
+class TransportPool:
+    """
+    Idle SSHClients, each with an authenticated Transport, waiting to be
+    reused. All methods are safe to call from several threads.
+    """
+
+    def __init__(self, max_size:int=8, max_idle:float=300.0):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.enabled = True
+
+        # key -> [ (client, time returned), ... ], oldest key first.
+        self.idle = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(_) for _ in self.idle.values())
+
+
+    @staticmethod
+    def key(hostname:str, port:int, user:str) -> tuple:
+        return hostname, int(port), user
+
+
+    @staticmethod
+    def alive(client:object) -> bool:
+        """
+        Is the client's transport still connected and authenticated? The
+        send_ignore() costs one small packet, and it is the only way to
+        notice a connection the far end has dropped.
+        """
+        try:
+            t = client.get_transport()
+            if t is None or not t.is_active() or not t.is_authenticated():
+                return False
+            t.send_ignore()
+            return True
+
+        except Exception as e:
+            return False
+
+
+    def acquire(self, key:tuple) -> object:
+        """
+        returns -- a live SSHClient for key, or None if the pool does not
+            have one. The client now belongs to the caller.
+        """
+        if not self.enabled: return None
+
+        while True:
+            with self.lock:
+                doomed = self._evict_idle()
+                clients = self.idle.get(key)
+                if not clients:
+                    self.misses += 1
+                    client = None
+                else:
+                    client, _ = clients.pop()
+                    if not clients: del self.idle[key]
+
+            for _ in doomed: TransportPool.discard(_)
+            if client is None: return None
+
+            if TransportPool.alive(client):
+                with self.lock: self.hits += 1
+                return client
+
+            # Dead on arrival. Throw it away and try the next one.
+            TransportPool.discard(client)
+            with self.lock: self.evictions += 1
+
+
+    def release(self, key:tuple, client:object) -> bool:
+        """
+        Offer a client back to the pool.
+
+        returns -- True if the pool kept it. If not, the client has been
+            closed.
+        """
+        if not self.enabled or not TransportPool.alive(client):
+            TransportPool.discard(client)
+            return False
+
+        with self.lock:
+            self.idle.setdefault(key, []).append((client, time.monotonic()))
+            self.idle.move_to_end(key)
+            doomed = self._evict_idle() + self._evict_oversize()
+
+        for _ in doomed: TransportPool.discard(_)
+        return client not in doomed
+
+
+    def clear(self) -> int:
+        """
+        Close everything in the pool.
+
+        returns -- the number of connections that were closed.
+        """
+        with self.lock:
+            doomed = [ c for clients in self.idle.values() for c, _ in clients ]
+            self.idle.clear()
+
+        for _ in doomed: TransportPool.discard(_)
+        return len(doomed)
+
+
+    @staticmethod
+    def discard(client:object) -> None:
+        try:
+            client.close()
+        except Exception as e:
+            pass
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'size': sum(len(_) for _ in self.idle.values()),
+                'hosts': len(self.idle),
+                'max_size': self.max_size,
+                'max_idle': self.max_idle,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+                }
+
+
+    def _evict_idle(self) -> list:
+        """
+        Must be called with the lock held. The caller closes the clients
+        that are returned, after letting go of the lock.
+        """
+        too_old = time.monotonic() - self.max_idle
+        doomed = []
+        for key in list(self.idle.keys()):
+            clients = self.idle[key]
+            doomed.extend(c for c, t in clients if t < too_old)
+            keep = [ _ for _ in clients if _[1] >= too_old ]
+            if keep: self.idle[key] = keep
+            else: del self.idle[key]
+
+        self.evictions += len(doomed)
+        return doomed
+
+
+    def _evict_oversize(self) -> list:
+        """ Same rules as _evict_idle(). The oldest clients go first. """
+        doomed = []
+        size = sum(len(_) for _ in self.idle.values())
+        while size > self.max_size:
+            key = min(self.idle, key=lambda k: self.idle[k][0][1])
+            client, _ = self.idle[key].pop(0)
+            if not self.idle[key]: del self.idle[key]
+            doomed.append(client)
+            size -= 1
+
+        self.evictions += len(doomed)
+        return doomed
+
+
+# One pool for the whole process.
+pool = TransportPool()
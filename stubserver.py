@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in SSH hosts, as many as you like, on localhost.
+
+    python beachhead.py serve-stub [ -n 1000 ] [ options ]
+
+starts n paramiko servers, each on its own localhost port, and writes an
+ssh config fragment (Host stub0000 .. stub0999) that points at them, so
+that sweep, probe, scan, open session, put and get can be tried against
+a thousand hosts from one machine. Every endpoint lets anyone in, with
+any password or key; the fragment names a client key that we make.
+
+Each endpoint can be given its own:
+
+    kex and cipher lists    what the server offers
+    host keys               generated (rsa, ecdsa) or read from files
+    version                 the identification line, SSH-2.0-...
+    banner                  the text shown before authentication
+    latency                 seconds to wait in each phase: connect
+                            (before the identification line), kex,
+                            auth, channel, and sftp, with some jitter
+    sftp                    a subsystem whose / is a directory of its
+                            own, under a temporary directory
+
+The options apply to every endpoint. A --spec file (a JSON list of
+dicts with the same names as the options, e.g. {"kex": [..],
+"latency": {"auth": 0.5}}) varies them: endpoint i takes its overrides
+from entry i % len(spec).
+
+All the listening sockets share one thread, which accepts connections
+and hands each one to a paramiko Transport of its own. A handshake is
+mostly Python, so one process serves a few dozen sessions a second;
+with --processes the endpoints are shared among that many processes,
+for machines with the CPUs to run them. bench.py uses the same classes
+to run its server in-process.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import selectors
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+paramiko = gkf.lazy_import('paramiko')
+
+class Endpoint:
+    """ Hack to support forward reference. """
+    pass
+
+
+class StubFleet:
+    """ Hack to support forward reference. """
+    pass
+
+
+phases = ('connect', 'kex', 'auth', 'channel', 'sftp')
+key_classes = {'rsa': lambda: paramiko.RSAKey.generate(2048),
+    'ecdsa': lambda: paramiko.ECDSAKey.generate()}
+
+class Endpoint:
+    """
+    The settings, and the counters, of one stand-in host.
+    """
+
+    def __init__(self, name:str, port:int=0,
+            kex:List[str]=None,
+            ciphers:List[str]=None,
+            host_keys:List[object]=(),
+            version:str=None,
+            banner:str=None,
+            latency:Dict[str, float]=None,
+            jitter:float=0.0,
+            sftp_root:str=None):
+        """
+        kex, ciphers -- None for paramiko's defaults.
+        host_keys -- PKeys; at least one.
+        latency -- phase -> seconds; see phases.
+        jitter -- each wait is its seconds times a random number from
+            1 - jitter to 1 + jitter.
+        sftp_root -- None for no sftp.
+        """
+        unknown = set(latency or {}) - set(phases)
+        if unknown: raise ValueError('no such phase: ' + ', '.join(sorted(unknown)))
+
+        self.name = name
+        self.port = port
+        self.kex = kex
+        self.ciphers = ciphers
+        self.host_keys = list(host_keys)
+        self.version = version
+        self.banner = banner
+        self.latency = dict(latency or {})
+        self.jitter = jitter
+        self.sftp_root = sftp_root
+
+        self.connections = 0
+        self.logins = 0
+
+
+    def pause(self, phase:str) -> None:
+        seconds = self.latency.get(phase, 0.0)
+        if seconds <= 0: return
+        if self.jitter: seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(seconds)
+
+
+class StubServer(paramiko.ServerInterface):
+    """ Lets anyone in, with any password or key. """
+
+    def __init__(self, endpoint:Endpoint):
+        self.endpoint = endpoint
+
+    def check_auth_password(self, username:str, password:str) -> int:
+        self.endpoint.pause('auth')
+        self.endpoint.logins += 1
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username:str, key:object) -> int:
+        self.endpoint.pause('auth')
+        self.endpoint.logins += 1
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_none(self, username:str) -> int:
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username:str) -> str:
+        return 'password,publickey'
+
+    def get_banner(self) -> Tuple[str, str]:
+        return (self.endpoint.banner, 'en-US') if self.endpoint.banner else (None, None)
+
+    def check_channel_request(self, kind:str, chanid:int) -> int:
+        if kind != 'session': return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.endpoint.pause('channel')
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_subsystem_request(self, channel:object, name:str) -> bool:
+        if name == 'sftp': self.endpoint.pause('sftp')
+        return super().check_channel_subsystem_request(channel, name)
+
+
+class StubHandle(paramiko.SFTPHandle):
+    def stat(self) -> object:
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class StubSFTP(paramiko.SFTPServerInterface):
+    """ An SFTP server whose / is a local directory. """
+
+    def __init__(self, server:object, root:str, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path:str) -> str:
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def list_folder(self, path:str) -> list:
+        try:
+            found = []
+            for name in os.listdir(self._path(path)):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(self._path(path), name)))
+                attr.filename = name
+                found.append(attr)
+            return found
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path:str) -> object:
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path:str, flags:int, attr:object) -> object:
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY: mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR: mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else: mode = 'rb'
+        handle = StubHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path:str) -> int:
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path:str, attr:object) -> int:
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path:str, attr:object) -> int:
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path:str) -> str:
+        return os.path.normpath('/' + path)
+
+
+class StubFleet:
+
+    def __init__(self, endpoints:List[Endpoint], address:str='127.0.0.1'):
+        self.endpoints = endpoints
+        self.address = address
+        self.selector = None
+        self.thread = None
+        self.stopping = False
+        self.transports = []
+        self.lock = threading.Lock()
+
+        # The server's side of a connection that is only a TCP connect
+        # (a sweep) ends in an error; that is not news.
+        logging.getLogger('stubserver').addHandler(logging.NullHandler())
+
+
+    def listen(self) -> None:
+        """
+        Listen on every endpoint's port (an unused one, if its port is
+        0, and the endpoint is told which). Connections wait in the
+        backlog until start().
+        """
+        if self.selector is not None: return
+        self.selector = selectors.DefaultSelector()
+        for e in self.endpoints:
+            listener = socket.socket()
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.address, e.port))
+            listener.listen(1024)
+            listener.setblocking(False)
+            e.port = listener.getsockname()[1]
+            self.selector.register(listener, selectors.EVENT_READ, e)
+
+
+    def start(self) -> None:
+        """ Start taking connections. """
+        self.listen()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._accept, name='stub server', daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        self.stopping = True
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        if self.selector is not None:
+            for key in list(self.selector.get_map().values()): key.fileobj.close()
+            self.selector.close()
+            self.selector = None
+        with self.lock:
+            for t in self.transports: t.close()
+            self.transports = []
+
+
+    def ssh_config(self, user:str='stub', identity_file:str=None) -> str:
+        """
+        returns -- a Host block for each endpoint, for ~/.ssh/config.
+        """
+        blocks = []
+        for e in self.endpoints:
+            lines = ['Host ' + e.name, '    HostName ' + self.address,
+                '    Port {}'.format(e.port), '    User ' + user]
+            if identity_file: lines.append('    IdentityFile ' + identity_file)
+            blocks.append("\n".join(lines) + "\n")
+        return "\n".join(blocks)
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            active = sum(_.is_active() for _ in self.transports)
+        return {
+            'endpoints': len(self.endpoints),
+            'connections': sum(_.connections for _ in self.endpoints),
+            'logins': sum(_.logins for _ in self.endpoints),
+            'active': active
+            }
+
+
+    def _accept(self) -> None:
+        while not self.stopping:
+            for key, _ in self.selector.select(0.25):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except OSError as e:
+                    continue
+                sock.setblocking(True)
+                endpoint = key.data
+                endpoint.connections += 1
+                if endpoint.latency.get('connect'):
+                    # Do not hold up everyone else's connections.
+                    threading.Thread(target=self._start, args=(sock, endpoint), daemon=True).start()
+                else:
+                    self._start(sock, endpoint)
+
+
+    def _start(self, sock:socket.socket, endpoint:Endpoint) -> None:
+        endpoint.pause('connect')
+        try:
+            t = paramiko.Transport(sock)
+            t.set_log_channel('stubserver')
+            if endpoint.version:
+                t.local_version = endpoint.version if endpoint.version.startswith('SSH-') \
+                    else 'SSH-2.0-' + endpoint.version
+            for k in endpoint.host_keys: t.add_server_key(k)
+
+            options = t.get_security_options()
+            if endpoint.kex:
+                options.kex = endpoint.kex
+                if any('group-exchange' in _ for _ in endpoint.kex): t.load_server_moduli()
+            if endpoint.ciphers: options.ciphers = endpoint.ciphers
+
+            if endpoint.latency.get('kex'):
+                parse = t._parse_kex_init
+                def slow_kex_init(m:object) -> None:
+                    endpoint.pause('kex')
+                    parse(m)
+                t._parse_kex_init = slow_kex_init
+
+            if endpoint.sftp_root:
+                t.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTP, endpoint.sftp_root)
+            t.start_server(event=threading.Event(), server=StubServer(endpoint))
+
+        except Exception as e:
+            gkf.tombstone('{}: {}'.format(endpoint.name, gkf.type_and_text(e)), 30, endpoint.name)
+            sock.close()
+            return
+
+        with self.lock:
+            self.transports.append(t)
+            # Forget the ones that are finished.
+            if len(self.transports) > 4096:
+                self.transports = [ _ for _ in self.transports if _.is_active() ]
+
+
+def host_key(spec:str) -> object:
+    """
+    returns -- a PKey from a file name, or a new one if spec is a key
+        type (rsa, ecdsa).
+    """
+    if spec in key_classes: return key_classes[spec]()
+    return paramiko.PKey.from_path(os.path.expanduser(spec))
+
+
+def build(n:int, root:str=None, port:int=0, prefix:str='stub', spec:List[dict]=None,
+        **defaults) -> List[Endpoint]:
+    """
+    Make n endpoints, named prefix0000 and on, from the defaults (the
+    arguments of Endpoint, with host_keys as specs for host_key()) and
+    the overrides in spec. With sftp, each endpoint has a directory of
+    its own under root. Keys of the same spec are made only once.
+
+    returns -- the endpoints.
+    """
+    keys = {}
+    def keys_for(specs:Iterable[str]) -> List[object]:
+        for _ in specs:
+            if _ not in keys: keys[_] = host_key(_)
+        return [ keys[_] for _ in specs ]
+
+    width = max(4, len(str(n - 1)))
+    endpoints = []
+    for i in range(n):
+        settings = dict(defaults)
+        if spec: settings.update(spec[i % len(spec)])
+        name = '{}{:0{}}'.format(prefix, i, width)
+
+        sftp_root = None
+        if settings.pop('sftp', False):
+            sftp_root = os.path.join(root, name)
+            os.makedirs(sftp_root, exist_ok=True)
+
+        endpoints.append(Endpoint(name, port + i if port else 0,
+            settings.get('kex'), settings.get('ciphers'),
+            keys_for(settings.get('host_keys') or ['ecdsa']),
+            settings.get('version'), settings.get('banner'),
+            settings.get('latency'), settings.get('jitter', 0.0), sftp_root))
+    return endpoints
+
+
+def client_key(directory:str) -> str:
+    """ Make a key for the clients to log in with; returns its file name. """
+    name = os.path.join(directory, 'id_ecdsa')
+    paramiko.ECDSAKey.generate().write_private_key_file(name)
+    return name
+
+
+def _interrupt(signum:int, frame:object) -> None:
+    raise KeyboardInterrupt()
+
+
+def _wait(stop_time:float=None, parent:int=None) -> None:
+    """
+    Sleep until stop_time (by time.monotonic()), a Ctrl-C or a SIGTERM,
+    or, if parent is given, until that process is gone.
+    """
+    try:
+        while stop_time is None or time.monotonic() < stop_time:
+            if parent is not None and os.getppid() != parent: return
+            time.sleep(1.0 if stop_time is None else min(1.0, max(0.0, stop_time - time.monotonic())))
+    except KeyboardInterrupt as e:
+        pass
+
+
+def main(argv:List[str]=None) -> int:
+    parser = argparse.ArgumentParser(prog='beachhead serve-stub',
+        description='Run stand-in SSH hosts on localhost.')
+    parser.add_argument('-n', type=int, default=1, help='how many endpoints.')
+    parser.add_argument('--port', type=int, default=0,
+        help='the first port; the rest follow it. By default, any unused ports.')
+    parser.add_argument('--prefix', default='stub', help='of the host names.')
+    parser.add_argument('--kex', type=str, default=None, help='comma separated kex algorithms.')
+    parser.add_argument('--ciphers', type=str, default=None, help='comma separated ciphers.')
+    parser.add_argument('--host-key', action='append', default=None, metavar='KEY',
+        help="a host key file, or 'rsa' or 'ecdsa' to make one. May be repeated. "
+            "The default is one ecdsa key.")
+    parser.add_argument('--version', type=str, default=None,
+        help='the identification line, SSH-2.0-... .')
+    parser.add_argument('--banner', type=str, default=None, help='shown before auth.')
+    parser.add_argument('--latency', type=str, default='', metavar='PHASE=SECONDS,..',
+        help='waits, in any of: ' + ', '.join(phases))
+    parser.add_argument('--auth-delay', type=float, default=None, help='the same as --latency auth=...')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='vary each wait by up to this fraction of it.')
+    parser.add_argument('--sftp', action='store_true', help='offer an sftp subsystem.')
+    parser.add_argument('--spec', type=str, default=None, help='JSON list of per-endpoint overrides.')
+    parser.add_argument('--ssh-config', type=str, default=None, metavar='FILE',
+        help="write the ssh config fragment here ('-' for stdout).")
+    parser.add_argument('--user', default='stub', help='the User in the ssh config fragment.')
+    parser.add_argument('--processes', type=int, default=1,
+        help='share the endpoints among this many processes, for more than one CPU.')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds.')
+    args = parser.parse_args(argv)
+    if args.n < 1 or args.processes < 1: parser.error('-n and --processes must be at least 1')
+    args.processes = min(args.processes, args.n)
+
+    try:
+        latency = { k:float(v) for k, v in (_.split('=') for _ in args.latency.split(',') if _) }
+    except ValueError as e:
+        parser.error('--latency is PHASE=SECONDS,..')
+    if args.auth_delay is not None: latency['auth'] = args.auth_delay
+    spec = None
+    if args.spec:
+        with open(args.spec) as f: spec = json.load(f)
+
+    # Each endpoint is a listening socket, and each connection another.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    state = tempfile.mkdtemp(prefix='beachhead-stub-')
+    try:
+        endpoints = build(args.n, state, args.port, args.prefix, spec,
+            kex=args.kex.split(',') if args.kex else None,
+            ciphers=args.ciphers.split(',') if args.ciphers else None,
+            host_keys=args.host_key, version=args.version, banner=args.banner,
+            latency=latency, jitter=args.jitter, sftp=args.sftp)
+        share = -(-len(endpoints) // args.processes)
+        fleets = [ StubFleet(endpoints[i:i + share]) for i in range(0, len(endpoints), share) ]
+        for fleet in fleets: fleet.listen()
+
+        fragment = StubFleet(endpoints).ssh_config(args.user, client_key(state))
+        if args.ssh_config == '-':
+            print(fragment)
+        elif args.ssh_config:
+            with open(args.ssh_config, 'w') as f: f.write(fragment)
+
+        gkf.tombstone('{} endpoint[s], {} to {}, ports {} to {}, {} process[es]{}'.format(
+            len(endpoints), endpoints[0].name, endpoints[-1].name,
+            endpoints[0].port, endpoints[-1].port, len(fleets),
+            ', ssh config in ' + args.ssh_config if args.ssh_config not in (None, '-') else ''))
+        gkf.tombstone('state (client key, sftp roots) in {}'.format(state))
+
+        signal.signal(signal.SIGTERM, _interrupt)
+        stop_time = None if args.duration is None else time.monotonic() + args.duration
+        if len(fleets) == 1:
+            fleets[0].start()
+            _wait(stop_time)
+            fleets[0].stop()
+            gkf.tombstone('stopped: {connections} connections, {logins} logins'.format(**fleets[0].stats()))
+            return os.EX_OK
+
+        # Each child takes its share of the listening sockets, and the
+        # parent waits for the time to be up.
+        parent, children = os.getpid(), []
+        for fleet in fleets:
+            pid = os.fork()
+            if pid:
+                children.append(pid)
+                continue
+            for other in fleets:
+                if other is not fleet: other.stop()
+            fleet.start()
+            _wait(None, parent)
+            fleet.stop()
+            gkf.tombstone('{} to {} stopped: {connections} connections, {logins} logins'.format(
+                fleet.endpoints[0].name, fleet.endpoints[-1].name, **fleet.stats()))
+            os._exit(os.EX_OK)
+
+        for fleet in fleets: fleet.stop()
+        _wait(stop_time)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError as e:
+                pass
+        for pid in children: os.waitpid(pid, 0)
+
+    finally:
+        shutil.rmtree(state, ignore_errors=True)
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
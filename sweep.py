@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Is anything listening? A TCP reachability sweep for a whole fleet.
+
+SmallHOP.open_socket() does one blocking connect at a time, so finding
+out which of a few thousand hosts have port 22 open costs the number of
+hosts times the timeout when many of them are down. Here, the connects
+are non-blocking and run together on one asyncio event loop, so the
+whole sweep takes about one timeout, however many hosts there are (up
+to the limit on connects in flight, which keeps us inside the file
+descriptor limit and off the firewall's radar).
+
+For each host we report the time the TCP connect took and, if the
+server sends one, its SSH identification line (RFC 4253, 4.2).
+"""
+
+import asyncio
+import socket
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+import hopstats
+
+# RFC 4253 allows the server to send other lines before the version,
+# but no line may be longer than 255 bytes.
+max_line = 255
+max_lines = 16
+
+async def sweep_one(host:str, hostname:str, port:int,
+        timeout:float, limit:asyncio.Semaphore,
+        family:int=socket.AF_UNSPEC) -> dict:
+    """
+    Connect, wait for the identification line, and hang up. The connect
+    and the banner share one timeout.
+
+    returns -- a dict with the host, where it resolved to, the connect
+        time in seconds (None if it did not connect), the banner (None
+        if there was not one), and the error (if any).
+    """
+    result = {'host':host, 'hostname':hostname, 'port':port,
+        'rtt':None, 'banner':None, 'error':None}
+
+    async with limit:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        writer = None
+        try:
+            start_time = time.perf_counter()
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(hostname, port, family=family, limit=max_line+2),
+                timeout)
+            result['rtt'] = time.perf_counter() - start_time
+            hopstats.stats.record(hostname, 'connect', result['rtt'])
+
+            for i in range(max_lines):
+                line = await asyncio.wait_for(reader.readline(), max(0, deadline - loop.time()))
+                if not line: break
+                if line.startswith(b'SSH-'):
+                    result['banner'] = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+                    break
+
+        except asyncio.TimeoutError as e:
+            result['error'] = 'timeout of {} seconds exceeded.'.format(timeout)
+
+        except Exception as e:
+            result['error'] = gkf.type_and_text(e)
+
+        finally:
+            if writer is not None:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception as e:
+                    pass
+
+    return result
+
+
+async def sweep_all(targets:List[tuple], timeout:float, limit:int,
+        family:int=socket.AF_UNSPEC) -> List[dict]:
+    semaphore = asyncio.Semaphore(max(1, limit))
+    return await asyncio.gather(*(
+        sweep_one(host, hostname, port, timeout, semaphore, family)
+        for host, hostname, port in targets))
+
+
+def sweep(targets:List[tuple], timeout:float=5.0, limit:int=256,
+        family:int=socket.AF_UNSPEC) -> List[dict]:
+    """
+    targets -- (host, hostname, port) triples; host is the name in the
+        ssh config, and the hostname and port are where it points.
+    timeout -- seconds for each host, connect and banner together.
+    limit -- the most connects in flight at once.
+
+    returns -- the result of sweep_one() for each target, in order.
+    """
+    if not targets: return []
+    return asyncio.run(sweep_all(targets, timeout, limit, family))
+
+
+def targets(host_names:Iterable[str], config_file:str=None) -> Tuple[List[tuple], List[str]]:
+    """
+    Resolve names through the ssh config.
+
+    returns -- the (host, hostname, port) triples for sweep(), and the
+        names that are not in the config.
+    """
+    found = []
+    unknown = []
+    for host, info in gkf.get_ssh_hosts_info(host_names, config_file).items():
+        if info is None:
+            unknown.append(host)
+            continue
+        found.append((host, info.get('hostname', host), int(info.get('port', 22))))
+
+    return found, unknown
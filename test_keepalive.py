@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Keepalives sent while other threads make global requests of their own
+on the same transport: each reply must go to whoever asked for it.
+"""
+
+import socket
+import threading
+
+import paramiko
+import pytest
+
+import keepalive
+import stubserver
+
+def echo(self, kind:str, m:object) -> object:
+    """ Answer echo@test with its own data, and refuse the rest. """
+    return (m.get_text(),) if kind == 'echo@test' else False
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    monkeypatch.setattr(stubserver.StubServer, 'check_global_request', echo, raising=False)
+    fleet = stubserver.StubFleet([stubserver.Endpoint('echo',
+        host_keys=[paramiko.ECDSAKey.generate()])])
+    fleet.start()
+    t = paramiko.Transport(socket.create_connection((fleet.address, fleet.endpoints[0].port)))
+    t.connect(username='stub', password='stub')
+    yield t
+    t.close()
+    fleet.stop()
+
+
+def test_global_request_with_keepalives(transport):
+    monitor = keepalive.KeepaliveMonitor(interval=0.001, stall_after=60)
+    monitor.watch('echo', transport)
+    failures = []
+
+    def ask() -> None:
+        for i in range(500):
+            text = str(i)
+            reply = transport.global_request('echo@test', (text,))
+            if reply is None or reply.get_text() != text: failures.append((text, reply))
+
+    # paramiko keeps one global request's answer per transport, so only
+    # one thread of ours may ask at a time; the monitor is the other.
+    try:
+        thread = threading.Thread(target=ask)
+        thread.start()
+        thread.join(60)
+        assert not thread.is_alive()
+        row, = monitor.report()
+    finally:
+        monitor.clear()
+
+    assert failures == []
+    assert row['sent'] > 0 and row['replies'] > 0
+    # Nothing of the monitor's is left on the transport.
+    assert '_send_user_message' not in transport.__dict__
+    assert transport.global_request('echo@test', ('after',)).get_text() == 'after'
+
+
+def test_closed_transport_is_given_back(transport):
+    handlers = dict(transport._handler_table)
+    monitor = keepalive.KeepaliveMonitor(interval=0.001)
+    monitor.watch('echo', transport)
+    transport.close()
+    try:
+        monitor._round()
+        assert len(monitor) == 0
+    finally:
+        monitor.clear()
+    assert '_send_user_message' not in transport.__dict__
+    assert transport._handler_table == handlers
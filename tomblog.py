@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+A backend for gkflib.tombstone() that does not make the caller wait.
+
+tombstone() formats a timestamp, joins its pieces, and does an
+unbuffered write to stderr on every call. From the probe workers that
+means every thread takes its turn at the same file, and the time spent
+formatting is spent on the thread that is supposed to be probing.
+
+With AsyncTombstone installed, tombstone() called from any thread but
+the main one appends a tuple (time, level, thread, host, text) to a
+deque, and that is all. A writer thread wakes every `interval` seconds,
+or sooner if `batch_size` records are waiting, formats everything in
+the queue, and writes it with one write() and one flush(). The format is either the text that tombstone() has always
+written, or one JSON object per line.
+
+Calls below gkf.tombstone_level return before doing anything at all.
+
+The main thread is the console's, and it also print()s; its records
+are written at once, after whatever is queued, so that they come out
+in order with its other output. The console calls flush() after each
+command, so that what the workers said is on the page before the next
+prompt.
+
+The host of a record is the one passed to tombstone(), or else the one
+set for the thread with host_context().
+"""
+
+import atexit
+import collections
+import contextlib
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+
+class AsyncTombstone:
+    """ Hack to support forward reference. """
+    pass
+
+
+levels = {'debug':10, 'info':20, 'warning':30, 'error':40, 'critical':50}
+level_names = { v:k for k, v in levels.items() }
+formats = ('text', 'json')
+
+# The colors are for the console; they do not belong in JSON.
+ansi_codes = re.compile(r'\033\[[0-9;]*m')
+
+# For each thread, [ thread name, host ], so that put() finds both
+# with one lookup.
+_context = threading.local()
+
+def _where() -> list:
+    try:
+        return _context.where
+    except AttributeError as e:
+        _context.where = [threading.current_thread().name, None]
+        return _context.where
+
+
+@contextlib.contextmanager
+def host_context(host:str) -> Iterator[None]:
+    """
+    Records made by this thread inside the with-block are about host,
+    unless tombstone() is told otherwise.
+    """
+    where = _where()
+    previous, where[1] = where[1], host
+    try:
+        yield
+    finally:
+        where[1] = previous
+
+
+class AsyncTombstone:
+
+    def __init__(self, fmt:str='text', stream:object=None,
+            interval:float=0.05, batch_size:int=1000, max_queue:int=100000):
+        """
+        fmt -- 'text' or 'json'.
+        stream -- where to write. None means whatever sys.stderr is at
+            the time of the write, which is what tombstone() does.
+        max_queue -- if the writer falls this far behind, the caller
+            writes the queue itself rather than letting it grow.
+        """
+        if fmt not in formats: raise ValueError('format must be one of {}'.format(formats))
+        self.fmt = fmt
+        self.stream = stream
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+
+        self.queue = collections.deque()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopping = False
+        self.pid = os.getpid()
+
+        self.records = 0
+        self.batches = 0
+        self.caller_writes = 0
+        self.errors = 0
+
+
+    def put(self, args:object, level:int=20, host:str=None) -> None:
+        """ What tombstone() calls. """
+        if not isinstance(args, str):
+            args = " ".join(str(_) for _ in args) if isinstance(args, list) else str(args)
+        try:
+            where = _context.where
+        except AttributeError as e:
+            where = _where()
+        self.queue.append((time.time(), level, where[0], host or where[1], args))
+
+        if threading.current_thread() is threading.main_thread():
+            self.flush()
+            return
+        if self.thread is None: self.start()
+        n = len(self.queue)
+        if n >= self.max_queue:
+            self.caller_writes += 1
+            self.flush()
+        elif n >= self.batch_size:
+            self.wakeup.set()
+
+
+    def start(self) -> None:
+        with self.write_lock:
+            if self.thread is not None: return
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name='tombstone writer', daemon=True)
+            self.thread.start()
+
+
+    def stop(self) -> None:
+        """ Write what is queued, and stop the writer. """
+        self.stopping = True
+        self.wakeup.set()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread(): thread.join()
+        self.flush()
+
+
+    def flush(self) -> int:
+        """
+        Write everything queued so far, from the calling thread.
+
+        returns -- the number of records written.
+        """
+        with self.write_lock:
+            batch = []
+            try:
+                while True: batch.append(self.queue.popleft())
+            except IndexError as e:
+                pass
+            if not batch: return 0
+
+            lines = self._format(batch)
+            try:
+                stream = self.stream or sys.stderr
+                stream.write(lines)
+                stream.flush()
+            except (OSError, ValueError) as e:
+                # Closed underneath us (quit closes every descriptor).
+                self.errors += 1
+
+            self.records += len(batch)
+            self.batches += 1
+            return len(batch)
+
+
+    def stats(self) -> dict:
+        return {
+            'format': self.fmt,
+            'level': level_names.get(gkf.tombstone_level, gkf.tombstone_level),
+            'queued': len(self.queue),
+            'records': self.records,
+            'batches': self.batches,
+            'caller_writes': self.caller_writes,
+            'errors': self.errors,
+            'running': self.thread is not None
+            }
+
+
+    def _run(self) -> None:
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+
+    def _format(self, batch:list) -> str:
+        pid = str(self.pid)
+        lines = []
+        if self.fmt == 'json':
+            for t, level, thread, host, text in batch:
+                lines.append(json.dumps({
+                    'time': datetime.datetime.fromtimestamp(t).isoformat(timespec='milliseconds'),
+                    'elapsed': round(t - gkf.START_TIME, 3),
+                    'pid': self.pid,
+                    'level': level_names.get(level, level),
+                    'thread': thread,
+                    'host': host,
+                    'message': ansi_codes.sub('', text)
+                    }))
+        else:
+            # The stamp is to a tenth of a second, so most of a batch
+            # shares one.
+            tenths = stamp = None
+            for t, level, thread, host, text in batch:
+                if int(t * 10) != tenths:
+                    tenths = int(t * 10)
+                    stamp = datetime.datetime.fromtimestamp(t).isoformat()[:21].replace('T', ' @ ')
+                context = [ _ for _ in (None if thread == 'MainThread' else thread, host) if _ ]
+                lines.append("{} :: ( {} )({}){} {}".format(
+                    stamp, round(t - gkf.START_TIME, 3), pid,
+                    '[' + ' '.join(context) + ']' if context else '',
+                    text))
+        lines.append('')
+        return "\n".join(lines)
+
+
+def install(fmt:str='text', level:int=None, stream:object=None) -> AsyncTombstone:
+    """
+    Put a new AsyncTombstone behind tombstone(), writing out (and
+    replacing) the one that is there, if any.
+    """
+    backend = AsyncTombstone(fmt, stream)
+    uninstall()
+    gkf.tombstone_backend = backend
+    if level is not None: gkf.tombstone_level = level
+    return backend
+
+
+def uninstall() -> None:
+    """ Go back to tombstone() writing for itself. """
+    backend = gkf.tombstone_backend
+    if backend is None: return
+    backend.stop()
+    gkf.tombstone_backend = None
+    # Anything that arrived while we were stopping.
+    backend.flush()
+
+
+def flush() -> None:
+    if gkf.tombstone_backend is not None: gkf.tombstone_backend.flush()
+
+
+def _after_fork() -> None:
+    """
+    A forked child has no writer thread, may leave by os._exit(), and
+    should not write again what its parent had queued; tombstone() goes
+    back to writing for itself.
+    """
+    gkf.tombstone_backend = None
+
+
+atexit.register(uninstall)
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Move many files over one SSH transport at once.
+
+SFTP is a request/response protocol, so a single SFTPClient spends most
+of its time on small files waiting for the round trip. Several clients,
+each on its own channel of the same transport, keep the link busy. This
+module expands wildcards on either end, hands the files to a fixed
+number of workers, and reports on each file and on the whole batch.
+"""
+
+import concurrent.futures
+import fnmatch
+import glob
+import os
+import posixpath
+import queue
+import stat
+import time
+import typing
+from   typing import *
+
+import gkflib as gkf
+paramiko = gkf.lazy_import('paramiko')
+
+wildcards = '*?['
+
+def expand_local(pattern:str) -> List[str]:
+    """
+    returns -- the regular files that match the pattern, sorted.
+    """
+    return sorted(_ for _ in glob.glob(os.path.expanduser(pattern)) if os.path.isfile(_))
+
+
+def expand_remote(sftp:object, pattern:str) -> List[str]:
+    """
+    Expand a wildcard in the last part of a remote path. Wildcards in
+    the directory part are not supported; neither is sftp.
+
+    returns -- the regular files that match the pattern, sorted.
+    """
+    if not any(c in pattern for c in wildcards): return [pattern]
+
+    directory, name = posixpath.split(pattern)
+    return sorted(
+        posixpath.join(directory, _.filename)
+        for _ in sftp.listdir_attr(directory or '.')
+        if stat.S_ISREG(_.st_mode or 0) and fnmatch.fnmatchcase(_.filename, name)
+        )
+
+
+def throughput(nbytes:int, seconds:float) -> float:
+    """ returns -- MB/s, where a MB is 10**6 bytes. """
+    return nbytes / 1e6 / seconds if seconds > 0 else 0.0
+
+
+def transfer(transport:object,
+        pairs:List[Tuple[str, str]],
+        direction:str='put',
+        workers:int=4,
+        sftp:object=None) -> Iterator[dict]:
+    """
+    Copy each (source, destination) pair, with as many as `workers`
+    files in flight at once. Each worker has its own SFTPClient on the
+    given transport. If sftp is given, it is used as one of them (and
+    left open).
+
+    Yields a dict for each file as it finishes, with the source, the
+    destination, bytes moved, elapsed seconds, and an error (or None).
+    """
+    if direction not in ('put', 'get'):
+        raise ValueError('direction must be put or get, not ' + str(direction))
+    if not pairs: return
+
+    workers = max(1, min(workers, len(pairs)))
+    clients = queue.Queue()
+    ours = []
+    if sftp is not None: clients.put(sftp)
+    while clients.qsize() + len(ours) < workers:
+        ours.append(paramiko.SFTPClient.from_transport(transport))
+    for _ in ours: clients.put(_)
+
+    def one(pair:tuple) -> dict:
+        source, destination = pair
+        result = {'source':source, 'destination':destination, 'bytes':0, 'seconds':0.0, 'error':None}
+        client = clients.get()
+        try:
+            start_time = time.perf_counter()
+            if direction == 'put':
+                result['bytes'] = client.put(source, destination).st_size
+            else:
+                client.get(source, destination)
+                result['bytes'] = os.path.getsize(destination)
+            result['seconds'] = time.perf_counter() - start_time
+
+        except Exception as e:
+            result['error'] = gkf.type_and_text(e)
+
+        finally:
+            clients.put(client)
+
+        return result
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = [ pool.submit(one, _) for _ in pairs ]
+    try:
+        for f in concurrent.futures.as_completed(futures):
+            yield f.result()
+    finally:
+        for f in futures: f.cancel()
+        pool.shutdown()
+        for _ in ours: _.close()